@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+"""
+column_profile streams a delivered file and keeps a fixed-size, mergeable
+summary of each column, so profiles of a file's byte ranges can be built in
+parallel and combined, and compared against the previous delivery
+"""
+
+import csv
+import hashlib
+import heapq
+import io
+import itertools
+import math
+from collections import Counter
+
+# hyperloglog precision: 2 ** 12 registers, about 1.6% standard error
+HLL_PRECISION = 12
+# number of frequent values tracked per column
+TOP_VALUES = 10
+# size of the blocks a range is read in
+READ_BYTES = 4 * 1024 * 1024
+# rows parsed and added to the sketches at a time
+BLOCK_ROWS = 10000
+# values counted as missing
+NULL_VALUES = frozenset(['', 'NULL'])
+# a change in the share of missing values larger than this is drift
+NULL_RATE_DRIFT = 0.1
+# distinct values dropping below this share of the previous count is drift
+DISTINCT_DROP_RATIO = 0.5
+# columns with fewer distinct values than this aren't checked for a drop
+MIN_DISTINCT_TO_COMPARE = 10
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct values added, in fixed memory."""
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(2 ** precision)
+
+    def add_all(self, values):
+        """Add string values."""
+        registers = self.registers
+        blake2b = hashlib.blake2b
+        rest_bits = 64 - self.precision
+        rest_mask = (1 << rest_bits) - 1
+        for value in values:
+            hashed = int.from_bytes(blake2b(value.encode('utf-8'), \
+                digest_size=8).digest(), 'big')
+            index = hashed >> rest_bits
+            rank = rest_bits - (hashed & rest_mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge(self, other):
+        """Fold in the values added to another sketch."""
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        """Return the estimated number of distinct values."""
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        raw = alpha * size * size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * size and zeros:
+            # small range correction, by linear counting
+            return int(round(size * math.log(size / zeros)))
+        return int(round(raw))
+
+
+class ColumnSketch(object):
+    """Fixed-size summary of one column: its number of values and missing
+    values, distinct values (HyperLogLog), least and greatest values, and
+    most frequent values (Misra-Gries, so counts are lower bounds)."""
+
+    def __init__(self):
+        self.count = 0
+        self.nulls = 0
+        self.distinct = HyperLogLog()
+        self.min = None
+        self.max = None
+        self.top = {}
+
+    def add_values(self, values):
+        """Add a block of values. Repeats within the block are hashed and
+        compared once."""
+        counts = Counter(values)
+        self.count += len(values)
+        for null in NULL_VALUES:
+            self.nulls += counts.pop(null, 0)
+        if not counts:
+            return
+        self.distinct.add_all(counts)
+        self.update_range(min(counts), max(counts))
+        self.update_top(counts)
+
+    def update_range(self, low, high):
+        """Widen the least and greatest values seen."""
+        if self.min is None or low < self.min:
+            self.min = low
+        if self.max is None or high > self.max:
+            self.max = high
+
+    def update_top(self, counts):
+        """Fold counts into the frequent values, keeping at most TOP_VALUES
+        of them by subtracting the next largest count from every value."""
+        combined = Counter(self.top)
+        combined.update(counts)
+        if len(combined) > TOP_VALUES:
+            cutoff = heapq.nlargest(TOP_VALUES + 1, combined.values())[-1]
+            combined = {value: count - cutoff for value, count in \
+                combined.items() if count > cutoff}
+        self.top = dict(combined)
+
+    def merge(self, other):
+        """Fold in another sketch of the same column."""
+        self.count += other.count
+        self.nulls += other.nulls
+        self.distinct.merge(other.distinct)
+        if other.min is not None:
+            self.update_range(other.min, other.max)
+        self.update_top(other.top)
+
+    def summary(self):
+        """Return the summary as a dict of plain values."""
+        top = sorted(self.top.items(), key=lambda item: (-item[1], item[0]))
+        return {'count': self.count, 'nulls': self.nulls, \
+            'distinct': self.distinct.estimate(), 'min': self.min, \
+            'max': self.max, 'top': top}
+
+
+def add_rows(sketches, rows):
+    """Add a block of parsed rows to the column sketches. Rows with the
+    wrong number of fields are left out."""
+    width = len(sketches)
+    rows = [row for row in rows if len(row) == width]
+    if not rows:
+        return
+    for sketch, values in zip(sketches, zip(*rows)):
+        sketch.add_values(values)
+
+
+def profile_lines(lines, width, delim, skip_header):
+    """Parse decoded lines and return the column sketches of their rows."""
+    sketches = [ColumnSketch() for column in range(width)]
+    reader = csv.reader(lines, delimiter=delim)
+    if skip_header:
+        next(reader, None)
+    while True:
+        rows = list(itertools.islice(reader, BLOCK_ROWS))
+        if not rows:
+            return sketches
+        add_rows(sketches, rows)
+
+
+def range_lines(path, start, end, encoding, state):
+    """Yield the decoded lines of the records that start between byte
+    offsets start and end of path, reading it in blocks. The last record is
+    followed past end if it has a quoted line break. If the range starts
+    inside a quoted field (state['in_quotes']), the rest of that record is
+    skipped. The parity of the quotes between start and end is left in
+    state['quotes_odd']."""
+    in_quotes = state['in_quotes']
+    odd = 0
+    offset = start
+    with open(path, 'rb') as data:
+        data.seek(start)
+        while in_quotes and offset < end:
+            line = data.readline()
+            if not line:
+                break
+            offset += len(line)
+            quotes = line.count(b'"') % 2
+            odd ^= quotes
+            in_quotes ^= quotes
+        if in_quotes:
+            # the whole range is inside a record that started earlier
+            state['quotes_odd'] = bool(odd)
+            return
+        leftover = b''
+        while offset < end:
+            block = data.read(min(READ_BYTES, end - offset))
+            if not block:
+                break
+            offset += len(block)
+            odd ^= block.count(b'"') % 2
+            block = leftover + block
+            cut = block.rfind(b'\n') + 1
+            leftover = block[cut:]
+            for line in io.StringIO(block[:cut].decode(encoding, 'replace'), \
+                    newline=''):
+                yield line
+        in_quotes = state['in_quotes'] ^ odd
+        while in_quotes:
+            line = data.readline()
+            if not line:
+                break
+            leftover += line
+            in_quotes ^= line.count(b'"') % 2
+        for line in io.StringIO(leftover.decode(encoding, 'replace'), newline=''):
+            yield line
+    state['quotes_odd'] = bool(odd)
+
+
+def profile_range(path, start, end, width, delim, encoding, in_quotes=False):
+    """Profile the records starting in a byte range of path, assuming it
+    starts in_quotes or not. Run in worker processes. Returns the column
+    sketches and whether the range holds an odd number of quotes."""
+    state = {'in_quotes': in_quotes}
+    sketches = profile_lines(range_lines(path, start, end, encoding, state), \
+        width, delim, start == 0)
+    return sketches, state['quotes_odd']
+
+
+def profile_file(path, bounds, width, delim, encoding, pool=None):
+    """Profile each column of a file after its header. bounds are the byte
+    ranges to profile, each ending on a line feed (see
+    deep_check.range_bounds), profiled in parallel in pool. Each range is
+    first profiled as if it starts at a record boundary. An odd number of
+    quotes before a range shows it starts inside a quoted field, and it is
+    profiled again. Returns a summary dict per column."""
+    if pool is None or len(bounds) < 2:
+        profiles = (profile_range(path, start, end, width, delim, encoding) \
+            for start, end in bounds)
+    else:
+        profiles = [pool.submit(profile_range, path, start, end, width, delim, \
+            encoding) for start, end in bounds]
+        profiles = (future.result() for future in profiles)
+    sketches = [ColumnSketch() for column in range(width)]
+    in_quotes = False
+    for (start, end), (range_sketches, quotes_odd) in zip(bounds, profiles):
+        if in_quotes:
+            range_sketches, quotes_odd = profile_range(path, start, end, width, \
+                delim, encoding, True)
+        for sketch, range_sketch in zip(sketches, range_sketches):
+            sketch.merge(range_sketch)
+        in_quotes ^= quotes_odd
+    return [sketch.summary() for sketch in sketches]
+
+
+def profile_stream(stream, width, delim, encoding):
+    """Profile each column of a decompressing stream after its header, in a
+    single pass. Returns a summary dict per column."""
+    lines = (line.decode(encoding, 'replace') for line in stream)
+    return [sketch.summary() for sketch in \
+        profile_lines(lines, width, delim, True)]
+
+
+def compare_profiles(previous, current):
+    """Compare the column summaries of a file against those of the previous
+    delivery, both keyed by column name. Returns a list of descriptions of
+    the columns that drifted: a change in the share of missing values, a
+    drop in distinct values, an earlier least value or an earlier greatest
+    value."""
+    drift = []
+    for column, new in current.items():
+        old = previous.get(column)
+        if not old or not old['count'] or not new['count']:
+            continue
+        old_rate = old['nulls'] / float(old['count'])
+        new_rate = new['nulls'] / float(new['count'])
+        if abs(new_rate - old_rate) > NULL_RATE_DRIFT:
+            drift.append("{} missing {:.0%} -> {:.0%}".format(column, old_rate, \
+                new_rate))
+        if old['distinct'] >= MIN_DISTINCT_TO_COMPARE and \
+                new['distinct'] < old['distinct'] * DISTINCT_DROP_RATIO:
+            drift.append("{} distinct values {} -> {}".format(column, \
+                old['distinct'], new['distinct']))
+        if old['min'] is not None and new['min'] is not None:
+            if new['min'] < old['min']:
+                drift.append("{} least value {} -> {}".format(column, \
+                    old['min'], new['min']))
+            if new['max'] < old['max']:
+                drift.append("{} greatest value {} -> {}".format(column, \
+                    old['max'], new['max']))
+    return drift
@@ -13,14 +13,33 @@ from string import digits
 import logging
 import logging.handlers
 import sqlite3
-import shutil
 import os
+import re
+import json
+import zipfile
+import signal
+import threading
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
 from datetime import date
 from subprocess import call
 
 import datetime
 import click
 import fileset_db
+import column_profile
+import deep_check
+import file_hash
+import filetype_classifier
+import header_diff
+import header_history
+import header_lsh
+import header_reader
+import report_model
+import watcher
+from inventory import DirectoryInventory, FileEntry
+from status_writer import StatusWriter
 from fuzzywuzzy import fuzz
 
 VERSION_NUMBER = '0.3'
@@ -30,10 +49,23 @@ FILE_ERROR_CODES_DATA_FILE = 'file_error_codes.sql'
 FILETYPES_DATA_FILE = 'filetypes.sql'
 FILESET_DATABASE = 'fileset_db.sqlite'
 FILESET_DATABASE_BACKUP = 'fileset_db.sqlite.bk'
-FILETYPES_TO_SKIP = ['pdf', 'xlsx', 'xls', 'zip', 'jpeg', 'jpg', 'DS_Store']
+# number of backup generations to keep (fileset_db.sqlite.bk, .bk.1, ...)
+BACKUP_GENERATIONS = 3
+# gzip the backups
+BACKUP_COMPRESS = False
+# database pages copied per step of the online backup
+BACKUP_PAGES_PER_STEP = 1024
+FILETYPES_TO_SKIP = ['pdf', 'xlsx', 'xls', 'jpeg', 'jpg', 'DS_Store']
 # delete any records in the database older than the most current number below
 # default is 30 most recent runs
 MAX_RUNS_TO_KEEP_IN_DB = 30
+# also delete records for runs older than this many days. None keeps runs
+# regardless of age
+MAX_DAYS_TO_KEEP_IN_DB = None
+# reclaim free pages after cleanup in steps of this many pages, up to the
+# maximum number of steps, so cleanup time stays bounded
+VACUUM_PAGES_PER_STEP = 1000
+VACUUM_MAX_STEPS = 10
 
 # logging settings
 # log file size in bytes
@@ -42,35 +74,136 @@ BACKUP_COUNT_LOG_FILES = 5
 
 # set the minimum match ratio for fuzzy matching
 MATCH_RATIO = 80
+# weights of filename and header similarity in the confidence of a match
+NAME_WEIGHT = 0.4
+HEADER_WEIGHT = 0.6
+# header similarity a file whose name matches no stored pattern needs to be
+# checked against a stored header
+MIN_HEADER_MATCH = 0.5
+# filetype id of files that couldn't be classified
+UNKNOWN_FILETYPE = 32
+# the most bytes read from a file looking for the end of its header, beyond
+# which its header is too long (code 9). Set in header_reader
+MAX_HEADER_BYTES = header_reader.MAX_HEADER_BYTES
+# archive directories scanned per partner when building filesets, newest
+# first. None scans them all
+MAX_BUILD_DEPTH = None
+# a partner's first fileset build stops after this many archive directories
+# in a row turn up no filetype that wasn't in a newer one
+FIRST_BUILD_QUIET_DIRS = 3
+# short descriptions of the file status codes, used for logging
+FILE_STATUS_DESCRIPTIONS = {1: 'exact match', 2: 'new column', \
+    3: 'deleted column', 4: 'missing header', 5: 'unmatched filename', \
+    6: 'missing and added col', 7: 'no previous fileset', 8: 'moved column', \
+    9: 'header too long'}
+# write each partner's file results as soon as it is checked, rather than
+# once for the whole run
+FLUSH_STATUS_PER_PARTNER = False
+# translation table used to strip digits out of filenames before matching
+STRIP_DIGITS = str.maketrans('', '', digits)
+# processes used to read whole files with --deep and --profile. None uses
+# every CPU
+DEEP_WORKERS = None
+# threads used to hash files with --fingerprint
+HASH_WORKERS = 4
+# stored headers parsed so far, keyed by the header text. In --watch mode,
+# headers no longer in any fileset are dropped when filesets are reloaded
+PARSED_STORED_HEADERS = {}
+
+# watch mode settings
+# minutes between reports
+WATCH_REPORT_MINUTES = 24 * 60
+# seconds to wait after a file is written before checking it
+WATCH_SETTLE_SECONDS = 5
+# seconds between directory listings where inotify isn't available
+WATCH_POLL_SECONDS = 60
 
 FROM_EMAILS = 'please-do-not-reply@ufl.edu'
 TO_EMAILS = 'nrejack@ufl.edu'
 MAIL_SERVER = 'smtp.ufl.edu'
 
+def check_archive_date(ctx, param, value):
+    """Click callback checking a --since or --until date is a valid date
+    written YYYYMMDD, as archive directories are named."""
+    if value is None:
+        return value
+    try:
+        if not re.match(r'\d{8}$', value):
+            raise ValueError(value)
+        datetime.datetime.strptime(value, '%Y%m%d')
+    except ValueError:
+        raise click.BadParameter("{} is not a date written YYYYMMDD, " \
+            "e.g. 20180101.".format(value))
+    return value
+
 @click.option('-v', '--verbose', help='Run in verbose mode.', \
     is_flag=True, default=False)
 @click.option('-c', '--create', help='Prompt for creation of tables \
     and loading data.', is_flag=True, default=False)
 @click.option('-b', '--buildfileset', help='Build fileset for partner.', \
     is_flag=True, default=False)
+@click.option('-w', '--workers', help='Number of partners to check in \
+    parallel, or headers to read in parallel with --buildfileset.', type=int, \
+    default=1)
+@click.option('--partner', help='With --buildfileset, only build the fileset \
+    of this partner. Can be given more than once.', multiple=True)
+@click.option('--since', help='With --buildfileset, only scan archive \
+    directories dated on or after this date (YYYYMMDD).', default=None, \
+    callback=check_archive_date)
+@click.option('--until', help='With --buildfileset, only scan archive \
+    directories dated on or before this date (YYYYMMDD).', default=None, \
+    callback=check_archive_date)
+@click.option('--rescan', help='With --buildfileset, scan archive directories \
+    already added to the fileset again.', is_flag=True, default=False)
+@click.option('--depth', help='With --buildfileset, scan at most this many of \
+    the newest archive directories of each partner.', type=int, \
+    default=MAX_BUILD_DEPTH)
+@click.option('-y', '--yes', help='With --buildfileset, scan every archive \
+    directory without asking.', is_flag=True, default=False)
+@click.option('--keep-runs', help='Number of most recent runs to keep in the \
+    database.', type=int, default=MAX_RUNS_TO_KEEP_IN_DB)
+@click.option('--keep-days', help='Delete runs older than this many days from \
+    the database.', type=int, default=MAX_DAYS_TO_KEEP_IN_DB)
+@click.option('--vacuum', help='Switch the database to incremental vacuuming. \
+    Rewrites the whole file once.', is_flag=True, default=False)
+@click.option('--watch', help='Keep running, checking files as they arrive.', \
+    is_flag=True, default=False)
+@click.option('--report-every', help='In watch mode, minutes between reports.', \
+    type=int, default=WATCH_REPORT_MINUTES)
+@click.option('--deep', help='Read whole files and check every row has as \
+    many fields as the header.', is_flag=True, default=False)
+@click.option('--profile', help='Read whole files and compare a profile of \
+    each column against the previous delivery.', is_flag=True, default=False)
+@click.option('--fingerprint', help='Hash file contents and flag files that \
+    were delivered before.', is_flag=True, default=False)
+@click.option('--results', help='Stream a JSON Lines record of each partner \
+    and file result to this file as the checks finish.', default=None)
+@click.option('--results-csv', help='Stream the same records to this CSV \
+    file too.', default=None)
+@click.option('--journal-mode', help='SQLite journal mode to use for the run.', \
+    type=click.Choice(fileset_db.JOURNAL_MODES), default=None)
+@click.option('--synchronous', help='SQLite synchronous level to use for the \
+    run.', type=click.Choice(fileset_db.SYNCHRONOUS_LEVELS), default=None)
 #@click.option('-m', '--manual', help='Run in manual mode.', is_flag=True, \
 #cd da    default=False)
 @click.command()
-def main(verbose, create, buildfileset):
+def main(verbose, create, buildfileset, workers, partner, since, until, rescan, \
+        depth, yes, keep_runs, keep_days, vacuum, watch, report_every, deep, profile, fingerprint, results, results_csv, \
+        journal_mode, synchronous):
     """main function for data_inbox."""
     logger = configure_logging(verbose)
 
     logger.info("Starting data_inbox.py")
-    # backup db if it already exists
+    # backup db if it already exists, while the run carries on
+    backup_thread = None
     if os.path.isfile(FILESET_DATABASE):
-        logger.info("Backing up database %s to %s", FILESET_DATABASE, \
-            FILESET_DATABASE_BACKUP)
-        shutil.copy2(FILESET_DATABASE, FILESET_DATABASE_BACKUP)
+        backup_thread = start_backup(logger)
     # open existing db
     logger.info("Opening database: %s", FILESET_DATABASE)
     conn = sqlite3.connect(FILESET_DATABASE)
     conn.row_factory = dict_factory
     conn_cursor = conn.cursor()
+    fileset_db.set_pragmas(conn, journal_mode, synchronous)
 
     # set up tables
     if create:
@@ -81,9 +214,15 @@ def main(verbose, create, buildfileset):
         for sql_file in [PARTNER_DATA_FILE, PARTNER_ERROR_CODES_DATA_FILE, \
                         FILE_ERROR_CODES_DATA_FILE, FILETYPES_DATA_FILE]:
             read_in_sql_files(os.path.join('sql', sql_file), logger, conn)
+        fileset_db.upgrade_schema(conn)
     if create:
         exit()
 
+    # bring an existing database up to the current schema
+    fileset_db.upgrade_schema(conn)
+    if vacuum:
+        fileset_db.enable_incremental_vacuum(conn)
+
     # read list of partners from table
     # TODO: abstract the data access methods
     partner_list_query = "SELECT id, name, name_full, incoming_file_directory FROM partners"
@@ -100,29 +239,79 @@ def main(verbose, create, buildfileset):
 
     # build fileset, and stop execution after
     if buildfileset:
-        add_new_fileset(conn, logger)
+        add_new_fileset(conn, logger, partner, since, until, yes, workers, \
+            rescan, depth)
         exit()
 
     # do database maintenance to keep it from getting too big
-    cleanup_database(conn, logger)
+    cleanup_database(conn, logger, keep_runs, keep_days)
+
+    # results are buffered and written out in batches, and streamed out
+    # as they are produced if asked for
+    sink = None
+    if results:
+        names = {pid: partner['name_full'] for pid, partner in partner_info.items()}
+        sink = report_model.ResultSink(results, names, results_csv)
+    elif results_csv:
+        logger.error("--results-csv needs --results as well. Not streaming results.")
+    writer = StatusWriter(conn, sink)
+
+    # whole files are read in parallel byte ranges, and hashed in threads
+    full_read = None
+    if deep or profile or fingerprint:
+        full_read = {'pool': ProcessPoolExecutor(DEEP_WORKERS), 'rows': deep, \
+            'profile': profile, 'fingerprint': fingerprint, \
+            'hash_pool': ThreadPoolExecutor(HASH_WORKERS)}
+
+    # check partner dirs and files
+    run_checks(partner_info, conn, logger, current_run_id, writer, workers, \
+        full_read)
+
+    if watch:
+        # keep checking files as they arrive, reporting on a schedule
+        watch_partners(partner_info, conn, logger, current_run_id, writer, \
+            report_every * 60, keep_runs, keep_days, full_read)
+    else:
+        report_run(conn, logger, current_run_id, partner_info, sink)
+    if sink:
+        sink.close()
+    if full_read:
+        full_read['pool'].shutdown()
+        full_read['hash_pool'].shutdown()
 
-    # check partner dirs for files
-    check_partner_dirs(partner_info, conn, logger, current_run_id)
+    commit_tran(conn, logger)
+    logger.info("Closing %s", FILESET_DATABASE)
+    conn.close()
+    if backup_thread:
+        backup_thread.join()
 
-    # report on partner results
-    temp_report = run_partner_report(conn, logger, current_run_id, partner_info)
+def run_checks(partner_info, conn, logger, current_run_id, writer, workers, \
+        full_read=None):
+    """Check every partner's directory, then the headers of their files.
+    With full_read, whole files are read too, see read_whole_file."""
+    # check partner dirs for files
+    inventories = check_partner_dirs(partner_info, conn, logger, current_run_id, \
+        writer, workers)
+    writer.flush()
 
     # check partner files for headers
-    check_partner_files(partner_info, conn, logger, current_run_id)
-
-    # generate exception report
-    report = generate_exception_report(conn, logger, current_run_id, partner_info)
-
-    # add the partner results after the exception
-    report += temp_report
-
-    # run file report
-    report += run_file_report(conn, logger, current_run_id, partner_info)
+    check_partner_files(partner_info, conn, logger, current_run_id, writer, \
+        workers, inventories, full_read)
+    writer.flush()
+
+def report_run(conn, logger, current_run_id, partner_info, sink=None):
+    """Build the report for a run, write it out and print it. The results
+    of the run are loaded once, from the results stream if there is one,
+    and every section is rendered from them."""
+    if sink:
+        partners = sink.load_run(current_run_id)
+    else:
+        partners = report_model.load_run(conn, current_run_id)
+    # exceptions first, then the partner results, then every file
+    lines = generate_exception_report(partners, logger)
+    lines += run_partner_report(partners, logger, current_run_id, partner_info)
+    lines += run_file_report(partners, logger)
+    report = "".join(lines)
 
     #send_report(report, FROM_EMAILS, TO_EMAILS, MAIL_SERVER)
     write_report(report, logger)
@@ -130,41 +319,162 @@ def main(verbose, create, buildfileset):
     print(report)
     print("*****************")
 
-    commit_tran(conn, logger)
-    logger.info("Closing %s", FILESET_DATABASE)
-    conn.close()
-
-def cleanup_database(conn, logger):
+def watch_partners(partner_info, conn, logger, current_run_id, writer, \
+        report_seconds, keep_runs, keep_days, full_read=None):
+    """Watch the partners' incoming directories and check each file's header
+    shortly after it has been written, adding the results to the open run.
+    Every report_seconds the run is reported and a new run is started.
+    Runs until interrupted or sent SIGTERM."""
+    signal.signal(signal.SIGTERM, stop_watching)
+    partners = {}
+    for partner in make_watch_list(conn, logger):
+        partners[partner['dir']] = partner
+    load_watch_filesets(conn, partners.values(), logger)
+    partner_codes = get_partner_codes(conn, current_run_id)
+    file_watcher = watcher.open_watcher(list(partners), WATCH_POLL_SECONDS)
+    logger.info("Watching %i partner directories.", len(partners))
+    # files written, waiting to settle before their header is checked
+    pending = {}
+    next_report = time.time() + report_seconds
+    try:
+        while True:
+            for directory, name in file_watcher.events(1):
+                pending[(directory, name)] = time.time() + WATCH_SETTLE_SECONDS
+            now = time.time()
+            for directory, name in [key for key in pending if pending[key] <= now]:
+                del pending[(directory, name)]
+                partner = partners[directory]
+                entry = FileEntry(directory, name)
+                if not os.path.exists(entry.path):
+                    continue
+                if partner_codes.get(partner['id']) != 3:
+                    # partner now has new data this run
+                    conn.execute("DELETE FROM partner_run_status WHERE \
+                        run_id = ? AND partner = ?", (current_run_id, partner['id']))
+                    writer.add_partner_status(3, partner['id'], current_run_id)
+                    partner_codes[partner['id']] = 3
+                for result in check_partner_file(partner, entry, \
+                        partner['index'], logger, full_read, current_run_id):
+                    # replace any result for the file from earlier in the run
+                    for table in ('file_run_status', 'file_profile'):
+                        conn.execute("DELETE FROM {} WHERE run_id = ? AND \
+                            partner = ? AND filename_pattern = ?".format(table), \
+                            (current_run_id, partner['id'], \
+                            result['filename_pattern']))
+                    record_file_status(result, partner['id'], current_run_id, \
+                        writer, logger)
+                    if result['cache']:
+                        writer.add_header_cache(result['cache'])
+                    if result['fingerprint']:
+                        # later deliveries are compared against this one too
+                        remember_fingerprint(partner['fingerprints'], \
+                            result['fingerprint'])
+                    if result['profile']:
+                        # compare later deliveries against this one
+                        partner['profiles'][result['profile']['normalized_name']] = \
+                            {result['profile']['path']: result['profile']}
+            writer.flush()
+            if now >= next_report:
+                report_run(conn, logger, current_run_id, partner_info, \
+                    writer.sink)
+                current_run_id = check_run_id(conn.cursor(), conn, logger)
+                cleanup_database(conn, logger, keep_runs, keep_days)
+                # filesets may have been rebuilt since the last run
+                load_watch_filesets(conn, partners.values(), logger)
+                partner_codes = {}
+                next_report = now + report_seconds
+    except KeyboardInterrupt:
+        logger.info("Stopping watch.")
+    finally:
+        file_watcher.close()
+        writer.flush()
+    report_run(conn, logger, current_run_id, partner_info, writer.sink)
+
+def stop_watching(signum, frame):
+    """Signal handler that stops watch mode the same way Ctrl-C does."""
+    raise KeyboardInterrupt()
+
+def make_watch_list(conn, logger):
+    """Generate the list of partners whose incoming directories to watch."""
+    partners_to_watch = []
+    for partner in conn.execute("SELECT id, name_full, incoming_file_directory, \
+            tocheck FROM partners"):
+        if partner['tocheck'] == "False":
+            continue
+        if not os.path.isdir(partner['incoming_file_directory']):
+            logger.error("Path %s not found for %s. Not watching.", \
+                partner['incoming_file_directory'], partner['name_full'])
+            continue
+        partners_to_watch.append({'id': partner['id'], \
+            'name_full': partner['name_full'], \
+            'dir': partner['incoming_file_directory']})
+    return partners_to_watch
+
+def load_watch_filesets(conn, partners, logger):
+    """Load and index the fileset and header cache of each watched partner."""
+    for partner in partners:
+        partner['fileset'] = load_previous_fileset(conn, partner['id'], \
+            logger, partner['name_full'])
+        partner['index'] = None
+        if partner['fileset']:
+            partner['index'] = compile_fileset_index(partner['fileset'], logger)
+        partner['header_cache'] = load_header_cache(conn, partner['id'])
+        partner['profiles'] = load_previous_profiles(conn, partner['id'])
+        partner['fingerprints'] = load_fingerprints(conn, partner['id'])
+    prune_parsed_headers(set(row['header'] for partner in partners \
+        if partner['fileset'] for row in partner['fileset']))
+
+def prune_parsed_headers(headers):
+    """Forget the parsed stored headers that aren't in headers, the stored
+    headers of the filesets in use."""
+    for header in set(PARSED_STORED_HEADERS) - headers:
+        del PARSED_STORED_HEADERS[header]
+
+def get_partner_codes(conn, current_run_id):
+    """Return the partner_run_status codes of a run, keyed by partner."""
+    return {row['partner']: row['code'] for row in conn.execute( \
+        "SELECT partner, code FROM partner_run_status WHERE run_id = ?", \
+        (current_run_id,))}
+
+def start_backup(logger):
+    """Start an online backup of the database in a background thread."""
+    logger.info("Backing up database %s to %s", FILESET_DATABASE, \
+        FILESET_DATABASE_BACKUP)
+    def run_backup():
+        try:
+            fileset_db.backup_database(FILESET_DATABASE, FILESET_DATABASE_BACKUP, \
+                BACKUP_GENERATIONS, BACKUP_COMPRESS, BACKUP_PAGES_PER_STEP)
+        except (sqlite3.Error, OSError):
+            logger.error("Unable to back up %s", FILESET_DATABASE, exc_info=True)
+    backup_thread = threading.Thread(target=run_backup, name='backup')
+    backup_thread.start()
+    return backup_thread
+
+def cleanup_database(conn, logger, max_runs=MAX_RUNS_TO_KEEP_IN_DB, \
+        max_days=MAX_DAYS_TO_KEEP_IN_DB):
     """Check three tables:
         current_run_status
         file_run_status
         partner_run_status
 
-        and delete any data from runs older than MAX_RUNS_TO_KEEP_IN_DB """
+        and delete any data from runs outside the retention window: older
+        than the max_runs most recent runs, or more than max_days old.
+        Freed pages are then reclaimed in bounded steps."""
     logger.info("Starting database cleanup process.")
-    logger.info("Maximum number of runs to keep data on: %s", MAX_RUNS_TO_KEEP_IN_DB)
-    # list of tables to clean up and their keys
-    tables_to_clean = { 'current_run_status': 'id',
-                        'file_run_status': 'run_id',
-                        'partner_run_status': 'run_id'}
-    c = conn.cursor()
-    for table, id_key in tables_to_clean.items():
-        get_key_query = 'SELECT DISTINCT {} FROM {}'.format(id_key, table)
-        get_max_key = 'SELECT MAX({}) FROM {}'.format(id_key, table)
-        list_of_keys = c.execute(get_key_query).fetchall()
-        max_key = c.execute(get_max_key).fetchone()['MAX({})'.format(id_key)]
-        logger.debug("Maximum key is {}".format(max_key))
-        #logger.debug(list_of_keys)
-        #logger.debug(max_key)
-        for item in list_of_keys:
-            current_key = item['{}'.format(id_key)]
-            # if the key is under the threshold
-            # (highest key minus the maxium number to keep), delete it
-            if current_key < max_key - MAX_RUNS_TO_KEEP_IN_DB:
-                logger.info("Deleting record(s) with id %s from the %s table " \
-                "as they are under the threshold to keep.", current_key, table)
-                delete_query = 'DELETE FROM {} WHERE {} = {}'.format(table, id_key, current_key)
-                c.execute(delete_query)
+    logger.info("Maximum number of runs to keep data on: %s", max_runs)
+    logger.info("Maximum age in days of runs to keep data on: %s", max_days)
+    first_run_id = fileset_db.first_run_to_keep(conn, max_runs, max_days)
+    if first_run_id is None:
+        logger.info("No runs to clean up.")
+    else:
+        logger.debug("Deleting records for runs with id under %s", first_run_id)
+        deleted = fileset_db.delete_runs_before(conn, first_run_id)
+        for table, row_count in deleted.items():
+            logger.info("Deleted %i record(s) from the %s table as they are " \
+                "under the threshold to keep.", row_count, table)
+    pages = fileset_db.incremental_vacuum(conn, VACUUM_PAGES_PER_STEP, \
+        VACUUM_MAX_STEPS)
+    logger.info("Reclaimed %i free page(s).", pages)
 
 def check_run_id(conn_cursor, conn, logger):
     """Check the previous run's ID and get the current run's ID.
@@ -205,118 +515,86 @@ def read_in_sql_files(sql_file, logger, conn):
         logger.info("Skipping reading in data.")
     commit_tran(conn, logger)
 
-def run_partner_report(conn, logger, current_run_id, partner_info):
-    """Report status of current run."""
-    output_report = ""
+def run_partner_report(partners, logger, current_run_id, partner_info):
+    """Report status of current run. Returns the lines of the report."""
     logger.debug("Current run status")
-    output_report = "\nPartner-level summaries\n-----------------------\n\n"
-    no_new_data = "No new data\n--------------------\n"
-    no_new_data_initial_len = len(no_new_data)
-    dir_not_found = "Directory not found\n--------------------\n"
-    dir_not_found_initial_len = len(dir_not_found)
-    new_files = "New data\n--------------------\n"
-    new_files_initial_len = len(new_files)
-    not_checked = "Not checked\n--------------------\n"
-    not_checked_initial_len = len(not_checked)
-    #logger.debug("Checking for violations.")
-    #generate_violation_report(partner_info, conn, logger, current_run_id)
-
-    #logger.debug(partner_info)
-    report = conn.execute("SELECT * FROM partner_run_status WHERE run_id=?", \
-        (int(current_run_id),))
-    # TODO refactor this for reporting vs. checking what the status is
-    for row in report:
-        #logger.debug(row)
-        partner_name = partner_info[row['partner']]['name_full']
-        partner_directory = partner_info[row['partner']]['incoming_file_directory']
-        if row['code'] == 1:
+    # partner_run_status codes and the heading partners with each are under
+    sections = [(1, "No new data"), (2, "Directory not found"), \
+        (3, "New data"), (4, "Not checked")]
+    names = {code: [] for code, heading in sections}
+    for partner in partners:
+        partner_name = partner.name_full
+        if partner.code == 1:
             logger.info("Partner %s has no new data in the current run %s ",\
                             partner_name, current_run_id)
-            no_new_data += partner_name + "\n"
-
-        if row['code'] == 2:
+        elif partner.code == 2:
             logger.info("Partner %s directory %s not found in the current run %s",\
-                partner_name, partner_directory, current_run_id)
-            dir_not_found += partner_name + "\n"
-
-        if row['code'] == 3:
+                partner_name, partner_info[partner.partner]['incoming_file_directory'], \
+                current_run_id)
+        elif partner.code == 3:
             logger.info("Partner %s has new files in the current run %s", \
                 partner_name, current_run_id)
-            new_files += partner_name + "\n"
-
-        if row['code'] == 4:
+        elif partner.code == 4:
             logger.info("Partner %s is set to not be checked %s", \
                 partner_name, current_run_id)
-            not_checked += partner_name + "\n"
-
-    if len(no_new_data) > no_new_data_initial_len:
-        output_report += no_new_data + "\n"
-
-    if len(dir_not_found) > dir_not_found_initial_len:
-        output_report += dir_not_found + "\n"
-
-    if len(new_files) > new_files_initial_len:
-        output_report += new_files + "\n"
-
-    if len(not_checked) > not_checked_initial_len:
-        output_report += not_checked + "\n"
-
-    return output_report
-
-def generate_exception_report(conn, logger, current_run_id, partner_info):
-    """Generate exception report."""
+        if partner.code in names:
+            names[partner.code].append(partner_name + "\n")
+    lines = ["\nPartner-level summaries\n-----------------------\n\n"]
+    for code, heading in sections:
+        if names[code]:
+            lines.append(heading + "\n--------------------\n")
+            lines += names[code]
+            lines.append("\n")
+    return lines
+
+def generate_exception_report(partners, logger):
+    """Generate exception report. Returns the lines of the report."""
     logger.info("Starting exception report.")
-    report = "OneFlorida Data Trust partner file check for " \
-            + str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    report += "\n\n :: Exceptions ::\n--------------------\n"
-    # this is hacky
-    # we want to see if anything changed but ignore newlines
-    # better way would be with a flag
-    initial_report_len = len(report.replace("\n", ""))
-    report += run_file_report(conn, logger, current_run_id, partner_info, detailed=False)
-    logger.debug("len report: %s %s ", len(report), initial_report_len)
-    if len(report.replace("\n", "")) == initial_report_len:
-        report += "None noted.\n\n"
-    return report + "\n"
-
-def run_file_report(conn, logger, current_run_id, partner_info, detailed=True):
-    """Report on the status of the individual files for a partner."""
-    report = ""
-    if detailed:
-        report = "\n\nDetailed report\n--------------------\n\n"
-    # first get list of partners we need to report on
-    partner_list = conn.execute("SELECT partner FROM partner_run_status \
-        WHERE code = 3 AND run_id = ?", (str(current_run_id),))
-    # next, get the file error codes
-    for partner in partner_list:
-        # get the partner name\
-        partner_code = partner['partner']
-        partner_name = conn.execute("SELECT name_full from partners \
-            WHERE id = ?", (partner['partner'],)).fetchone()
-        file_list = conn.execute("SELECT code, partner, run_id, \
-            filename_pattern, cols_add, cols_del FROM file_run_status WHERE \
-            run_id = ? AND partner = ?", (int(current_run_id), partner_code))
-        do_once = True
-        for item in file_list:
-            # if we're doing a basic report, skip reporting on files where nothing changed
-            if item['code'] == 1 and not detailed:
-                continue
-            while do_once:
-                report += "\n" + partner_name['name_full'] +"\n"
-                report += "-----------------------\n"
-                do_once = False
-            logger.debug("Partner %s %s ", partner_code, partner_name)
+    lines = ["OneFlorida Data Trust partner file check for " \
+        + str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")), \
+        "\n\n :: Exceptions ::\n--------------------\n"]
+    exceptions = run_file_report(partners, logger, detailed=False)
+    if not exceptions:
+        exceptions = ["None noted.\n\n"]
+    return lines + exceptions + ["\n"]
+
+def run_file_report(partners, logger, detailed=True):
+    """Report on the status of the individual files of the partners with
+    new files. A basic report only lists the files that need attention, and
+    is empty if none do. Returns the lines of the report."""
+    lines = []
+    for partner in partners:
+        if partner.code != report_model.NEW_FILES:
+            continue
+        # if we're doing a basic report, skip reporting on files where nothing changed
+        items = partner.files if detailed else partner.exceptions()
+        if items:
+            lines += ["\n", partner.name_full, "\n", "-----------------------\n"]
+        for item in items:
+            logger.debug("Partner %s %s ", partner.partner, partner.name_full)
             logger.debug(item)
-            report += get_file_status(logger, item['code'], item)
-        do_once = True
-        while do_once and detailed:
-            report += "\n"
-            do_once = False
-        else:
-            report +="\n"
+            file_status = get_file_status(logger, item['code'], item)
+            if item['cached']:
+                # flag results for files that weren't read again this run
+                file_status = file_status.rstrip("\n") + " (cached)\n"
+            lines.append(file_status)
+            if item['rows'] is not None:
+                lines.append(get_row_status(item))
+            if item['drift']:
+                lines.append("    Column contents changed since the last " \
+                    "delivery: {}. Check before processing.\n".format(item['drift']))
+            if item['duplicate_of']:
+                lines.append("    Same contents as {}. This may be a resend of " \
+                    "an earlier delivery.\n".format(item['duplicate_of']))
+        if detailed:
+            lines.append("\n\n")
+        elif items:
+            lines.append("\n")
     if detailed:
-        report += "\nThis report generated by version {} of data_inbox.\n".format(VERSION_NUMBER)
-    return report
+        lines.insert(0, "\n\nDetailed report\n--------------------\n\n")
+        lines.append("\nThis report generated by version {} of data_inbox.\n" \
+            .format(VERSION_NUMBER))
+    return lines
 
 def get_file_status(logger, code, item):
     """Helper function to return text describing what happened to a file."""
@@ -352,6 +630,23 @@ def get_file_status(logger, code, item):
     elif code == 7:
         return "No previous fileset stored for partner. " \
         "Header(s) have not been checked.\n"
+    elif code == 8:
+        return "{} has the same columns in a different order. Moved column(s) " \
+        "{}. Check before processing.\n".format(item['filename_pattern'], \
+        item['cols_moved'])
+    elif code == 9:
+        return "{} has no end of line in its first {} bytes. The header is " \
+        "too long or missing. Check before processing.\n" \
+        .format(item['filename_pattern'], MAX_HEADER_BYTES)
+
+def get_row_status(item):
+    """Helper function to return text describing the rows read from a file."""
+    if not item['bad_rows']:
+        return "    {} rows, all with as many fields as the header.\n" \
+            .format(item['rows'])
+    return "    {} rows, {} with a different number of fields than the header," \
+        " starting at byte offset(s) {}. Check before processing.\n" \
+        .format(item['rows'], item['bad_rows'], item['bad_offsets'])
 
 def setup_tables(conn, logger):
     """Make the empty tables. Only run once at initial setup."""
@@ -366,51 +661,75 @@ def setup_tables(conn, logger):
         logger.info("Skipping table creation.")
     commit_tran(conn, logger)
 
-def check_partner_dirs(partner_info, conn, logger, current_run_id):
-    """Iterate over partners and check to see if there are files."""
+def run_partner_tasks(task, partners, workers):
+    """Run task against each partner, yielding (partner, result) pairs.
+
+    With more than one worker the tasks run in a thread pool and are yielded
+    as they finish, so a slow partner directory doesn't hold up the others.
+    Tasks must not touch the database: the caller's thread stays the only
+    one writing through the sqlite3 connection."""
+    if workers <= 1:
+        for partner in partners:
+            yield partner, task(partner)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(task, partner): partner for partner in partners}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def check_partner_dirs(partner_info, conn, logger, current_run_id, writer, \
+        workers=1):
+    """Iterate over partners and check to see if there are files.
+
+    Returns the directory inventories of partners with files, keyed by
+    partner id, so the file checks can carry on from the same listing."""
     # get list of partners and locations of files
     partner_list_query = ("SELECT id, name, name_full, incoming_file_directory,\
         tocheck FROM partners")
-    partner_list = conn.execute(partner_list_query)
-    for partner in partner_list:
-        if partner['tocheck'] == "False":
-            logger.info("%s is set to be not checked.", partner['name_full'])
-            error_code = 4
-            conn.execute('INSERT INTO partner_run_status \
-                (code, partner, run_id) VALUES (?, ?, ?)', \
-                (error_code, partner['id'], current_run_id))
-            continue
-        error_code = None
-        logger.info("Now checking %s", partner['name_full'])
-        if not os.path.isdir(partner['incoming_file_directory']):
-            logger.error("Path %s not found for %s", \
-                partner['incoming_file_directory'], partner['name_full'])
-            error_code = 2  # directory missing
-        elif not os.listdir(partner['incoming_file_directory']):
-            logger.info("Path %s empty found for %s", \
-                partner['incoming_file_directory'], partner['name_full'])
-            error_code = 1  # no files, therefore no new files
-        else:
-            # verify that at least one actual file is in the directory
-            all_dirs = True
-            for item in os.listdir(partner['incoming_file_directory']):
-                logger.debug("Now checking %s", item)
-                if os.path.isfile(os.path.join(partner['incoming_file_directory'], item)):
-                    all_dirs = False
-            if all_dirs:
-                error_code = 1
-                logger.debug("all dirs for %s", partner)
-            else:
-                error_code = 3
-                logger.debug("not all dirs for %s", partner)
-
+    partner_list = conn.execute(partner_list_query).fetchall()
+    inventories = {}
+    task = functools.partial(scan_partner_dir, logger=logger)
+    for partner, (error_code, inventory) in run_partner_tasks(task, \
+            partner_list, workers):
         if error_code:
-            conn.execute('INSERT INTO partner_run_status \
-                (code, partner, run_id) VALUES (?, ?, ?)', \
-                (error_code, partner['id'], current_run_id))
+            writer.add_partner_status(error_code, partner['id'], current_run_id)
+        if error_code == 3:
+            inventories[partner['id']] = inventory
+        elif inventory:
+            inventory.close()
+    return inventories
+
+def scan_partner_dir(partner, logger):
+    """Check a partner's incoming directory. Returns the partner status code,
+    and the directory inventory if the directory could be listed."""
+    if partner['tocheck'] == "False":
+        logger.info("%s is set to be not checked.", partner['name_full'])
+        return 4, None
+    logger.info("Now checking %s", partner['name_full'])
+    try:
+        inventory = DirectoryInventory(partner['incoming_file_directory'])
+    except (FileNotFoundError, NotADirectoryError):
+        logger.error("Path %s not found for %s", \
+            partner['incoming_file_directory'], partner['name_full'])
+        return 2, None  # directory missing
+    # verify that at least one actual file is in the directory
+    first_file = inventory.first_file()
+    if first_file:
+        error_code = 3
+        logger.debug("%s has files, starting with %s", partner, first_file.name)
+    elif not inventory.entries_read():
+        logger.info("Path %s empty found for %s", \
+            partner['incoming_file_directory'], partner['name_full'])
+        error_code = 1  # no files, therefore no new files
+    else:
+        error_code = 1
+        logger.debug("all dirs for %s", partner)
+    return error_code, inventory
 
-def make_partners_to_check_list(partner_info, conn, logger, current_run_id):
+def make_partners_to_check_list(partner_info, conn, logger, current_run_id, \
+        inventories=None):
     """Generate list of partners to check"""
+    inventories = inventories or {}
     partners_to_check = []
     report = conn.execute("SELECT * FROM partner_run_status WHERE run_id=?", (int(current_run_id),))
     for row in report:
@@ -425,7 +744,8 @@ def make_partners_to_check_list(partner_info, conn, logger, current_run_id):
         if row['code'] == 3:
             logger.info("Adding partner %s to the list to check", partner_name)
             partners_to_check.append({'id':partner_id, \
-                'name_full':partner_name, 'dir':partner_directory})
+                'name_full':partner_name, 'dir':partner_directory, \
+                'inventory': inventories.get(partner_id)})
     return partners_to_check
 
 #def generate_violation_report(partner_info, conn, logger, current_run_id):
@@ -441,143 +761,674 @@ def make_partners_to_check_list(partner_info, conn, logger, current_run_id):
     # for row in report:
     #     print(row)
 
-def check_partner_files(partner_info, conn, logger, current_run_id):
-    """Iterate over files for each partner to check their headers."""
+def check_partner_files(partner_info, conn, logger, current_run_id, writer, \
+        workers=1, inventories=None, full_read=None):
+    """Iterate over files for each partner to check their headers. Directory
+    inventories from check_partner_dirs are reused rather than listing the
+    directories again. With full_read, whole files are read too."""
     logger.debug("Checking partner files")
-    partners_to_check = make_partners_to_check_list(partner_info, conn, logger, current_run_id)
-    # now check the list
+    partners_to_check = make_partners_to_check_list(partner_info, conn, \
+        logger, current_run_id, inventories)
+    # load the previous fileset info and cached headers up front, so the
+    # checks don't need the db
     for partner in partners_to_check:
-        name_full = partner['name_full']
-        pid = partner['id']
-        directory = partner['dir']
-        logger.info("Now checking %s ", name_full)
-        # load the previous fileset info
-        #partner_fileset = load_previous_fileset(conn, pid, logger, name_full)
-        new_fileset = os.listdir(directory)
-        for new_file in new_fileset:
-            partner_fileset = load_previous_fileset(conn, pid, logger, name_full)
+        partner['fileset'] = load_previous_fileset(conn, partner['id'], \
+            logger, partner['name_full'])
+        partner['header_cache'] = load_header_cache(conn, partner['id'])
+        partner['profiles'] = load_previous_profiles(conn, partner['id'])
+        partner['fingerprints'] = load_fingerprints(conn, partner['id'])
+    task = functools.partial(check_partner, logger=logger, full_read=full_read, \
+        run_id=current_run_id)
+    for partner, results in run_partner_tasks(task, partners_to_check, workers):
+        seen_paths = set()
+        for result in results:
+            record_file_status(result, partner['id'], current_run_id, \
+                writer, logger)
+            if result['cache']:
+                seen_paths.add(result['cache']['path'])
+                writer.add_header_cache(result['cache'])
+        # forget files that are no longer in the incoming directory
+        writer.remove_header_cache(set(partner['header_cache']) - seen_paths)
+        if FLUSH_STATUS_PER_PARTNER:
+            writer.flush()
+        elif writer.sink:
+            # stream each partner's results out as soon as it is checked
+            writer.sink.flush()
+
+def check_partner(partner, logger, full_read=None, run_id=None):
+    """Check the headers of a partner's incoming files against its fileset,
+    in run run_id.
+
+    Returns a list of results, one per checked file, for the caller to store."""
+    results = []
+    name_full = partner['name_full']
+    partner_fileset = partner['fileset']
+    directory = partner['dir']
+    logger.info("Now checking %s ", name_full)
+    fileset_index = None
+    if partner_fileset:
+        logger.debug("partner_fileset len: %i", len(partner_fileset))
+        fileset_index = compile_fileset_index(partner_fileset, logger)
+    inventory = partner['inventory'] or DirectoryInventory(directory)
+    try:
+        for entry in inventory:
+            file_results = check_partner_file(partner, entry, fileset_index, \
+                logger, full_read, run_id)
+            if file_results and file_results[0]['fingerprint']:
+                # later files of the run are compared against this one too
+                remember_fingerprint(partner['fingerprints'], \
+                    file_results[0]['fingerprint'])
+            results.extend(file_results)
             if not partner_fileset:
-                try:
-                    conn.execute("INSERT INTO file_run_status (code, partner, \
-                    run_id, filename_pattern, filetype) \
-                    VALUES (?, ?, ?, ?, ?)", (7, pid, current_run_id, \
-                    new_file, "unknown"))
-                    commit_tran(conn, logger)
-                    break
-                except:
-                    logger.info("Unable to store file_run_status.")
-            else:
-                logger.debug("partner_fileset len: %i", len(partner_fileset))
-            #logger.debug(partner_fileset)
-            logger.info("Now checking new file %s", new_file)
-            if os.path.isdir(directory + new_file):
-                logger.info("%s is a directory and will not be checked.", new_file)
-                continue
-            try:
-                file_extension = new_file.split('.')[1].lower()
-            except IndexError:
-                logger.error("Unable to split file extension off file %s", new_file)
-                logger.error("File will not be checked.")
-                continue
-            logger.debug("File extension: %s", file_extension)
-            if file_extension in FILETYPES_TO_SKIP:
-                logger.debug("Not checking %s because it is in the list of " \
-                    "filetypes to skip.", new_file)
+                break
+    finally:
+        inventory.close()
+    return results
+
+def check_partner_file(partner, entry, fileset_index, logger, full_read=None, \
+        run_id=None):
+    """Check one entry of a partner's incoming directory in run run_id.
+    Returns a list of
+    results to store: one for a file, one per member for a zip archive, and
+    none if the entry isn't checked. With full_read, whole files are read
+    too, see read_whole_file, and the file is fingerprinted in a thread while
+    it is checked, see fingerprint_file."""
+    new_file = entry.name
+    if not partner['fileset']:
+        return [file_result(7, new_file)]
+    logger.info("Now checking new file %s", new_file)
+    if entry.is_dir():
+        logger.info("%s is a directory and will not be checked.", new_file)
+        return []
+    if skip_file(new_file, logger):
+        return []
+    fingerprint = None
+    if full_read and full_read['fingerprint']:
+        fingerprint = full_read['hash_pool'].submit(fingerprint_file, entry, \
+            partner['fingerprints'], run_id, logger)
+    results = []
+    for source in header_sources(entry.path, new_file, logger):
+        if source['member'] and skip_file(source['name'], logger):
+            continue
+        results.append(check_file_header(partner, entry, source, \
+            fileset_index, logger, full_read))
+    if fingerprint:
+        fingerprint = fingerprint.result()
+    if fingerprint:
+        # earlier deliveries hashed in full aren't hashed again
+        for earlier, full_hash in fingerprint['hashed']:
+            earlier['full_hash'] = full_hash
+    if fingerprint and results:
+        # the file is stored once, with its first result
+        results[0]['fingerprint'] = fingerprint['row']
+        for result in results:
+            result['duplicate_of'] = fingerprint['duplicate_of']
+    return results
+
+def fingerprint_file(entry, previous, run_id, logger):
+    """Fingerprint the contents of a delivered file and look for an earlier
+    delivery with the same contents in previous, the partner's stored
+    fingerprints keyed by size. A file still in the incoming directory
+    belongs to the run it arrived in, and only deliveries from an earlier
+    run, or from earlier in run_id for a file arriving in it, count as
+    earlier. Large files are only hashed in full when their pre-hash matches
+    an earlier file. Returns the fingerprint row to store, a description of
+    the earlier delivery, and the earlier deliveries hashed in full with
+    their hash, or None if the file couldn't be read."""
+    try:
+        file_stat = entry.stat()
+        same_size = previous.get(file_stat.st_size, [])
+        row = {'run_id': run_id, 'path': entry.path, \
+            'filename_pattern': entry.name, 'size': file_stat.st_size, \
+            'mtime_ns': file_stat.st_mtime_ns, 'quick_hash': None, \
+            'full_hash': None}
+        this_file = (row['path'], row['mtime_ns'])
+        for earlier in same_size:
+            if (earlier['path'], earlier['mtime_ns']) == this_file:
+                # still in the incoming directory since an earlier run
+                row.update(run_id=earlier['run_id'], \
+                    quick_hash=earlier['quick_hash'], full_hash=earlier['full_hash'])
+        if row['quick_hash'] is None:
+            row['quick_hash'] = file_hash.quick_hash(entry.path, row['size'])
+            if not file_hash.is_prehash(row['quick_hash']):
+                row['full_hash'] = row['quick_hash']
+        duplicate_of = None
+        hashed = []
+        for earlier in same_size:
+            if (earlier['path'], earlier['mtime_ns']) == this_file or \
+                    earlier['quick_hash'] != row['quick_hash'] or \
+                    not delivered_before(earlier, row, run_id):
                 continue
-            # find a match
-            # search the fileset to find a matching filename
-            max_score = {'score': 0, 'filename': ""}
-            for row in partner_fileset:
-                # previous filename
-                filename = row['filename_pattern']
-                logger.debug("Current filename from fileset: %s", filename)
-                # current filename check
-                #logger.debug(filename)
-                new_file_trim = new_file.split('.')[0]
-                # ignore case in comparison
-                new_file_trim_upper = new_file_trim.upper()
-                new = new_file_trim_upper.translate({ord(k): None for k in digits})
-                # get rid of numbers in the strings
-                filename_upper = filename.upper()
-                fname = filename_upper.translate({ord(k): None for k in digits})
-                current_score = fuzz.ratio(new, fname)
-                if current_score > max_score['score']:
-                    max_score['score'] = current_score
-                    max_score['filename'] = filename
-                    max_score['header'] = row['header']
-                    logger.debug("new max score found:")
-                    logger.debug(max_score)
-
-                logger.debug("Continuing to attempt to match %s", new_file_trim)
-                #if new == fname or new in fname \
-                #    or fuzz.ratio(new, fname) > MATCH_RATIO or new.find(fname) != -1:
-
-            if max_score['score'] == 0:
-                logger.info("new file: %s has no match", new_file_trim)
-                conn.execute("INSERT INTO file_run_status (code, \
-                    partner, run_id, filename_pattern, filetype) \
-                    VALUES (?, ?, ?, ?, ?)", (5, pid, current_run_id, \
-                    new_file_trim, "unknown"))
-            else:
-                filename = max_score['filename']
-                cols = ""
-                cols_add = ""
-                cols_del = ""
-                logger.info("Match found: %s", filename)
-                status_and_cols = check_header(new_file, directory, max_score['header'], logger)
-                status = status_and_cols[0]
-                if len(status_and_cols) == 2:
-                    if status == 2:
-                        # there is a new column
-                        cols_add = status_and_cols[1]
-                    elif status == 3:
-                        # there is a deleted column
-                        cols_del = status_and_cols[1]
-                elif len(status_and_cols) == 3:
-                    cols_add = status_and_cols[1]
-                    cols_del = status_and_cols[2]
-                get_status(status, pid, current_run_id, new_file, cols, \
-                    cols_add, cols_del, conn, logger)
-
-
-def get_status(status, pid, current_run_id, new_file, cols, cols_add, \
-            cols_del, conn, logger):
-    """Given a status code, insert a row recording the file_run_status and log it."""
-    if status == 1:
-        logger.info("Storing exact match status for %s", new_file)
-        conn.execute("INSERT INTO file_run_status (code, partner, \
-            run_id, filename_pattern, filetype) VALUES (?, ?, ?, ?, ?)", \
-            (1, pid, current_run_id, new_file, "unknown"))
-        return
-    elif status == 2:
-        logger.info("Storing new column status for {}".format(new_file))
-        conn.execute("INSERT INTO file_run_status (code, partner, \
-            run_id, filename_pattern, filetype, cols_add) \
-            VALUES (?, ?, ?, ?, ?, ?)", (2, pid, current_run_id, new_file, \
-            "unknown", str(cols_add)))
-        return
-    elif status == 3:
-        logger.info("Storing deleted column status for {}".format(new_file))
-        conn.execute("INSERT INTO file_run_status (code, partner, \
-            run_id, filename_pattern, filetype, cols_del) \
-            VALUES (?, ?, ?, ?, ?, ?)", (3, pid, current_run_id, \
-            new_file, "unknown", str(cols_del)))
-        return
-    elif status == 4:
-        logger.info("Storing missing header status for {}".format(new_file))
-        conn.execute("INSERT INTO file_run_status (code, partner, \
-            run_id, filename_pattern, filetype) \
-            VALUES (?, ?, ?, ?, ?)", (4, pid, current_run_id, new_file, "unknown"))
-        return
-    elif status == 6:
-        logger.info("Storing missing and added col status status for {}"\
-            .format(new_file))
-        conn.execute("INSERT INTO file_run_status (code, partner, \
-            run_id, filename_pattern, filetype, cols_add, cols_del) \
-            VALUES (?, ?, ?, ?, ?, ?, ?)", (6, pid, current_run_id, new_file,\
-            "unknown", str(cols_add), str(cols_del)))
+            if file_hash.is_prehash(row['quick_hash']):
+                earlier_hash = earlier['full_hash']
+                if earlier_hash is None:
+                    earlier_hash = earlier_full_hash(earlier, logger)
+                    if earlier_hash:
+                        hashed.append((earlier, earlier_hash))
+                # an earlier file that is gone matches on its pre-hash
+                if earlier_hash:
+                    if row['full_hash'] is None:
+                        logger.info("%s may have been delivered before. " \
+                            "Hashing all of it.", entry.name)
+                        row['full_hash'] = file_hash.full_hash(entry.path)
+                    if row['full_hash'] != earlier_hash:
+                        continue
+            duplicate_of = "{} (run {})".format(earlier['filename_pattern'], \
+                earlier['run_id'])
+            logger.info("%s has the same contents as %s", entry.name, duplicate_of)
+            break
+    except OSError:
+        logger.error("Unable to fingerprint %s", entry.name, exc_info=True)
+        return None
+    return {'row': row, 'duplicate_of': duplicate_of, 'hashed': hashed}
+
+def delivered_before(earlier, row, run_id):
+    """Return True if a stored fingerprint was delivered before the file of
+    fingerprint row: in an earlier run, or earlier in run_id if the file
+    arrived in it."""
+    if earlier['run_id'] is None or row['run_id'] is None:
+        return False
+    if earlier['run_id'] < row['run_id']:
+        return True
+    return earlier['run_id'] == row['run_id'] == run_id
+
+def earlier_full_hash(earlier, logger):
+    """Return the full hash of an earlier delivery, if it is still where it
+    was found and unchanged. Otherwise returns None, and its matching
+    pre-hash is taken as a match."""
+    try:
+        file_stat = os.stat(earlier['path'])
+        if (file_stat.st_size, file_stat.st_mtime_ns) == \
+                (earlier['size'], earlier['mtime_ns']):
+            return file_hash.full_hash(earlier['path'])
+    except OSError:
+        pass
+    logger.info("%s is no longer available to compare in full. Comparing " \
+        "its size, start and end only.", earlier['path'])
+    return None
+
+def remember_fingerprint(fingerprints, row):
+    """Add the fingerprint row of a checked file to a partner's fingerprints,
+    replacing any earlier one for the same path, so later files are compared
+    against it."""
+    same_size = fingerprints.setdefault(row['size'], [])
+    same_size[:] = [earlier for earlier in same_size if \
+        earlier['path'] != row['path']]
+    same_size.append(row)
+
+def skip_file(new_file, logger):
+    """Return True if a file shouldn't be checked because of its extension."""
+    try:
+        file_extension = new_file.split('.')[1].lower()
+    except IndexError:
+        # the contents decide whether it can be checked
+        logger.debug("%s has no file extension.", new_file)
+        return False
+    logger.debug("File extension: %s", file_extension)
+    if file_extension in FILETYPES_TO_SKIP:
+        logger.debug("Not checking %s because it is in the list of " \
+            "filetypes to skip.", new_file)
+        return True
+    return False
+
+def header_sources(path, new_file, logger):
+    """Return the files to read headers from for a delivered file: the file
+    itself, or each member of a zip archive, listed from its central
+    directory. What the file is comes from its leading bytes, not its
+    name; binary files that aren't compressed data have no sources. Each
+    source is a dict with the display name, the name to match against the
+    fileset, the compression and the zip member."""
+    try:
+        kind = header_reader.sniff_content(path)
+    except OSError:
+        logger.error("Unable to read %s", new_file, exc_info=True)
+        return []
+    if kind and kind not in header_reader.COMPRESSED_KINDS:
+        logger.info("%s is a %s file, not a data file. It will not be " \
+            "checked.", new_file, kind)
+        return []
+    if kind != 'zip':
+        return [{'display': new_file, 'name': new_file, \
+            'compression': kind, 'member': None}]
+    try:
+        members = header_reader.zip_members(path)
+    except (zipfile.BadZipFile, OSError):
+        logger.error("Unable to read zip archive %s", new_file, exc_info=True)
+        return []
+    if header_reader.OOXML_MARKER in members:
+        logger.info("%s is an Office document, not a data file. It will " \
+            "not be checked.", new_file)
+        return []
+    return [{'display': new_file + '/' + member, \
+        'name': os.path.basename(member), 'compression': kind, \
+        'member': member} for member in members]
+
+def check_file_header(partner, entry, source, fileset_index, logger, \
+        full_read=None):
+    """Match a delivered file, or zip member, against the partner's fileset
+    and check its header, and read all of it with full_read. Returns the
+    result to store."""
+    new_file = source['display']
+    # find a match
+    # search the fileset to find a matching filename
+    new_file_trim = source['name'].split('.')[0]
+    max_score = match_fileset(fileset_index, new_file_trim, logger)
+
+    if max_score['score'] == 0:
+        # a renamed file can still be told by its header
+        max_score = match_by_header(entry, source, fileset_index, \
+            new_file_trim, logger)
+    if max_score is None:
+        logger.info("new file: %s has no match", new_file_trim)
+        return file_result(5, new_file_trim)
+    filename = max_score['filename']
+    cols_add = ""
+    cols_del = ""
+    cols_moved = ""
+    logger.info("Match found: %s", filename)
+    cache_path = entry.path
+    if source['member']:
+        cache_path = entry.path + '/' + source['member']
+    cache_row = check_header_cached(entry, max_score['row'], \
+        partner['header_cache'].get(cache_path), logger, source)
+    cache_row['partner'] = partner['id']
+    header_cols = None
+    if cache_row['header'] is not None:
+        header_cols = find_delim_and_split(cache_row['header'], logger, \
+            cache_row['delim'])[0]
+    match = best_fileset_match(fileset_index, new_file_trim, max_score, \
+        header_cols, logger)
+    if match['row'] is not max_score['row']:
+        logger.info("%s header looks more like %s. Checking against it.", \
+            new_file, match['filename'])
+        status_and_cols, delim = compare_header(new_file, cache_row['header'], \
+            match['row'], logger)
+        cache_row.update(outcome=json.dumps(status_and_cols), delim=delim, \
+            fingerprint=match['row']['fingerprint'])
+    status_and_cols = json.loads(cache_row['outcome'])
+    status = status_and_cols[0]
+    if len(status_and_cols) == 2:
+        if status == 2:
+            # there is a new column
+            cols_add = status_and_cols[1]
+        elif status == 3:
+            # there is a deleted column
+            cols_del = status_and_cols[1]
+        elif status == 8:
+            # columns have moved
+            cols_moved = status_and_cols[1]
+    elif len(status_and_cols) == 3:
+        cols_add = status_and_cols[1]
+        cols_del = status_and_cols[2]
+    fields = {}
+    if full_read and cache_row['header'] is not None:
+        normalized_name = normalize_filename(new_file)
+        fields = read_whole_file(entry.path, source, cache_row, normalized_name, \
+            partner['profiles'].get(normalized_name), full_read, logger)
+    return file_result(status, new_file, cols_add=cols_add, \
+        cols_del=cols_del, cols_moved=cols_moved, \
+        cached=cache_row.pop('from_cache'), cache=cache_row, \
+        match_confidence=round(match['confidence'], 3), **fields)
+
+def match_by_header(entry, source, fileset_index, new_file_trim, logger):
+    """Find the stored fileset row for a file whose name matches no stored
+    pattern, by its header alone. Returns a match like match_fileset's, or
+    None if the header can't be read or isn't at least MIN_HEADER_MATCH
+    similar to a stored header."""
+    header_row, outcome = read_header(entry.path, logger, \
+        source['compression'], source['member'])
+    if header_row is None:
+        return None
+    header_cols = find_delim_and_split(header_row, logger)[0]
+    match = best_fileset_match(fileset_index, new_file_trim, \
+        {'score': 0, 'filename': "", 'row': None}, header_cols, logger)
+    if match is None or header_lsh.jaccard(header_lsh.column_set( \
+            header_cols), match['row']['column_set']) < MIN_HEADER_MATCH:
+        return None
+    logger.info("%s header looks like %s.", source['display'], \
+        match['filename'])
+    return match
+
+def read_whole_file(path, source, cache_row, normalized_name, previous, \
+        full_read, logger):
+    """Read all of a delivered file after its header check, as set in
+    full_read: count its rows and the rows with a different number of fields
+    than its header (full_read['rows']), and profile each column and compare
+    the profile to the previous delivery's, from previous, the last profiles
+    stored for the same normalized file name (full_read['profile']). The row
+    counts and profile of a file unchanged since they were stored are reused,
+    and new counts are added to cache_row. Returns the result fields to
+    set."""
+    fields = {}
+    if full_read['rows'] and cache_row['rows'] is not None:
+        logger.info("%s is unchanged since its rows were counted. Using the " \
+            "cached counts.", source['display'])
+        fields.update(rows=cache_row['rows'], bad_rows=cache_row['bad_rows'], \
+            bad_offsets=json.loads(cache_row['bad_offsets']))
+    elif full_read['rows']:
+        fields.update(deep_check_file(path, source, cache_row['delim'], \
+            full_read['pool'], logger))
+        if fields:
+            cache_row.update(rows=fields['rows'], bad_rows=fields['bad_rows'], \
+                bad_offsets=json.dumps(fields['bad_offsets']))
+    if full_read['profile'] and cache_row['delim']:
+        columns = find_delim_and_split(cache_row['header'], logger, \
+            cache_row['delim'])[0]
+        previous = previous or {}
+        stored = previous.get(cache_row['path'])
+        if stored and (stored['size'], stored['mtime_ns']) == \
+                (cache_row['size'], cache_row['mtime_ns']) and \
+                [column for column, summary in stored['columns']] == columns:
+            # compared with itself, as it would be if profiled again
+            logger.info("%s is unchanged since it was profiled. Using the " \
+                "stored profile.", source['display'])
+            fields['profile'] = stored
+            return fields
+        summaries = profile_file(path, source, len(columns), cache_row['delim'], \
+            full_read['pool'], logger)
+        if summaries:
+            profile = list(zip(columns, summaries))
+            fields['profile'] = {'normalized_name': normalized_name, \
+                'path': cache_row['path'], 'size': cache_row['size'], \
+                'mtime_ns': cache_row['mtime_ns'], 'columns': profile}
+            earlier = previous_profile(previous, cache_row['path'], \
+                source['display'], logger)
+            if earlier:
+                fields['drift'] = column_profile.compare_profiles( \
+                    dict(earlier['columns']), dict(profile))
+    return fields
+
+def previous_profile(previous, path, new_file, logger):
+    """Pick the profile a file's profile is compared with from previous, the
+    latest profiles of files with the same normalized name, keyed by path:
+    the earlier profile of the same file, or of the only other file. Files
+    with several earlier deliveries of the same name aren't compared."""
+    if path in previous:
+        return previous[path]
+    if len(previous) > 1:
+        logger.info("%i earlier files have the same name as %s. Not " \
+            "comparing its profile.", len(previous), new_file)
+        return None
+    for profile in previous.values():
+        return profile
+    return None
+
+def deep_check_file(path, source, delim, pool, logger):
+    """Read a whole delivered file and count its rows, and the rows with a
+    different number of fields than its header. Uncompressed files are
+    split into byte ranges read in pool. Returns the counts, or an empty
+    dict if the file couldn't be read."""
+    logger.info("Now reading all rows of %s", source['display'])
+    if delim:
+        delim = delim.encode(header_reader.HEADER_ENCODING)
+    try:
+        if source['compression']:
+            with header_reader.open_compressed(path, source['compression'], \
+                    source['member']) as stream:
+                rows = deep_check.check_stream(stream, delim)
+        else:
+            rows = deep_check.check_file(path, delim, pool)
+    except header_reader.COMPRESSION_ERRORS:
+        logger.error("Unable to read all rows of %s", source['display'], \
+            exc_info=True)
+        return {}
+    logger.info("%s has %i rows, %i with the wrong number of fields.", \
+        source['display'], rows['rows'], rows['bad_rows'])
+    return rows
+
+def profile_file(path, source, width, delim, pool, logger):
+    """Profile each column of a delivered file. Uncompressed files are
+    split into byte ranges profiled in pool. Returns a summary per column,
+    or None if the file couldn't be read."""
+    logger.info("Now profiling the columns of %s", source['display'])
+    encoding = header_reader.HEADER_ENCODING
+    try:
+        if source['compression']:
+            with header_reader.open_compressed(path, source['compression'], \
+                    source['member']) as stream:
+                return column_profile.profile_stream(stream, width, delim, \
+                    encoding)
+        bounds = deep_check.range_bounds(path, os.path.getsize(path))
+        return column_profile.profile_file(path, bounds, width, delim, \
+            encoding, pool)
+    except header_reader.COMPRESSION_ERRORS:
+        logger.error("Unable to profile %s", source['display'], exc_info=True)
+        return None
+
+def file_result(code, filename_pattern, **fields):
+    """Build the result of checking one file. Fields not passed are empty."""
+    result = {'code': code, 'filename_pattern': filename_pattern, \
+        'cols_add': "", 'cols_del': "", 'cols_moved': "", 'cached': False, \
+        'cache': None, 'rows': None, 'bad_rows': None, 'bad_offsets': None, \
+        'profile': None, 'drift': [], 'fingerprint': None, 'duplicate_of': None, \
+        'match_confidence': None}
+    result.update(fields)
+    return result
+
+def load_previous_profiles(conn, pid):
+    """Load the latest stored column profiles of a partner's files, keyed
+    by normalized file name (see normalize_filename) and then by the path of
+    the file profiled. Each has the file's size and mtime, and its columns as
+    (name, summary) pairs in order."""
+    profile_rows = conn.execute("SELECT normalized_name, path, size, \
+        mtime_ns, column_name, count, nulls, distinct_count, min_value, \
+        max_value, top_values FROM file_profile AS p WHERE partner = ? AND \
+        run_id = (SELECT MAX(run_id) FROM file_profile WHERE partner = \
+        p.partner AND normalized_name = p.normalized_name) \
+        ORDER BY position", (int(pid),))
+    profiles = {}
+    for row in profile_rows:
+        profile = profiles.setdefault(row['normalized_name'], {}).setdefault( \
+            row['path'], {'normalized_name': row['normalized_name'], \
+            'path': row['path'], 'size': row['size'], \
+            'mtime_ns': row['mtime_ns'], 'columns': []})
+        profile['columns'].append((row['column_name'], {'count': row['count'], \
+            'nulls': row['nulls'], 'distinct': row['distinct_count'], \
+            'min': row['min_value'], 'max': row['max_value'], \
+            'top': json.loads(row['top_values'] or '[]')}))
+    return profiles
+
+def load_fingerprints(conn, pid):
+    """Load the stored content fingerprints of a partner's files, keyed by
+    file size, the first thing compared."""
+    fingerprint_rows = conn.execute("SELECT run_id, path, filename_pattern, \
+        size, mtime_ns, quick_hash, full_hash FROM file_fingerprints \
+        WHERE partner = ? ORDER BY run_id", (int(pid),))
+    fingerprints = {}
+    for row in fingerprint_rows:
+        fingerprints.setdefault(row['size'], []).append(row)
+    return fingerprints
+
+def load_header_cache(conn, pid):
+    """Load the cached headers of a partner's incoming files, keyed by path."""
+    cache_rows = conn.execute("SELECT path, size, mtime_ns, inode, header, \
+        delim, fingerprint, outcome, rows, bad_rows, bad_offsets FROM \
+        header_cache WHERE partner = ?", (int(pid),))
+    return {row['path']: row for row in cache_rows}
+
+def check_header_cached(entry, stored, cached, logger, source=None):
+    """Check the header of a directory entry's file, using the cached header
+    when the file's size, mtime and inode show it is unchanged since it was
+    cached. The cached outcome is reused too if the stored header it was
+    checked against is still the same. source (from header_sources) gives
+    the compression and zip member to read. Returns the cache row for the
+    file, with the outcome stored as JSON and from_cache set if the file
+    wasn't read. The row counts of an unchanged file (see read_whole_file)
+    are carried over while its delimiter is the same."""
+    if source is None:
+        source = {'display': entry.name, 'compression': None, 'member': None}
+    new_file = source['display']
+    path = entry.path
+    if source['member']:
+        path = entry.path + '/' + source['member']
+    file_stat = entry.stat()
+    cache_row = {'path': path, 'size': file_stat.st_size, \
+        'mtime_ns': file_stat.st_mtime_ns, 'inode': file_stat.st_ino, \
+        'fingerprint': stored['fingerprint'], 'from_cache': False, \
+        'rows': None, 'bad_rows': None, 'bad_offsets': None}
+    if cached and (cached['size'], cached['mtime_ns'], cached['inode']) == \
+            (cache_row['size'], cache_row['mtime_ns'], cache_row['inode']):
+        logger.info("%s is unchanged since the last run. Using cached header.", new_file)
+        cache_row.update(header=cached['header'], delim=cached['delim'], \
+            from_cache=True, rows=cached['rows'], bad_rows=cached['bad_rows'], \
+            bad_offsets=cached['bad_offsets'])
+        # headers cached before they were stripped are compared again
+        if cached['fingerprint'] == stored['fingerprint'] and \
+                (cached['header'] or '') == (cached['header'] or '').strip():
+            cache_row['outcome'] = cached['outcome']
+            return cache_row
+        header_row = cached['header']
     else:
-        logger.info("something went wrong. status {}".format(status))
+        logger.info("Now checking header for %s", new_file)
+        header_row, outcome = read_header(entry.path, logger, \
+            source['compression'], source['member'])
+        cache_row['header'] = header_row
+        cache_row['delim'] = None
+        if outcome == header_reader.HEADER_TOO_LONG:
+            cache_row['outcome'] = json.dumps([9])
+            return cache_row
+    if header_row is None:
+        cache_row['outcome'] = json.dumps([0, ''])
+        return cache_row
+    status_and_cols, delim = compare_header(new_file, header_row, stored, logger)
+    if delim != cache_row['delim']:
+        # rows were counted with another delimiter
+        cache_row.update(rows=None, bad_rows=None, bad_offsets=None)
+    cache_row['delim'] = delim
+    cache_row['outcome'] = json.dumps(status_and_cols)
+    return cache_row
+
+
+def record_file_status(result, pid, current_run_id, writer, logger):
+    """Given a file check result, buffer a file_run_status row and log it."""
+    code = result['code']
+    new_file = result['filename_pattern']
+    if code not in FILE_STATUS_DESCRIPTIONS:
+        logger.info("something went wrong. status {}".format(code))
+        return
+    logger.info("Storing %s status for %s", FILE_STATUS_DESCRIPTIONS[code], new_file)
+    # column lists are stored as their string representation
+    writer.add_file_status(code, pid, current_run_id, new_file, \
+        cached=int(result['cached']), \
+        cols_add=str(result['cols_add']) if result['cols_add'] else None, \
+        cols_del=str(result['cols_del']) if result['cols_del'] else None, \
+        cols_moved=str(result['cols_moved']) if result['cols_moved'] else None, \
+        rows=result['rows'], bad_rows=result['bad_rows'], \
+        bad_offsets=str(result['bad_offsets']) if result['bad_offsets'] else None, \
+        drift="; ".join(result['drift']) if result['drift'] else None, \
+        duplicate_of=result['duplicate_of'], \
+        match_confidence=result['match_confidence'])
+    if result['fingerprint']:
+        # a file seen by an earlier run keeps that run's id
+        fingerprint = dict(result['fingerprint'], partner=pid)
+        if fingerprint['run_id'] is None:
+            fingerprint['run_id'] = current_run_id
+        writer.add_fingerprint(fingerprint)
+    if result['profile']:
+        for position, (column, summary) in enumerate(result['profile']['columns']):
+            writer.add_file_profile(current_run_id, pid, new_file, \
+                result['profile']['normalized_name'], position, column, summary, \
+                result['profile']['path'], result['profile']['size'], \
+                result['profile']['mtime_ns'])
+
+def normalize_filename(filename):
+    """Uppercase a filename and strip the digits out of it for matching."""
+    return filename.upper().translate(STRIP_DIGITS)
+
+def compile_fileset_index(partner_fileset, logger):
+    """Build a per-run matching index over a partner's stored fileset.
+
+    Each filename pattern is normalized once. Patterns are also keyed by
+    their normalized name so exact matches are a single dict lookup, and
+    by the MinHash signature of their header in an LSH index for header
+    matching. Stored headers are split and fingerprinted once for header
+    checking, and the results are kept for later runs in --watch mode."""
+    patterns = []
+    exact = {}
+    for row in partner_fileset:
+        entry = dict(row)
+        entry['normalized'] = normalize_filename(row['filename_pattern'])
+        entry.update(parse_stored_header(row['header'], logger))
+        patterns.append(entry)
+        # keep the first pattern seen, as the fuzzy scan would
+        exact.setdefault(entry['normalized'], entry)
+    headers = header_lsh.HeaderIndex()
+    for position, entry in enumerate(patterns):
+        headers.add(position, entry['column_set'], entry['signature'])
+    return {'patterns': patterns, 'exact': exact, 'headers': headers}
+
+def parse_stored_header(header, logger):
+    """Return the columns, delimiter, fingerprint, column set and MinHash
+    signature of a stored header, parsing it only the first time it is
+    seen."""
+    parsed = PARSED_STORED_HEADERS.get(header)
+    if parsed is None:
+        columns, delim = find_delim_and_split(header, logger)
+        column_set = header_lsh.column_set(columns)
+        parsed = {'columns': columns, 'delim': delim, \
+            'fingerprint': header_diff.header_fingerprint(columns), \
+            'column_set': column_set, 'signature': header_lsh.signature(column_set)}
+        PARSED_STORED_HEADERS[header] = parsed
+    return parsed
+
+def match_fileset(fileset_index, new_file_trim, logger):
+    """Find the stored fileset row that best matches an incoming filename.
+
+    Tries an exact lookup on the normalized name first and only falls back
+    to fuzzy scoring against every stored pattern when that fails."""
+    new = normalize_filename(new_file_trim)
+    exact_row = fileset_index['exact'].get(new)
+    if new and exact_row:
+        logger.debug("Exact match found for %s: %s", new_file_trim, \
+            exact_row['filename_pattern'])
+        return {'score': 100, 'filename': exact_row['filename_pattern'], \
+            'header': exact_row['header'], 'row': exact_row}
+    max_score = {'score': 0, 'filename': ""}
+    for row in fileset_index['patterns']:
+        current_score = fuzz.ratio(new, row['normalized'])
+        if current_score > max_score['score']:
+            max_score['score'] = current_score
+            max_score['filename'] = row['filename_pattern']
+            max_score['header'] = row['header']
+            max_score['row'] = row
+            logger.debug("new max score found:")
+            logger.debug(max_score)
+    return max_score
+
+def best_fileset_match(fileset_index, new_file_trim, name_match, header_cols, \
+        logger):
+    """Pick the stored fileset row a file most likely is, by a confidence
+    that combines filename and header similarity. Unless the name matched
+    exactly, the stored headers most like the file's header (header_cols,
+    None if it couldn't be read) are found through the LSH index and
+    considered too, so a renamed file can still be paired with its fileset.
+    Returns name_match, or a match like it for a better row, with its
+    confidence from 0 to 1. name_match may have no row, when the name
+    matched nothing; None is returned if no stored header is like the
+    file's either."""
+    if header_cols is None:
+        return dict(name_match, confidence=name_match['score'] / 100.0)
+    column_set = header_lsh.column_set(header_cols)
+    candidates = []
+    if name_match['row'] is not None:
+        candidates.append((name_match['score'], name_match['row']))
+    if name_match['score'] < 100:
+        new = normalize_filename(new_file_trim)
+        for similarity, position in fileset_index['headers'].query(column_set):
+            row = fileset_index['patterns'][position]
+            if row is not name_match['row']:
+                candidates.append((fuzz.ratio(new, row['normalized']), row))
+    best = None
+    for score, row in candidates:
+        confidence = NAME_WEIGHT * score / 100.0 + \
+            HEADER_WEIGHT * header_lsh.jaccard(column_set, row['column_set'])
+        if best is None or confidence > best['confidence']:
+            best = {'score': score, 'filename': row['filename_pattern'], \
+                'header': row['header'], 'row': row, 'confidence': confidence}
+    if best is not None:
+        logger.debug("Best match for %s: %s, confidence %.2f", new_file_trim, \
+            best['filename'], best['confidence'])
+    return best
 
 def load_previous_fileset(conn, pid, logger, name_full):
     """Load previous fileset for a specified (pid) partner."""
@@ -603,63 +1454,197 @@ def load_previous_fileset(conn, pid, logger, name_full):
         #logger.debug(partner_fileset)
     return partner_fileset
 
-def add_new_fileset(conn, logger):
-    """Read files on disk and build a new fileset record for the partner."""
+def add_new_fileset(conn, logger, partners=None, since=None, until=None, \
+        assume_yes=False, workers=1, rescan=False, depth=MAX_BUILD_DEPTH):
+    """Read files on disk and build a new fileset record for the partner.
+    partners limits the build to partners with those names, and since and
+    until to archive directories dated in that range. Only the newest depth
+    directories of each partner are scanned, if given. Unless assume_yes,
+    each directory is confirmed before it is scanned. Headers are read in
+    a pool of workers threads. Directories whose files haven't changed
+    since they were added are skipped unless rescan, see
+    build_partner_fileset."""
     partner_list = get_partner_list(conn, logger)
-    filetype_dict = get_filetype_dict(conn, logger)
+    if partners:
+        wanted = set(name.upper() for name in partners)
+        partner_list = {pid: partner for pid, partner in partner_list.items() \
+            if partner['name'].upper() in wanted}
+        for name in wanted - set(partner['name'].upper() for partner in \
+                partner_list.values()):
+            logger.error("Partner %s not found. Skipping.", name)
+    classifier = build_filetype_classifier(conn, logger)
     logger.debug("Current list of partners")
     logger.debug(partner_list)
-    for partner in partner_list:
-        name = partner_list[partner]['name']
-        directory = partner_list[partner]['stored_file_directory']
-        try:
-            list_of_dirs = os.listdir(directory)
-        except:
-            logger.error("Directory %s not found.", directory, exc_info = True)
+    with ThreadPoolExecutor(workers) as pool:
+        for partner in partner_list:
+            name = partner_list[partner]['name']
+            directory = partner_list[partner]['stored_file_directory']
+            try:
+                list_of_dirs = archive_dirs(directory, since, until, logger)
+                if depth is not None:
+                    list_of_dirs = list_of_dirs[:depth]
+            except OSError:
+                logger.error("Directory %s not found.", directory, exc_info = True)
+                continue
+            if not list_of_dirs:
+                logger.info("No archive directories to scan for %s. Skipping " \
+                    "building fileset.", name)
+                continue
+            logger.info("Now building fileset for %s", name)
+            watermarks = {}
+            stored_dirs = load_resolved_dirs(conn, partner)
+            if rescan:
+                # stored headers are read again rather than taken as resolved
+                stored_dirs = dict.fromkeys(stored_dirs)
+            else:
+                watermarks = load_watermarks(conn, partner)
+            build_partner_fileset(conn, logger, partner, name, directory, \
+                list_of_dirs, classifier, pool, assume_yes, watermarks, \
+                stored_dirs)
+            logger.info("Finished building fileset for %s", name)
+
+def load_watermarks(conn, pid):
+    """Load the fingerprints of the archive directories already added to a
+    partner's fileset, keyed by directory name."""
+    watermark_rows = conn.execute("SELECT directory, fingerprint FROM \
+        fileset_watermarks WHERE pid = ?", (int(pid),))
+    return {row['directory']: row['fingerprint'] for row in watermark_rows}
+
+def load_resolved_dirs(conn, pid):
+    """Load the archive directory the stored header of each of a partner's
+    known filetypes was read from, keyed by filetype. Headers stored before
+    archive directories were recorded have None."""
+    fileset_rows = conn.execute("SELECT filetype, archive_dir FROM \
+        partners_filesets WHERE pid = ? AND filetype != ?", \
+        (int(pid), UNKNOWN_FILETYPE))
+    return {row['filetype']: row['archive_dir'] for row in fileset_rows}
+
+def archive_dirs(directory, since, until, logger):
+    """Return the archive directories of a partner, newest first. With since
+    or until, only directories named with a date (YYYYMMDD) in that range."""
+    list_of_dirs = []
+    for new_dir in sorted(os.listdir(directory), reverse=True):
+        if not os.path.isdir(os.path.join(directory, new_dir)):
+            logger.info("{} is not a directory. Skipping.".format(new_dir))
+            continue
+        if since or until:
+            dated = re.match(r'\d{8}', new_dir)
+            if not dated:
+                logger.info("%s isn't dated. Skipping.", new_dir)
+                continue
+            if (since and dated.group() < since) or (until and dated.group() > until):
+                continue
+        list_of_dirs.append(new_dir)
+    return list_of_dirs
+
+def build_partner_fileset(conn, logger, partner, name, directory, list_of_dirs, \
+        classifier, pool, assume_yes, watermarks, stored_dirs):
+    """Add the headers of the files in a partner's archive directories to
+    its fileset, newest directory first. Each directory is written in one
+    transaction along with its watermark, so an interrupted build carries on
+    from the next directory. Directories with the same fingerprint as their
+    watermark are skipped. The newest header of each filetype wins, so the
+    scan stops once every filetype in stored_dirs (see load_resolved_dirs)
+    has a header from this build or from a directory at least as new as the
+    next one. With no stored filetypes, it stops once FIRST_BUILD_QUIET_DIRS
+    directories in a row have turned up nothing new."""
+    list_of_dirs_count = len(list_of_dirs)
+    # filetypes found, and unknown files by normalized name
+    resolved = set()
+    quiet_dirs = 0
+    for new_dir in list_of_dirs:
+        newer = set(filetype for filetype, archive_dir in stored_dirs.items() \
+            if archive_dir is not None and archive_dir >= new_dir)
+        if stored_dirs and set(stored_dirs) <= resolved | newer:
+            logger.info("Every known filetype for %s has its newest header. " \
+                "Stopping before %s.", name, new_dir)
+            break
+        if not stored_dirs and quiet_dirs >= FIRST_BUILD_QUIET_DIRS:
+            logger.info("No new filetypes for %s in the last %i directories. " \
+                "Stopping before %s.", name, quiet_dirs, new_dir)
+            break
+        dir_path = os.path.join(directory, new_dir)
+        fingerprint = file_hash.directory_fingerprint(dir_path)
+        if watermarks.get(new_dir) == fingerprint:
+            logger.info("%s was already added to the fileset for %s. Skipping.", \
+                new_dir, name)
+            list_of_dirs_count = list_of_dirs_count - 1
             continue
-        if not list_of_dirs:
-            logger.info("File directory empty for %s. Skipping building fileset.", name)
+        if not assume_yes:
+            get_out = input("\nThere are {} remaining directories to scan " \
+                "for {}. The next directory is {}.\nDo you wish to continue scanning this partner? (Y/N). Enter (S) to skip scanning the next directory {}: " \
+                .format(list_of_dirs_count, name, new_dir, new_dir))
+            list_of_dirs_count = list_of_dirs_count - 1
+            if get_out == 'N' or get_out == 'n':
+                break
+            if get_out == "S" or get_out == 's':
+                continue
+        new_paths = [os.path.join(dir_path, new_file) for new_file in \
+            os.listdir(dir_path)]
+        new_paths = [new_path for new_path in new_paths if os.path.isfile(new_path)]
+        task = functools.partial(read_archived_headers, logger=logger)
+        resolved_before = len(resolved)
+        with conn:
+            # headers are read in the pool, and added in order
+            for headers in pool.map(task, new_paths):
+                for source, header, delivered in headers:
+                    logger.info("Now trying to add file %s to fileset.", source['display'])
+                    filetype_id = guess_filetype(partner, source['name'], \
+                        classifier, header, conn, logger, delivered, new_dir)
+                    if filetype_id == UNKNOWN_FILETYPE:
+                        resolved.add(normalize_filename( \
+                            source['name'].split('.')[0]))
+                    else:
+                        resolved.add(filetype_id)
+            conn.execute("INSERT OR REPLACE INTO fileset_watermarks (pid, \
+                directory, fingerprint, files, built_at) VALUES (?, ?, ?, ?, ?)", \
+                (int(partner), new_dir, fingerprint, len(new_paths), \
+                time.strftime('%Y-%m-%d %H:%M:%S')))
+        if len(resolved) == resolved_before:
+            quiet_dirs = quiet_dirs + 1
         else:
-            logger.info("Now building fileset for %s", name)
-            # iterate over newest first
-            list_of_dirs = sorted(list_of_dirs, reverse=True)
-            list_of_dirs_count = len(list_of_dirs)
-            for new_dir in list_of_dirs:
-                #logger.debug(new_dir)
-                #logger.debug(os.path.isdir(os.path.join(directory + new_dir)))
-                if os.path.isdir(os.path.join(directory + new_dir)):
-                    #print("HERE")
-                    get_out = input("\nThere are {} remaining directories to scan " \
-                        "for {}. The next directory is {}.\nDo you wish to continue scanning this partner? (Y/N). Enter (S) to skip scanning the next directory {}: " \
-                        .format(list_of_dirs_count, name, new_dir, new_dir))
-                    list_of_dirs_count = list_of_dirs_count - 1
-                    if get_out == 'N' or get_out == 'n':
-                        break
-                    if get_out == "S" or get_out == 's':
-                        continue
-                    new_dir = directory + new_dir
-                    list_of_files = os.listdir(new_dir)
-                    for new_file in list_of_files:
-                        if os.path.isfile(os.path.join(new_dir, new_file)):
-                            with open(os.path.join(new_dir, new_file), 'r') as f:
-                                try:
-                                    header = f.readline()
-                                except UnicodeDecodeError:
-                                    logger.info("UnicodeDecodeError: Unable to read header of file %s. Probably not a data file.", new_file)
-                                    continue
-                            logger.info("Now trying to add file %s to fileset.", new_file)
-                            guess_filetype(partner, new_file, filetype_dict, header, conn, logger)
-                else:
-                    logger.info("{} is not a directory. Skipping for {}.".format(new_dir, name))
-
-def get_filetype_dict(conn, logger):
-    """Utility function that gets the dict of filetypes."""
-    # TODO replace * in SELECT with column names
-    filetypes = conn.execute("SELECT * FROM filetypes")
-    filetypes_dict = {}
-    for item in filetypes:
-        filetypes_dict[item['filetype_name'].upper()] = item['filetype_id']
-    return filetypes_dict
+            quiet_dirs = 0
+
+def read_archived_headers(new_path, logger):
+    """Read the headers of an archived file, or of each file in it if it is
+    a zip archive. Returns a list of the source (see header_sources), the
+    header and the date the file was delivered, for each readable header."""
+    headers = []
+    for source in header_sources(new_path, os.path.basename(new_path), logger):
+        header, outcome = header_reader.read_header( \
+            new_path, MAX_HEADER_BYTES, \
+            compression=source['compression'], \
+            member=source['member'])
+        if outcome == header_reader.HEADER_NOT_TEXT:
+            logger.info("UnicodeDecodeError: Unable to read header of file %s. Probably not a data file.", source['display'])
+            continue
+        if outcome == header_reader.HEADER_TOO_LONG:
+            logger.info("No end of line found in the first %i bytes of %s. Probably not a data file.", MAX_HEADER_BYTES, source['display'])
+            continue
+        if outcome == header_reader.HEADER_UNREADABLE:
+            logger.info("Unable to decompress %s. Skipping.", source['display'])
+            continue
+        # the header took effect when the file was delivered
+        delivered = time.strftime('%Y-%m-%d %H:%M:%S', \
+            time.localtime(os.path.getmtime(new_path)))
+        headers.append((source, header, delivered))
+    return headers
+
+def build_filetype_classifier(conn, logger):
+    """Index the filetype names, and the filename patterns and headers
+    already stored for any partner, for guess_filetype."""
+    classifier = filetype_classifier.FiletypeClassifier()
+    for item in conn.execute("SELECT filetype_id, filetype_name FROM filetypes \
+            WHERE filetype_id != ?", (UNKNOWN_FILETYPE,)):
+        classifier.add_name(item['filetype_name'], item['filetype_id'])
+    for item in conn.execute("SELECT filetype, filename_pattern, header FROM \
+            partners_filesets WHERE filetype != ?", (UNKNOWN_FILETYPE,)):
+        classifier.add_name(item['filename_pattern'], item['filetype'])
+        classifier.add_header(parse_stored_header(item['header'], \
+            logger)['columns'], item['filetype'])
+    logger.debug("Indexed %i filetype names and %i headers.", \
+        len(classifier.names), len(classifier.headers))
+    return classifier
 
 def get_partner_list(conn, logger):
     """Utility function that gets the list of partners and their attributes"""
@@ -673,42 +1658,41 @@ def get_partner_list(conn, logger):
             'tocheck': partner['tocheck']}
     return partner_dict
 
-def guess_filetype(partner, new_file, filetype_dict, header, conn, logger):
-    """Given an incoming file, guess the filetype."""
-    # TODO restructure this to streamline the matching logic
-    #logger.info(filetype_dict)
+def guess_filetype(partner, new_file, classifier, header, conn, logger, \
+        effective_date=None, archive_dir=None):
+    """Given an incoming file, guess the filetype from its name, or from
+    its header if the name is ambiguous (see FiletypeClassifier). Files
+    that are classified teach the classifier their name and header.
+    Returns the filetype_id."""
     # take the file extension off
     new_file = new_file.split('.')[0]
-    new_file_upper = new_file.upper()
-    file_matched = False
-    # try exact match (case doesn't matter) first
-    if new_file_upper in filetype_dict.keys():
-        logger.info("Exact match found: %s looks like a %s file.", new_file, new_file.upper())
-        filetype_id = filetype_dict[new_file_upper]
-        add_to_filetype_dict(partner, filetype_id, new_file, header, conn, logger)
-        file_matched = True
-    # try to find as a substring or do fuzzy match
-    if not file_matched:
-        for item in filetype_dict.keys():
-            filetype_id = filetype_dict[item]
-            #logger.debug(item)
-            #logger.debug(new_file_upper)
-            #logger.debug(fuzz.ratio(new_file_upper, item))
-            if fuzz.ratio(new_file_upper, item) > MATCH_RATIO or new_file_upper.find(item) != -1:
-                logger.info("Partial match found for %s: looks like a %s file", new_file, item)
-                add_to_filetype_dict(partner, filetype_id, new_file, header, conn, logger)
-                file_matched = True
-                break
-    if not file_matched:
+    columns, delim = find_delim_and_split(header.strip(), logger)
+    filetype_id, found_by = classifier.classify(new_file, columns)
+    if filetype_id is None:
         logger.info("No full match found for %s. Not sure what it is.", new_file)
         logger.info("Adding with full filename.")
-        add_to_filetype_dict(partner, 31, new_file, header, conn, logger)
-
-def add_to_filetype_dict(partner, filetype_id, new_file, header, conn, logger):
-    """Function to add a new file to the filetype dictionary."""
+        filetype_id = UNKNOWN_FILETYPE
+    else:
+        logger.info("Match found by %s: %s looks like filetype %i.", found_by, \
+            new_file, filetype_id)
+        classifier.add_name(new_file, filetype_id)
+        classifier.add_header(columns, filetype_id)
+    add_to_filetype_dict(partner, filetype_id, new_file, header, conn, logger, \
+        effective_date, archive_dir)
+    return filetype_id
+
+def add_to_filetype_dict(partner, filetype_id, new_file, header, conn, logger, \
+        effective_date=None, archive_dir=None):
+    """Function to add a new file to the filetype dictionary. partners_filesets
+    holds the header files are checked against; every version of the header
+    is kept in header_history as well, dated effective_date. A stored header
+    read from a newer archive directory than archive_dir is kept."""
     logger.info("Adding new filetype record for partner %s for " \
         "filetype_id %i", partner, filetype_id)
     date_now = time.strftime('%Y-%m-%d %H:%M:%S')
+    columns, delim = find_delim_and_split(header.strip(), logger)
+    header_history.record_header(conn, partner, filetype_id, new_file, columns, \
+        delim, effective_date or date_now)
     # get existing filetype record
     existing_filetype_row = conn.execute("SELECT * FROM partners_filesets \
         WHERE pid = ? AND filetype = ?", (partner, filetype_id))
@@ -717,14 +1701,20 @@ def add_to_filetype_dict(partner, filetype_id, new_file, header, conn, logger):
         existing_filetype_row = existing_filetype_row.fetchone()
     except:
         logger.debug("No previous record found.")
-    if existing_filetype_row and int(filetype_id) != 31:
+    if existing_filetype_row and int(filetype_id) != UNKNOWN_FILETYPE and \
+            archive_dir and existing_filetype_row['archive_dir'] and \
+            archive_dir < existing_filetype_row['archive_dir']:
+        logger.info("Newer filetype record from %s found for partner %s and " \
+            "filetype %i. Keeping it.", existing_filetype_row['archive_dir'], \
+            partner, filetype_id)
+        return None
+    elif existing_filetype_row and int(filetype_id) != UNKNOWN_FILETYPE:
         logger.info("Existing filetype record found for partner %s and " \
             "filetype %i", partner, filetype_id)
         logger.info("Deleting previous filetype records from partners_filesets")
-        delete_tran = conn.execute("DELETE FROM partners_filesets \
+        conn.execute("DELETE FROM partners_filesets \
             WHERE pid = ? AND filetype = ?", (partner, filetype_id))
-        commit_tran(conn, logger)
-    elif existing_filetype_row and int(filetype_id) == 31 and \
+    elif existing_filetype_row and int(filetype_id) == UNKNOWN_FILETYPE and \
             new_file == existing_filetype_row['filename_pattern']:
         logger.info("Matching file of unknown type with same name \
             already added for partner. Skipping.")
@@ -734,82 +1724,82 @@ def add_to_filetype_dict(partner, filetype_id, new_file, header, conn, logger):
             "and filetype %i", partner, filetype_id)
     logger.info("Adding new filetype record.")
     conn.execute("INSERT INTO partners_filesets (pid, date, \
-        filename_pattern, filetype, header) VALUES (?, ?, ?, ?, ?)", \
-        (int(partner), date_now, new_file, filetype_id, header.strip()))
-    commit_tran(conn, logger)
+        filename_pattern, filetype, header, archive_dir) \
+        VALUES (?, ?, ?, ?, ?, ?)", (int(partner), date_now, new_file, \
+        filetype_id, header.strip(), archive_dir))
     #logger.warning("add_to_filetype_dict not yet implemented. NOOP")
 
-def split_on_delim(line, delim):
-    """Given a string and a delimiter, return the string split on the delimter."""
-    return line.split(delim)
-
-def find_delim_and_split(line, logger):
-    """Given a string, try splitting it until you find the correct delimiter"""
-    delims = [',', ';', '\t', '|']
-    for delim in delims:
-        line_split = split_on_delim(line, delim)
-        if len(line_split) != 1:
-            break
-        else:
-            continue
-    if len(line_split) == 1:
+def find_delim_and_split(line, logger, preferred=None):
+    """Given a string, split it on the delimiter that best fits it, in one
+    quote-aware pass. preferred wins if it is as common as any other."""
+    line_split, delim = header_reader.split_header(line, preferred)
+    if delim is None:
         logger.error("Couldn't find correct delimiter to split %s", line)
     return line_split, delim
 
-def check_header(new_file, partner_directory, prev_header, logger):
-    """Check new file header against previous header."""
-    # TODO: make this work on non-exact matching
-    logger.info("Now checking header for %s", new_file)
-    with open(partner_directory + new_file, 'r') as f:
-        try:
-            header_row = f.readline().strip()
-        except UnicodeDecodeError:
-            logger.error("Can't decode file. Not a text file.")
-            return [0, '']
-
-        logger.debug("Header for file %s:\n%s", new_file, header_row.strip())
-        header_cols, delim = find_delim_and_split(header_row, logger)
-        logger.debug("Delimiter for new header: %s", delim)
-        prev_header, new_delim = find_delim_and_split(prev_header, logger)
-        missing_header_cols = []
-        #logger.debug(header_cols)
-        #logger.debug(prev_header)
-        starting_new_header_len = len(header_cols)
-        # iterate over old header, deleting any cols in new header that match
-        for old_col in prev_header:
-            logger.debug("Column header trying to match: %s", old_col)
-            try:
-                header_cols.remove(old_col)
-                logger.debug("Removed old column %s", old_col)
-            except ValueError:
-                logger.info("Old column %s is missing.", old_col)
-                missing_header_cols.append(old_col)
-        logger.debug("After matching columns: %i", len(header_cols))
-        if len(header_cols) == 0 and len(missing_header_cols) == 0:
-            logger.info("%s header exactly matches old header. No change in header.", new_file)
-            return [1]
-        elif len(header_cols) == starting_new_header_len:
-            # if the length hasn't changed, assume header is missing in file
-            logger.info("No columns from new header match old header.")
-            logger.info("Header may have been deleted.")
-            return [4]
-        elif len(header_cols) != starting_new_header_len and \
-            len(missing_header_cols) != 0 and len(header_cols) == 0:
-            # at least some columns matched
-            logger.info("Columns deleted.")
-            #logger.debug("MISSING HEADER %s", missing_header_cols)
-            return [3, missing_header_cols]
-        elif len(header_cols) != 0 and len(missing_header_cols) != 0:
-            # columns added and deleted
-            logger.info("Columns added and deleted")
-            return [6, header_cols, missing_header_cols]
-        else:
-            #TODO: trap here to check for addition
-            logger.info("new header cols: %s starting_new_header_len: %s missing_header_cols: %s", header_cols, starting_new_header_len, missing_header_cols)
-
-            logger.info("%s header does not match old header.", new_file)
-            logger.info("New column(s) found: %s", header_cols)
-            return [2, header_cols]
+def read_header(path, logger, compression=None, member=None):
+    """Read the header row of a file, reading at most MAX_HEADER_BYTES.
+    Compressed files are decompressed only as far as the end of the header.
+    Returns the header, stripped of surrounding whitespace as stored headers
+    are, or None if it couldn't be read, and the outcome."""
+    header_row, outcome = header_reader.read_header(path, MAX_HEADER_BYTES, \
+        compression=compression, member=member)
+    if header_row is not None:
+        header_row = header_row.strip()
+    if outcome == header_reader.HEADER_NOT_TEXT:
+        logger.error("Can't decode file. Not a text file.")
+    elif outcome == header_reader.HEADER_UNREADABLE:
+        logger.error("Can't decompress %s. Corrupt or unsupported " \
+            "compression.", path)
+    elif outcome == header_reader.HEADER_TOO_LONG:
+        logger.error("No end of line found in the first %i bytes of %s. " \
+            "Header too long or missing.", MAX_HEADER_BYTES, path)
+    return header_row, outcome
+
+def compare_header(new_file, header_row, stored, logger):
+    """Compare a header row against the stored fileset row it matched.
+    Returns the status and columns, and the delimiter of the header row."""
+    header_row = header_row.strip()
+    logger.debug("Header for file %s:\n%s", new_file, header_row)
+    header_cols, delim = find_delim_and_split(header_row, logger, \
+        stored['delim'])
+    logger.debug("Delimiter for new header: %s", delim)
+    return compare_columns(new_file, header_cols, stored, logger), delim
+
+def compare_columns(new_file, header_cols, stored, logger):
+    """Compare the columns of a header against the stored fileset row."""
+    diff = header_diff.diff_columns(header_cols, stored['columns'], \
+        stored['fingerprint'])
+    if diff['duplicates']:
+        logger.warning("%s has repeated column(s): %s", new_file, diff['duplicates'])
+    for old_col in diff['deleted']:
+        logger.info("Old column %s is missing.", old_col)
+    added = diff['added']
+    missing_header_cols = diff['deleted']
+    if not added and not missing_header_cols:
+        if diff['moved']:
+            logger.info("%s header has the same columns in a different order.", new_file)
+            logger.info("Moved column(s): %s", diff['moved'])
+            return [8, diff['moved']]
+        logger.info("%s header exactly matches old header. No change in header.", new_file)
+        return [1]
+    elif len(added) == len(header_cols):
+        # if no column matched, assume header is missing in file
+        logger.info("No columns from new header match old header.")
+        logger.info("Header may have been deleted.")
+        return [4]
+    elif not added:
+        # at least some columns matched
+        logger.info("Columns deleted.")
+        return [3, missing_header_cols]
+    elif missing_header_cols:
+        # columns added and deleted
+        logger.info("Columns added and deleted")
+        return [6, added, missing_header_cols]
+    else:
+        logger.info("%s header does not match old header.", new_file)
+        logger.info("New column(s) found: %s", added)
+        return [2, added]
 
 def dict_factory(cursor, row):
     """Helper function to return dictionary."""
@@ -877,8 +1867,7 @@ def write_report(report, logger):
     """
     report_file_name = str(date.today()).replace('-', '') + "_report.txt"
     with open(report_file_name, 'w') as f:
-        for row in report:
-            f.write(row)
+        f.write(report)
     logger.info("Finished writing report out.")
 
 if __name__ == '__main__':
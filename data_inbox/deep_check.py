@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+deep_check reads the whole of a delivered file and checks that every record
+has as many fields as its header, splitting large files into byte ranges
+that are checked in parallel
+"""
+
+import os
+import re
+from collections import Counter
+from itertools import repeat
+
+# size of the byte ranges a large file is split into
+CHUNK_BYTES = 64 * 1024 * 1024
+# size of the blocks each range is read in
+READ_BYTES = 4 * 1024 * 1024
+# number of offending record offsets kept per file
+BAD_OFFSETS_TO_KEEP = 10
+
+# a quoted field, which may hold delimiters, escaped quotes and line feeds
+QUOTED_FIELD = re.compile(b'"[^"]*"')
+
+
+def new_state(in_quotes=False, open_fields=0, record_start=None):
+    """Return the scan state at a record boundary, or inside an open quoted
+    field of a record that started at record_start. Records are tallied by
+    their number of fields, keeping the offsets of the first few of each."""
+    return {'fields': {}, 'in_quotes': in_quotes, 'open_fields': open_fields, \
+        'record_start': record_start}
+
+
+def end_record(state, fields, offset):
+    """Tally a finished record."""
+    tally = state['fields'].get(fields)
+    if tally is None:
+        tally = state['fields'][fields] = [0, []]
+    tally[0] += 1
+    if len(tally[1]) < BAD_OFFSETS_TO_KEEP + 1:
+        tally[1].append(offset)
+
+
+def tally_lines(state, data, plain, offset, delim):
+    """Tally the records in data, where every line is a whole record, given
+    plain, the same data with its quoted fields removed. Delimiters are
+    counted and tallied a block at a time; lines are only located to keep
+    the offsets of the first few records with each number of fields."""
+    lines = plain.split(b'\n')
+    counts = list(map(bytes.count, lines, repeat(delim))) if delim \
+        else [0] * len(lines)
+    blanks = lines.count(b'') + lines.count(b'\r')
+    line_ends = None
+    for count, records in Counter(counts).items():
+        if count == 0:
+            # blank lines aren't records
+            records -= blanks
+            if not records:
+                continue
+        tally = state['fields'].setdefault(count + 1, [0, []])
+        tally[0] += records
+        index = -1
+        while len(tally[1]) < BAD_OFFSETS_TO_KEEP + 1:
+            try:
+                index = counts.index(count, index + 1)
+            except ValueError:
+                break
+            if count == 0 and not lines[index].rstrip(b'\r'):
+                continue
+            if line_ends is None:
+                line_ends = [0]
+                for line in data.split(b'\n'):
+                    line_ends.append(line_ends[-1] + len(line) + 1)
+            tally[1].append(offset + line_ends[index])
+
+
+def scan_lines(state, data, offset, delim):
+    """Tally the records in data, which holds whole lines starting at byte
+    offset in the file. Blocks where no quoted field holds a line feed are
+    tallied whole with tally_lines; otherwise lines are split on quotes one
+    at a time to find the delimiters outside them."""
+    if not state['in_quotes']:
+        plain = QUOTED_FIELD.sub(b'', data) if b'"' in data else data
+        if b'"' not in plain and plain.count(b'\n') == data.count(b'\n'):
+            tally_lines(state, data, plain, offset, delim)
+            return
+    for line in data.split(b'\n'):
+        line_offset = offset
+        offset += len(line) + 1
+        if not state['in_quotes'] and b'"' not in line:
+            if not line.rstrip(b'\r'):
+                # blank lines aren't records
+                continue
+            end_record(state, line.count(delim) + 1 if delim else 1, line_offset)
+            continue
+        if not state['in_quotes']:
+            state['record_start'] = line_offset
+            state['open_fields'] = 1
+        parts = line.split(b'"')
+        for index, part in enumerate(parts):
+            # parts alternate between outside and inside quotes
+            if delim and (index % 2 == 0) != state['in_quotes']:
+                state['open_fields'] += part.count(delim)
+        if len(parts) % 2 == 0:
+            state['in_quotes'] = not state['in_quotes']
+        if not state['in_quotes']:
+            end_record(state, state['open_fields'], state['record_start'])
+
+
+def scan_blocks(blocks, state, offset, delim):
+    """Scan an iterable of consecutive blocks of a file starting at byte
+    offset, carrying partial lines between blocks. Returns the state."""
+    leftover = b''
+    for block in blocks:
+        data = leftover + block
+        cut = data.rfind(b'\n')
+        if cut < 0:
+            leftover = data
+            continue
+        scan_lines(state, data[:cut], offset, delim)
+        offset += cut + 1
+        leftover = data[cut + 1:]
+    if leftover:
+        scan_lines(state, leftover, offset, delim)
+    return state
+
+
+def read_range(path, start, end, block_size=READ_BYTES):
+    """Yield the bytes of path from start up to end in blocks."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = start
+        while offset < end:
+            block = os.pread(fd, min(block_size, end - offset), offset)
+            if not block:
+                break
+            offset += len(block)
+            yield block
+    finally:
+        os.close(fd)
+
+
+def scan_range(path, start, end, delim, state=None):
+    """Scan the records of path between byte offsets start and end. A range
+    is assumed to start at a record boundary unless state says otherwise.
+    Run in worker processes, so it takes and returns plain values."""
+    if state is None:
+        state = new_state()
+    return scan_blocks(read_range(path, start, end), state, start, delim)
+
+
+def range_bounds(path, size, chunk_bytes=CHUNK_BYTES):
+    """Split path into ranges of about chunk_bytes, each ending just after
+    a line feed."""
+    bounds = []
+    start = 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        while start < size:
+            end = start + chunk_bytes
+            if end >= size:
+                bounds.append((start, size))
+                break
+            # move the end forward to the next line feed
+            while True:
+                block = os.pread(fd, READ_BYTES, end)
+                newline = block.find(b'\n')
+                if newline >= 0:
+                    end += newline + 1
+                    break
+                end += len(block)
+                if not block or end >= size:
+                    end = size
+                    break
+            bounds.append((start, end))
+            start = end
+    finally:
+        os.close(fd)
+    return bounds
+
+
+def merge(total, scan):
+    """Add the tallies of a scanned range onto the running total."""
+    for fields, (count, offsets) in scan['fields'].items():
+        tally = total['fields'].setdefault(fields, [0, []])
+        tally[0] += count
+        tally[1].extend(offsets[:BAD_OFFSETS_TO_KEEP + 1 - len(tally[1])])
+    total.update(in_quotes=scan['in_quotes'], open_fields=scan['open_fields'], \
+        record_start=scan['record_start'])
+
+
+def finish(state):
+    """Turn the tallies of a whole file into its results. The first record
+    is the header, and sets the number of fields every other record should
+    have. A record still inside a quoted field at the end of the file is
+    truncated, and counted as bad."""
+    if state['in_quotes']:
+        end_record(state, None, state['record_start'])
+    rows = sum(count for count, offsets in state['fields'].values())
+    if not rows:
+        return {'rows': 0, 'bad_rows': 0, 'bad_offsets': []}
+    header = min(state['fields'], key=lambda fields: state['fields'][fields][1][0])
+    bad_offsets = sorted(offset for fields, (count, offsets) in \
+        state['fields'].items() if fields != header for offset in offsets)
+    return {'rows': rows - 1, 'bad_rows': rows - state['fields'][header][0], \
+        'bad_offsets': bad_offsets[:BAD_OFFSETS_TO_KEEP]}
+
+
+def check_file(path, delim, pool=None, chunk_bytes=CHUNK_BYTES):
+    """Count the records of a file after its header, and the ones whose
+    number of fields differs from the header's, splitting on delim (bytes,
+    or None for a single column). Ranges of a large file are scanned in
+    parallel in pool, each assuming it starts at a record boundary, then
+    stitched together in order; a range that actually starts inside a
+    quoted field is scanned again from the right state. Returns a dict with
+    rows, bad_rows and bad_offsets, the byte offsets of the first few bad
+    records."""
+    bounds = range_bounds(path, os.path.getsize(path), chunk_bytes)
+    if pool is None or len(bounds) < 2:
+        scans = (scan_range(path, start, end, delim) for start, end in bounds)
+    else:
+        scans = [pool.submit(scan_range, path, start, end, delim) \
+            for start, end in bounds]
+        scans = (future.result() for future in scans)
+    total = new_state()
+    for (start, end), scan in zip(bounds, scans):
+        if total['in_quotes']:
+            # the previous range ended inside a quoted field, so this one
+            # didn't start at a record boundary
+            scan = scan_range(path, start, end, delim, new_state(True, \
+                total['open_fields'], total['record_start']))
+        merge(total, scan)
+    return finish(total)
+
+
+def check_stream(stream, delim, block_size=READ_BYTES):
+    """Check the records of a decompressing stream, as check_file does. A
+    stream can't be split, so it is read in a single pass, and offsets are
+    into the decompressed data."""
+    blocks = iter(lambda: stream.read(block_size), b'')
+    return finish(scan_blocks(blocks, new_state(), 0, delim))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+file_hash fingerprints delivered files by their contents, so a file sent
+again under a new name can be recognized
+"""
+
+import hashlib
+import os
+
+# size of the blocks files are hashed in. hashlib releases the GIL while
+# hashing blocks this large, so files can be hashed in parallel threads
+HASH_BLOCK_BYTES = 8 * 1024 * 1024
+# files at least this large get a pre-hash of their size, start and end,
+# and are only hashed in full when that matches another file
+PREHASH_MIN_BYTES = 64 * 1024 * 1024
+# bytes hashed from each end of a file for its pre-hash
+PREHASH_SAMPLE_BYTES = 1024 * 1024
+DIGEST_SIZE = 32
+
+
+def full_hash(path, block_size=HASH_BLOCK_BYTES):
+    """Return the BLAKE2b hex digest of the whole file at path."""
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as data:
+        while True:
+            read = data.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+
+def quick_hash(path, size, sample_bytes=PREHASH_SAMPLE_BYTES, \
+        min_size=PREHASH_MIN_BYTES):
+    """Return a fingerprint of the file at path, which is size bytes long.
+    Files smaller than min_size are hashed in full, so their quick hash is
+    their full hash. Larger files are hashed by their size and first and
+    last sample_bytes only."""
+    if size < min_size:
+        return full_hash(path)
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    digest.update(str(size).encode('ascii'))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        digest.update(os.pread(fd, sample_bytes, 0))
+        digest.update(os.pread(fd, sample_bytes, size - sample_bytes))
+    finally:
+        os.close(fd)
+    return 'pre:' + digest.hexdigest()
+
+
+def is_prehash(fingerprint):
+    """Return True if a quick hash is a pre-hash rather than a full hash."""
+    return fingerprint.startswith('pre:')
+
+
+def directory_fingerprint(path):
+    """Return a fingerprint of the files directly in a directory, from their
+    names, sizes and modification times, without reading them. It changes
+    when a file is added, removed or rewritten."""
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    listing = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) \
+        for entry in os.scandir(path) if entry.is_file())
+    for name, size, mtime_ns in listing:
+        digest.update('{}\x1f{}\x1f{}\n'.format(name, size, mtime_ns).encode('utf-8'))
+    return digest.hexdigest()
@@ -4,13 +4,187 @@
 fileset_db utility functions for maintaining the fileset database
 """
 
+import gzip
 import logging
+import os
+import shutil
+import sqlite3
 
 logger = logging.getLogger(__name__)
 
+# schema migrations, applied in order on top of the tables made by
+# create_empty_tables. each entry is (version, description, sql). the version
+# a database is at is tracked in PRAGMA user_version.
+SCHEMA_MIGRATIONS = [
+    (1, 'Add indexes for the hot query paths', """
+        CREATE INDEX IF NOT EXISTS partners_filesets_pid_filetype
+            ON partners_filesets (pid, filetype);
+        CREATE INDEX IF NOT EXISTS file_run_status_run_id_partner
+            ON file_run_status (run_id, partner);
+        CREATE INDEX IF NOT EXISTS partner_run_status_run_id_code
+            ON partner_run_status (run_id, code);
+        """),
+    (2, 'Record columns that changed position', """
+        ALTER TABLE file_run_status ADD COLUMN cols_moved TEXT;
+        INSERT OR IGNORE INTO file_error_codes (id, error)
+            VALUES (8, 'Column order changed');
+        """),
+    (3, 'Cache headers of incoming files by path and stat', """
+        -- this table stores the header read from each incoming file, keyed
+        -- by its path, along with the stat info it was read with, so the
+        -- file only has to be read again once it changes
+        CREATE TABLE header_cache (
+        path TEXT PRIMARY KEY,
+        partner INTEGER,
+        size INTEGER,
+        mtime_ns INTEGER,
+        inode INTEGER,
+        header TEXT,
+        delim TEXT,
+        fingerprint TEXT,
+        outcome TEXT,
+        FOREIGN KEY (partner) REFERENCES partners(id)
+        );
+        CREATE INDEX header_cache_partner ON header_cache (partner);
+        ALTER TABLE file_run_status ADD COLUMN cached INTEGER;
+        """),
+    (4, 'Add error code for headers without an end of line', """
+        INSERT OR IGNORE INTO file_error_codes (id, error)
+            VALUES (9, 'Header too long or no end of line');
+        """),
+    (5, 'Record the results of reading whole files', """
+        ALTER TABLE file_run_status ADD COLUMN rows INTEGER;
+        ALTER TABLE file_run_status ADD COLUMN bad_rows INTEGER;
+        ALTER TABLE file_run_status ADD COLUMN bad_offsets TEXT;
+        """),
+    (6, 'Store column profiles of files', """
+        -- this table stores a summary of each column of each file checked
+        -- with --profile, to compare against the next delivery
+        CREATE TABLE file_profile (
+        run_id INTEGER,
+        partner INTEGER,
+        filename_pattern TEXT,
+        normalized_name TEXT,
+        position INTEGER,
+        column_name TEXT,
+        count INTEGER,
+        nulls INTEGER,
+        distinct_count INTEGER,
+        min_value TEXT,
+        max_value TEXT,
+        top_values TEXT,
+        FOREIGN KEY (partner) REFERENCES partners(id)
+        );
+        CREATE INDEX file_profile_partner_name_run_id
+            ON file_profile (partner, normalized_name, run_id);
+        CREATE INDEX file_profile_run_id ON file_profile (run_id);
+        ALTER TABLE file_run_status ADD COLUMN drift TEXT;
+        """),
+    (7, 'Store content fingerprints of files', """
+        -- content hashes of delivered files, to recognize resends. Kept
+        -- across run retention, so resends of old deliveries are found too
+        CREATE TABLE file_fingerprints (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_id INTEGER,
+        partner INTEGER,
+        path TEXT,
+        filename_pattern TEXT,
+        size INTEGER,
+        mtime_ns INTEGER,
+        quick_hash TEXT,
+        full_hash TEXT,
+        FOREIGN KEY (partner) REFERENCES partners(id)
+        );
+        CREATE UNIQUE INDEX file_fingerprints_path
+            ON file_fingerprints (path, size, mtime_ns);
+        CREATE INDEX file_fingerprints_partner_size
+            ON file_fingerprints (partner, size, quick_hash);
+        ALTER TABLE file_run_status ADD COLUMN duplicate_of TEXT;
+        """),
+    (8, 'Keep every version of partner headers', """
+        -- every column name seen in a header, stored once
+        CREATE TABLE column_names (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE
+        );
+        -- each distinct header of a partner's file and the dates it was
+        -- first and last delivered. columns holds the column_names ids of
+        -- the header in order, packed as 4-byte little-endian integers
+        CREATE TABLE header_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pid INTEGER,
+        filetype INTEGER,
+        filename_pattern TEXT,
+        delim TEXT,
+        columns BLOB,
+        first_seen DATETIME,
+        last_seen DATETIME,
+        FOREIGN KEY (filetype) REFERENCES filetypes(filetype_id)
+        FOREIGN KEY (pid) REFERENCES partners(id)
+        );
+        CREATE UNIQUE INDEX header_history_version ON header_history
+            (pid, filetype, filename_pattern, delim, columns);
+        -- the dates each column was first and last seen in a partner's
+        -- headers
+        CREATE TABLE column_history (
+        column_id INTEGER,
+        pid INTEGER,
+        first_seen DATETIME,
+        last_seen DATETIME,
+        PRIMARY KEY (column_id, pid)
+        ) WITHOUT ROWID;
+        """),
+    (9, 'Move files of unknown type from HCN_VitalFeed to Unknown', """
+        -- unclassified files were stored as 31, which is HCN_VitalFeed
+        UPDATE partners_filesets SET filetype = 32 WHERE filetype = 31
+            AND UPPER(filename_pattern) NOT LIKE '%VITALFEED%';
+        UPDATE OR IGNORE header_history SET filetype = 32 WHERE filetype = 31
+            AND UPPER(filename_pattern) NOT LIKE '%VITALFEED%';
+        """),
+    (10, 'Record how confidently files were matched to their fileset', """
+        ALTER TABLE file_run_status ADD COLUMN match_confidence REAL;
+        """),
+    (11, 'Record the archive directories filesets were built from', """
+        -- archive directories already added to a partner's fileset, and a
+        -- fingerprint of their files when they were, so a build only scans
+        -- new or changed directories
+        CREATE TABLE fileset_watermarks (
+        pid INTEGER,
+        directory TEXT,
+        fingerprint TEXT,
+        files INTEGER,
+        built_at DATETIME,
+        PRIMARY KEY (pid, directory),
+        FOREIGN KEY (pid) REFERENCES partners(id)
+        ) WITHOUT ROWID;
+        """),
+    (12, 'Record the archive directory of each stored header', """
+        -- the archive directory a stored header was read from, so a build
+        -- only replaces it with a header from the same or a newer directory
+        ALTER TABLE partners_filesets ADD COLUMN archive_dir TEXT;
+        """),
+    (13, 'Cache the row counts of files read with --deep', """
+        -- row counts of a cached file, reused while the file is unchanged
+        ALTER TABLE header_cache ADD COLUMN rows INTEGER;
+        ALTER TABLE header_cache ADD COLUMN bad_rows INTEGER;
+        ALTER TABLE header_cache ADD COLUMN bad_offsets TEXT;
+        """),
+    (14, 'Record the file each column profile was read from', """
+        -- the path, size and mtime of the profiled file, so profiles of
+        -- files with the same normalized name are kept apart, and an
+        -- unchanged file's profile is reused
+        ALTER TABLE file_profile ADD COLUMN path TEXT;
+        ALTER TABLE file_profile ADD COLUMN size INTEGER;
+        ALTER TABLE file_profile ADD COLUMN mtime_ns INTEGER;
+        """),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
 def create_empty_tables(conn):
     """Create the table structure required for the data model."""
     logger.warning('This will initialize the required tables.')
+    # let freed pages be reclaimed in steps, see incremental_vacuum
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
     required_tables = {
         'partners': """
         -- this table stores the partners, their names, and the location
@@ -102,3 +276,200 @@ def create_empty_tables(conn):
     for item in required_tables:
         logger.info("Executing {}".format(item))
         conn.execute(required_tables[item])
+
+JOURNAL_MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+SYNCHRONOUS_LEVELS = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+
+def set_pragmas(conn, journal_mode=None, synchronous=None):
+    """Set the journal mode and synchronous level used for this connection.
+    Either setting is left at the database default when None."""
+    if journal_mode:
+        if journal_mode.upper() not in JOURNAL_MODES:
+            raise ValueError("Unknown journal mode {}".format(journal_mode))
+        logger.info("Setting journal_mode to {}".format(journal_mode))
+        conn.execute("PRAGMA journal_mode = {}".format(journal_mode.upper()))
+    if synchronous:
+        if synchronous.upper() not in SYNCHRONOUS_LEVELS:
+            raise ValueError("Unknown synchronous level {}".format(synchronous))
+        logger.info("Setting synchronous to {}".format(synchronous))
+        conn.execute("PRAGMA synchronous = {}".format(synchronous.upper()))
+
+def query_value(conn, query, params=()):
+    """Return the first column of the first row of a query, or None.
+    Works whatever row_factory the connection has been given."""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    row = cursor.execute(query, params).fetchone()
+    return row[0] if row else None
+
+def get_schema_version(conn):
+    """Return the migration version the database is at."""
+    return query_value(conn, "PRAGMA user_version")
+
+def table_exists(conn, table):
+    """Return True if table exists in the database."""
+    return query_value(conn, "SELECT 1 FROM sqlite_master WHERE type = 'table' \
+        AND name = ?", (table,)) is not None
+
+def upgrade_schema(conn):
+    """Apply any pending migrations to the database in place.
+
+    Each migration runs in its own transaction along with the bump of
+    user_version, so an interrupted upgrade can simply be run again.
+    Returns the version the database is at afterwards."""
+    version = get_schema_version(conn)
+    if not table_exists(conn, 'partners_filesets'):
+        logger.warning("Tables not created yet. Skipping schema upgrade.")
+        return version
+    for migration_version, description, sql in SCHEMA_MIGRATIONS:
+        if migration_version <= version:
+            continue
+        logger.info("Upgrading schema to version {}: {}".format( \
+            migration_version, description))
+        try:
+            conn.executescript("BEGIN;\n{}\nPRAGMA user_version = {};\nCOMMIT;" \
+                .format(sql, migration_version))
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        version = migration_version
+    return version
+
+# run tables cleaned up by retention, and the column holding the run id
+RUN_TABLES = [('file_run_status', 'run_id'),
+              ('file_profile', 'run_id'),
+              ('partner_run_status', 'run_id'),
+              ('current_run_status', 'id')]
+
+def first_run_to_keep(conn, max_runs=None, max_days=None):
+    """Return the lowest run id inside the retention window, or None if
+    nothing needs deleting. A run is kept only if it is one of the max_runs
+    most recent runs and is no more than max_days old."""
+    thresholds = []
+    if max_runs is not None:
+        max_run_id = query_value(conn, "SELECT MAX(id) FROM current_run_status")
+        if max_run_id is not None:
+            thresholds.append(max_run_id - max_runs)
+    if max_days is not None:
+        # run_date is stored as CURRENT_DATE, so compare dates as text
+        oldest_recent_run = query_value(conn, "SELECT MIN(id) FROM \
+            current_run_status WHERE run_date >= date('now', ?)", \
+            ('-{} days'.format(int(max_days)),))
+        if oldest_recent_run is None:
+            oldest_recent_run = query_value(conn, "SELECT MAX(id) + 1 FROM \
+                current_run_status")
+        if oldest_recent_run is not None:
+            thresholds.append(oldest_recent_run)
+    return max(thresholds) if thresholds else None
+
+def delete_runs_before(conn, run_id):
+    """Delete everything recorded for runs with an id below run_id, as one
+    range delete per table in a single transaction. Returns a dict of
+    table name to number of rows deleted."""
+    deleted = {}
+    with conn:
+        for table, id_key in RUN_TABLES:
+            cursor = conn.execute("DELETE FROM {} WHERE {} < ?".format( \
+                table, id_key), (run_id,))
+            deleted[table] = cursor.rowcount
+    return deleted
+
+def enable_incremental_vacuum(conn):
+    """Switch an existing database to incremental auto_vacuum. This needs a
+    full VACUUM, so it is only done once, on request."""
+    if query_value(conn, "PRAGMA auto_vacuum") == 2:
+        return
+    logger.info("Switching database to incremental vacuum. Rebuilding file.")
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+def incremental_vacuum(conn, pages_per_step, max_steps):
+    """Return free pages to the filesystem in bounded steps, stopping when
+    the freelist is empty or after max_steps. Only has an effect when the
+    database uses incremental auto_vacuum. Returns the pages reclaimed."""
+    if query_value(conn, "PRAGMA auto_vacuum") != 2:
+        return 0
+    conn.commit()
+    start_free = query_value(conn, "PRAGMA freelist_count")
+    for _ in range(max_steps):
+        if not query_value(conn, "PRAGMA freelist_count"):
+            break
+        # executescript steps the pragma to completion; execute would only
+        # free a single page
+        conn.executescript("PRAGMA incremental_vacuum({});".format( \
+            int(pages_per_step)))
+    return start_free - query_value(conn, "PRAGMA freelist_count")
+
+def database_change_key(db_path):
+    """Return a value that changes whenever the database at db_path is
+    written to: the file change counter from the SQLite header, the size and
+    mtime of the file, and the size and mtime of any write-ahead log not yet
+    checkpointed into it. In WAL mode the change counter isn't updated, but
+    checkpoints write to the file."""
+    with open(db_path, 'rb') as f:
+        header = f.read(100)
+        db_stat = os.fstat(f.fileno())
+    if len(header) < 100:
+        return None
+    change_counter = int.from_bytes(header[24:28], 'big')
+    change_key = '{} {} {}'.format(change_counter, db_stat.st_size, \
+        db_stat.st_mtime_ns)
+    wal_path = db_path + '-wal'
+    if os.path.exists(wal_path):
+        wal_stat = os.stat(wal_path)
+        change_key += ' {} {}'.format(wal_stat.st_size, wal_stat.st_mtime_ns)
+    return change_key
+
+def rotate_backups(backup_path, generations):
+    """Shift backup_path to backup_path.1 and so on, keeping at most
+    generations files including backup_path itself."""
+    oldest = '{}.{}'.format(backup_path, generations - 1)
+    if generations > 1 and os.path.exists(oldest):
+        os.remove(oldest)
+    for generation in range(generations - 2, 0, -1):
+        older = '{}.{}'.format(backup_path, generation)
+        if os.path.exists(older):
+            os.replace(older, '{}.{}'.format(backup_path, generation + 1))
+    if generations > 1 and os.path.exists(backup_path):
+        os.replace(backup_path, backup_path + '.1')
+
+def backup_database(db_path, backup_path, generations=1, compress=False, \
+        pages_per_step=1024):
+    """Copy the database at db_path to backup_path with the SQLite online
+    backup API, a few pages at a time, so other connections can keep using
+    the database while it runs. The copy is a consistent snapshot.
+
+    Earlier backups are rotated to backup_path.1, .2 and so on, and with
+    compress the generations are gzipped (named with a .gz suffix). The
+    backup is skipped if the database hasn't changed since the last one.
+    Returns True if a backup was made."""
+    if compress:
+        backup_path += '.gz'
+    state_path = backup_path + '.state'
+    change_key = database_change_key(db_path)
+    if change_key is not None and os.path.exists(backup_path) \
+            and os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            if f.read() == change_key:
+                logger.info("Database unchanged since last backup. Skipping.")
+                return False
+    temp_path = backup_path + '.tmp'
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(temp_path)
+    try:
+        source.backup(target, pages=pages_per_step)
+    finally:
+        target.close()
+        source.close()
+    if compress:
+        with open(temp_path, 'rb') as f_in, gzip.open(temp_path + '.gz', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(temp_path)
+        temp_path += '.gz'
+    rotate_backups(backup_path, generations)
+    os.replace(temp_path, backup_path)
+    with open(state_path, 'w') as f:
+        f.write(change_key or '')
+    logger.info("Backed up {} to {}".format(db_path, backup_path))
+    return True
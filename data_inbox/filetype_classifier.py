@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+filetype_classifier guesses the filetype of a delivered file from its name,
+using a character n-gram index over filetype names and known filename
+patterns, and from its header columns when the name is ambiguous
+"""
+
+import re
+from collections import Counter
+
+# length of the character n-grams names are indexed by
+NGRAM = 3
+# share of a known name's n-grams a filename must contain to match it
+NAME_MIN_SCORE = 0.8
+# candidates of other filetypes scoring within this of the best make a
+# filename ambiguous
+AMBIGUOUS_MARGIN = 0.1
+# share of columns a header must have in common with a known header
+HEADER_MIN_SIMILARITY = 0.5
+
+# characters dropped from names before indexing: digits, which are usually
+# dates, and separators
+NOT_LETTERS = re.compile('[^A-Z]')
+
+
+def name_grams(name):
+    """Return the set of character n-grams of a name, ignoring case, digits
+    and separators. A name shorter than an n-gram is a single gram."""
+    letters = NOT_LETTERS.sub('', name.upper())
+    if len(letters) <= NGRAM:
+        return {letters} if letters else set()
+    return {letters[start:start + NGRAM] for start in \
+        range(len(letters) - NGRAM + 1)}
+
+
+def header_columns(columns):
+    """Return the set of column names of a header, ignoring case, quotes and
+    surrounding whitespace."""
+    return frozenset(column.strip().strip('"').strip().upper() for column \
+        in columns)
+
+
+class FiletypeClassifier(object):
+    """Inverted indexes from n-grams to known names, and from column names
+    to known headers, each with the filetype it belongs to. Candidates are
+    found through the indexes, so only names and headers sharing something
+    with a file are scored, and the best scoring one wins."""
+
+    def __init__(self):
+        self.names = []
+        self.name_index = {}
+        self.headers = []
+        self.header_index = {}
+        self.seen = set()
+
+    def add_name(self, name, filetype_id):
+        """Index a filetype name or a filename pattern known to be of
+        filetype_id."""
+        grams = frozenset(name_grams(name))
+        if not grams or ('name', grams, filetype_id) in self.seen:
+            return
+        self.seen.add(('name', grams, filetype_id))
+        for gram in grams:
+            self.name_index.setdefault(gram, []).append(len(self.names))
+        self.names.append((grams, filetype_id))
+
+    def add_header(self, columns, filetype_id):
+        """Index the columns of a header known to be of filetype_id."""
+        columns = header_columns(columns)
+        if not columns or ('header', columns, filetype_id) in self.seen:
+            return
+        self.seen.add(('header', columns, filetype_id))
+        for column in columns:
+            self.header_index.setdefault(column, []).append(len(self.headers))
+        self.headers.append((columns, filetype_id))
+
+    def match_name(self, filename):
+        """Return the best (score, similarity, filetype_id) for each filetype
+        whose known names share an n-gram with filename, best first. score
+        is the share of the known name's n-grams in filename, and similarity
+        the Dice coefficient of the two, which prefers the closest name when
+        several are contained in filename."""
+        grams = name_grams(filename)
+        common = Counter()
+        for gram in grams:
+            common.update(self.name_index.get(gram, ()))
+        best = {}
+        for entry, shared in common.items():
+            known, filetype_id = self.names[entry]
+            match = (shared / float(len(known)), \
+                2.0 * shared / (len(known) + len(grams)), filetype_id)
+            if match > best.get(filetype_id, (0, 0)):
+                best[filetype_id] = match
+        return sorted(best.values(), reverse=True)
+
+    def match_header(self, columns):
+        """Return the (similarity, filetype_id) of the known header most
+        like columns, by Jaccard similarity of their column sets, or None
+        if none share a column."""
+        columns = header_columns(columns)
+        common = Counter()
+        for column in columns:
+            common.update(self.header_index.get(column, ()))
+        best = None
+        for entry, shared in common.items():
+            known, filetype_id = self.headers[entry]
+            match = (shared / float(len(known | columns)), filetype_id)
+            if best is None or match > best:
+                best = match
+        return best
+
+    def classify(self, filename, columns=None):
+        """Return the filetype_id of a file and how it was found, 'name' or
+        'header', or (None, None) if it can't be told. The name decides
+        unless no known name matches well enough, or names of different
+        filetypes match about as well, in which case the header columns
+        decide if they are close enough to a known header."""
+        matches = [match for match in self.match_name(filename) \
+            if match[0] >= NAME_MIN_SCORE]
+        ambiguous = len(matches) > 1 and \
+            matches[0][0] - matches[1][0] <= AMBIGUOUS_MARGIN and \
+            matches[0][1] - matches[1][1] <= AMBIGUOUS_MARGIN
+        if (ambiguous or not matches) and columns:
+            header_match = self.match_header(columns)
+            if header_match and header_match[0] >= HEADER_MIN_SIMILARITY:
+                return header_match[1], 'header'
+        if matches:
+            # an ambiguous name the header didn't settle goes to the best name
+            return matches[0][2], 'name'
+        return None, None
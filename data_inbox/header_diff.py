@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+header_diff compares the columns of a new file header against a stored header
+"""
+
+import hashlib
+from bisect import bisect_left
+from collections import Counter
+
+# separator used when hashing column lists, unlikely to appear in a header
+FINGERPRINT_SEPARATOR = '\x1f'
+
+
+def header_fingerprint(columns):
+    """Return a hash fingerprint of an ordered list of column names."""
+    joined = FINGERPRINT_SEPARATOR.join(columns)
+    return hashlib.blake2b(joined.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def longest_increasing_run(positions):
+    """Return the indexes into positions of a longest strictly increasing
+    subsequence, using patience sorting."""
+    tails = []
+    tail_indexes = []
+    previous = [None] * len(positions)
+    for index, position in enumerate(positions):
+        slot = bisect_left(tails, position)
+        if slot > 0:
+            previous[index] = tail_indexes[slot - 1]
+        if slot == len(tails):
+            tails.append(position)
+            tail_indexes.append(index)
+        else:
+            tails[slot] = position
+            tail_indexes[slot] = index
+    keep = set()
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        keep.add(index)
+        index = previous[index]
+    return keep
+
+
+def find_moved_columns(new_cols, old_cols):
+    """Return the columns present in both headers whose position relative to
+    the other shared columns has changed. Repeated names are paired up in
+    the order they appear."""
+    old_positions = {}
+    for position, col in enumerate(old_cols):
+        old_positions.setdefault(col, []).append(position)
+    seen = Counter()
+    shared = []
+    for col in new_cols:
+        positions = old_positions.get(col)
+        if positions and seen[col] < len(positions):
+            shared.append((col, positions[seen[col]]))
+            seen[col] += 1
+    in_order = longest_increasing_run([position for col, position in shared])
+    return [col for index, (col, position) in enumerate(shared)
+            if index not in in_order]
+
+
+def diff_columns(new_cols, old_cols, old_fingerprint=None):
+    """Compare a new list of columns against the stored columns.
+
+    If old_fingerprint (from header_fingerprint) is given and matches the new
+    columns, the headers are the same and no further work is done. Otherwise
+    returns a dict with the columns that were added and deleted (counting
+    repeated names), the columns repeated in the new header, and the shared
+    columns that moved position."""
+    if old_fingerprint is None:
+        old_fingerprint = header_fingerprint(old_cols)
+    if header_fingerprint(new_cols) == old_fingerprint:
+        return {'unchanged': True, 'added': [], 'deleted': [],
+                'duplicates': [], 'moved': []}
+    new_counts = Counter(new_cols)
+    old_counts = Counter(old_cols)
+    added_counts = new_counts - old_counts
+    deleted_counts = old_counts - new_counts
+    # keep the columns in the order they appear in their header
+    added = []
+    for col in new_cols:
+        if added_counts[col]:
+            added.append(col)
+            added_counts[col] -= 1
+    deleted = []
+    for col in old_cols:
+        if deleted_counts[col]:
+            deleted.append(col)
+            deleted_counts[col] -= 1
+    duplicates = [col for col, count in new_counts.items() if count > 1]
+    moved = find_moved_columns(new_cols, old_cols)
+    return {'unchanged': not (added or deleted or moved), 'added': added,
+            'deleted': deleted, 'duplicates': duplicates, 'moved': moved}
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+header_history keeps every version of a partner's file headers, with column
+names stored once in a dictionary table and each header stored as a packed
+array of column ids
+"""
+
+import struct
+
+# column ids are packed as unsigned 4-byte little-endian integers
+COLUMN_ID_FORMAT = '<{}I'
+COLUMN_ID_BYTES = struct.calcsize('<I')
+# column names looked up per query, below SQLite's host parameter limit
+NAMES_PER_QUERY = 500
+
+
+def pack_columns(column_ids):
+    """Pack an ordered list of column ids into bytes."""
+    return struct.pack(COLUMN_ID_FORMAT.format(len(column_ids)), *column_ids)
+
+
+def unpack_columns(packed):
+    """Return the ordered list of column ids packed into bytes."""
+    return list(struct.unpack(COLUMN_ID_FORMAT.format( \
+        len(packed) // COLUMN_ID_BYTES), packed))
+
+
+def intern_columns(conn, columns):
+    """Return the ids of column names, in order, adding names not seen
+    before to column_names."""
+    names = list(set(columns))
+    conn.executemany("INSERT OR IGNORE INTO column_names (name) VALUES (?)", \
+        [(name,) for name in names])
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    ids = {}
+    for start in range(0, len(names), NAMES_PER_QUERY):
+        chunk = names[start:start + NAMES_PER_QUERY]
+        ids.update((name, column_id) for column_id, name in cursor.execute( \
+            "SELECT id, name FROM column_names WHERE name IN ({})".format( \
+            ", ".join("?" * len(chunk))), chunk))
+    return [ids[name] for name in columns]
+
+
+def record_header(conn, pid, filetype, filename_pattern, columns, delim, \
+        effective_date):
+    """Record a header delivered on effective_date. A header seen before for
+    the same file keeps its version, and the dates it was first and last
+    seen are widened, so deliveries can be recorded in any order. The same
+    is done for each of its columns."""
+    column_ids = intern_columns(conn, columns)
+    conn.execute("INSERT INTO header_history (pid, filetype, \
+        filename_pattern, delim, columns, first_seen, last_seen) \
+        VALUES (?, ?, ?, ?, ?, ?, ?) \
+        ON CONFLICT (pid, filetype, filename_pattern, delim, columns) DO UPDATE \
+        SET first_seen = MIN(first_seen, excluded.first_seen), \
+        last_seen = MAX(last_seen, excluded.last_seen)", (int(pid), filetype, \
+        filename_pattern, delim or '', pack_columns(column_ids), \
+        effective_date, effective_date))
+    conn.executemany("INSERT INTO column_history (column_id, pid, first_seen, \
+        last_seen) VALUES (?, ?, ?, ?) \
+        ON CONFLICT (column_id, pid) DO UPDATE \
+        SET first_seen = MIN(first_seen, excluded.first_seen), \
+        last_seen = MAX(last_seen, excluded.last_seen)", \
+        [(column_id, int(pid), effective_date, effective_date) \
+        for column_id in set(column_ids)])
+
+
+def header_versions(conn, pid, filetype):
+    """Return the header versions of a partner's filetype, oldest first, as
+    dicts with the column names decoded."""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    versions = cursor.execute("SELECT filename_pattern, delim, columns, \
+        first_seen, last_seen FROM header_history WHERE pid = ? AND \
+        filetype = ? ORDER BY first_seen, id", (int(pid), filetype)).fetchall()
+    column_ids = set()
+    for version in versions:
+        column_ids.update(unpack_columns(version[2]))
+    names = column_names(conn, column_ids)
+    return [{'filename_pattern': filename_pattern, 'delim': delim or None, \
+        'columns': [names[column_id] for column_id in unpack_columns(packed)], \
+        'first_seen': first_seen, 'last_seen': last_seen} \
+        for filename_pattern, delim, packed, first_seen, last_seen in versions]
+
+
+def column_names(conn, column_ids):
+    """Return the names of column ids, keyed by id."""
+    column_ids = list(column_ids)
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    names = {}
+    for start in range(0, len(column_ids), NAMES_PER_QUERY):
+        chunk = column_ids[start:start + NAMES_PER_QUERY]
+        names.update(cursor.execute("SELECT id, name FROM column_names WHERE \
+            id IN ({})".format(", ".join("?" * len(chunk))), chunk))
+    return names
+
+
+def column_span(conn, pid, column):
+    """Return the dates a column name was first and last seen in any of a
+    partner's headers, or None if it never was."""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor.execute("SELECT h.first_seen, h.last_seen FROM \
+        column_names AS c JOIN column_history AS h ON h.column_id = c.id \
+        WHERE c.name = ? AND h.pid = ?", (column, int(pid))).fetchone()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+header_lsh finds the stored headers most like a new header, using MinHash
+signatures of their column sets and a locality-sensitive hashing index, so
+a lookup only compares the new header with likely matches
+"""
+
+import hashlib
+import random
+
+# hashes in a MinHash signature
+NUM_HASHES = 64
+# signatures are split into bands; headers sharing any whole band are
+# candidates. 16 bands of 4 find most headers with a Jaccard similarity
+# above about 0.5
+BANDS = 16
+ROWS_PER_BAND = NUM_HASHES // BANDS
+# candidates returned by a lookup, most similar first
+MAX_CANDIDATES = 5
+
+MERSENNE_PRIME = (1 << 61) - 1
+# the hash functions are fixed, so signatures can be compared across runs
+_seeded = random.Random(20190101)
+HASH_PARAMETERS = [(_seeded.randrange(1, MERSENNE_PRIME), \
+    _seeded.randrange(0, MERSENNE_PRIME)) for _ in range(NUM_HASHES)]
+
+
+def column_set(columns):
+    """Return the set of column names of a header, ignoring case and
+    surrounding whitespace."""
+    return frozenset(column.strip().upper() for column in columns)
+
+
+def jaccard(first, second):
+    """Return the Jaccard similarity of two column sets."""
+    if not first and not second:
+        return 0.0
+    return len(first & second) / float(len(first | second))
+
+
+def signature(columns):
+    """Return the MinHash signature of a column set."""
+    hashed = [int.from_bytes(hashlib.blake2b(column.encode('utf-8'), \
+        digest_size=8).digest(), 'big') for column in columns]
+    if not hashed:
+        return None
+    return tuple(min((a * value + b) % MERSENNE_PRIME for value in hashed) \
+        for a, b in HASH_PARAMETERS)
+
+
+def bands(header_signature):
+    """Yield the band keys of a signature."""
+    for band in range(BANDS):
+        start = band * ROWS_PER_BAND
+        yield band, header_signature[start:start + ROWS_PER_BAND]
+
+
+class HeaderIndex(object):
+    """LSH index of stored headers by their column sets."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.column_sets = {}
+
+    def add(self, key, columns, header_signature=None):
+        """Index a header's column set under key."""
+        if header_signature is None:
+            header_signature = signature(columns)
+        if header_signature is None:
+            return
+        self.column_sets[key] = columns
+        for band in bands(header_signature):
+            self.buckets.setdefault(band, []).append(key)
+
+    def query(self, columns, limit=MAX_CANDIDATES):
+        """Return up to limit (similarity, key) pairs of the indexed headers
+        sharing a band with columns, most similar first by exact Jaccard
+        similarity."""
+        header_signature = signature(columns)
+        if header_signature is None:
+            return []
+        candidates = set()
+        for band in bands(header_signature):
+            candidates.update(self.buckets.get(band, ()))
+        scored = sorted(((jaccard(columns, self.column_sets[key]), key) \
+            for key in candidates), key=lambda match: -match[0])
+        return scored[:limit]
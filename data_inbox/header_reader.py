@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+"""
+header_reader reads the header row of a delivered file, reading no more than
+a bounded prefix of the file however large it is
+"""
+
+import bz2
+import contextlib
+import gzip
+import lzma
+import os
+import re
+import zipfile
+import zlib
+
+# outcomes of reading a header
+HEADER_OK = 'ok'
+# no record terminator found within the maximum header size
+HEADER_TOO_LONG = 'too_long'
+# the header isn't valid text
+HEADER_NOT_TEXT = 'not_text'
+# compressed data that is corrupt, encrypted or uses an unsupported method
+HEADER_UNREADABLE = 'unreadable'
+
+READ_BLOCK_SIZE = 64 * 1024
+MAX_HEADER_BYTES = 1024 * 1024
+HEADER_ENCODING = 'utf-8'
+
+# characters that matter when looking for the end of the first record
+RECORD_SPECIALS = re.compile(b'["\r\n]')
+
+# candidate column delimiters, in order of preference on a tie
+DELIMITERS = (',', ';', '\t', '|')
+# characters that matter when splitting a header into columns
+HEADER_SPECIALS = re.compile('["' + re.escape(''.join(DELIMITERS)) + ']')
+
+# streaming openers for single-file compression formats, by extension
+COMPRESSED_OPENERS = {'gz': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+# leading bytes of file formats, checked in order against the start of a file
+CONTENT_SIGNATURES = [
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),
+    (b'%PDF-', 'pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+    (b'SQLite format 3\x00', 'sqlite'),
+    (b'PAR1', 'parquet'),
+    # OLE2 compound documents, such as .xls and .doc
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'ole'),
+]
+SNIFF_BYTES = max(len(magic) for magic, kind in CONTENT_SIGNATURES)
+# formats whose header is read by decompressing them
+COMPRESSED_KINDS = ('gz', 'bz2', 'xz', 'zip')
+# zip member present in Office Open XML documents, such as .xlsx
+OOXML_MARKER = '[Content_Types].xml'
+# errors raised by corrupt or unsupported compressed data
+COMPRESSION_ERRORS = (OSError, EOFError, zlib.error, lzma.LZMAError, \
+    zipfile.BadZipFile, RuntimeError, NotImplementedError)
+
+
+def find_record_end(data):
+    """Return the offset of the first record terminator (LF, CR or CRLF) in
+    data that isn't inside a quoted field, or None if there isn't one. If
+    the quotes never balance, the first terminator of any kind is used."""
+    in_quotes = False
+    for match in RECORD_SPECIALS.finditer(data):
+        if match.group() == b'"':
+            in_quotes = not in_quotes
+        elif not in_quotes:
+            return match.start()
+    if in_quotes:
+        # a stray quote, don't let it swallow the whole file
+        match = re.search(b'[\r\n]', data)
+        if match:
+            return match.start()
+    return None
+
+
+def read_prefix(fd, offset, size):
+    """Read up to size bytes at offset without moving the file position."""
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def sniff_content(path):
+    """Return the kind of file at path from its leading bytes, such as 'gz',
+    'zip' or 'pdf' (see CONTENT_SIGNATURES), or None if no known binary
+    signature matches and the file may be text. Reads a single small block."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        start = read_prefix(fd, 0, SNIFF_BYTES)
+    finally:
+        os.close(fd)
+    for magic, kind in CONTENT_SIGNATURES:
+        if start.startswith(magic):
+            return kind
+    return None
+
+
+def zip_members(path):
+    """Return the names of the files in a zip archive, from its central
+    directory, without extracting anything."""
+    with zipfile.ZipFile(path) as archive:
+        return [info.filename for info in archive.infolist() if not info.is_dir()]
+
+
+def read_first_record(read_block, max_bytes, block_size):
+    """Return the bytes of the first record read through read_block(offset,
+    size), and the outcome. Blocks are read until the first terminator is
+    found, so at most max_bytes are read and held. Data without any
+    terminator that ends within max_bytes is all header."""
+    data = b''
+    while True:
+        block = read_block(len(data), min(block_size, max_bytes - len(data)))
+        data += block
+        if len(data) >= max_bytes or not block:
+            break
+        if b'\n' in block or b'\r' in block:
+            end = find_record_end(data)
+            if end is not None:
+                return data[:end], HEADER_OK
+    end = find_record_end(data)
+    if end is not None:
+        return data[:end], HEADER_OK
+    if len(data) >= max_bytes:
+        return data, HEADER_TOO_LONG
+    return data, HEADER_OK
+
+
+def read_header_bytes(path, max_bytes=MAX_HEADER_BYTES, block_size=READ_BLOCK_SIZE):
+    """Return the raw bytes of the first record of the file at path, and the
+    outcome, reading blocks with pread."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return read_first_record(lambda offset, size: read_prefix(fd, offset, size), \
+            max_bytes, block_size)
+    finally:
+        os.close(fd)
+
+
+def read_stream_header_bytes(stream, max_bytes=MAX_HEADER_BYTES, \
+        block_size=READ_BLOCK_SIZE):
+    """Return the raw bytes of the first record of a decompressing stream,
+    and the outcome. Decompression stops once the first record is found."""
+    return read_first_record(lambda offset, size: stream.read(size), \
+        max_bytes, block_size)
+
+
+@contextlib.contextmanager
+def open_compressed(path, compression, member=None):
+    """Open a decompressing stream over a compressed file, or over member
+    of a zip archive."""
+    if compression == 'zip':
+        with zipfile.ZipFile(path) as archive:
+            with archive.open(member) as stream:
+                yield stream
+    else:
+        with COMPRESSED_OPENERS[compression](path, 'rb') as stream:
+            yield stream
+
+
+def read_compressed_header_bytes(path, compression, member=None, \
+        max_bytes=MAX_HEADER_BYTES):
+    """Return the raw bytes of the first record of a compressed file, or of
+    member of a zip archive, and the outcome."""
+    try:
+        with open_compressed(path, compression, member) as stream:
+            return read_stream_header_bytes(stream, max_bytes)
+    except COMPRESSION_ERRORS:
+        return None, HEADER_UNREADABLE
+
+
+def delimiter_positions(line, quote_aware=True):
+    """Return the offsets of each candidate delimiter in line, skipping
+    those inside quoted fields if quote_aware, in a single pass."""
+    positions = {delim: [] for delim in DELIMITERS}
+    in_quotes = False
+    for match in HEADER_SPECIALS.finditer(line):
+        char = match.group()
+        if char == '"':
+            in_quotes = quote_aware and not in_quotes
+        elif not in_quotes:
+            positions[char].append(match.start())
+    return positions, in_quotes
+
+
+def split_header(line, preferred=None):
+    """Split a header row into columns. Every candidate delimiter outside
+    quoted fields is counted in one pass, and the most common candidate wins.
+    preferred, usually the delimiter of the stored header, wins a tie.
+    Returns the columns and the delimiter, which is None if no candidate
+    appears."""
+    positions, in_quotes = delimiter_positions(line)
+    if in_quotes:
+        # a stray quote, count every delimiter instead
+        positions, in_quotes = delimiter_positions(line, quote_aware=False)
+    delim = max(DELIMITERS, key=lambda candidate: len(positions[candidate]))
+    if preferred in positions and \
+            len(positions[preferred]) == len(positions[delim]):
+        delim = preferred
+    if not positions[delim]:
+        return [line], None
+    columns = []
+    start = 0
+    for offset in positions[delim]:
+        columns.append(line[start:offset])
+        start = offset + 1
+    columns.append(line[start:])
+    return columns, delim
+
+
+def decode_header(raw, encoding=HEADER_ENCODING):
+    """Decode raw header bytes. Returns the text and outcome."""
+    try:
+        return raw.decode(encoding), HEADER_OK
+    except UnicodeDecodeError:
+        return None, HEADER_NOT_TEXT
+
+
+def read_header(path, max_bytes=MAX_HEADER_BYTES, encoding=HEADER_ENCODING, \
+        compression=None, member=None):
+    """Return the header row of the file at path as text, without its
+    terminator, and the outcome. The header is None unless the outcome is
+    HEADER_OK. Compressed files (see sniff_content) are decompressed as a
+    stream only as far as the end of the header; for a zip archive, member
+    names the file inside it to read."""
+    if compression:
+        raw, outcome = read_compressed_header_bytes(path, compression, member, \
+            max_bytes)
+    else:
+        raw, outcome = read_header_bytes(path, max_bytes)
+    if outcome != HEADER_OK:
+        return None, outcome
+    return decode_header(raw, encoding)
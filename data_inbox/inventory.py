@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+inventory lists a partner directory once with os.scandir and shares the
+listing between the stages that need it
+"""
+
+import os
+import stat
+
+
+class DirectoryInventory(object):
+    """A single lazy os.scandir pass over a directory.
+
+    Stages can look ahead (first_file) without losing entries: anything read
+    ahead is kept and handed out again, in order, when the inventory is
+    iterated. The rest of the directory is streamed straight from scandir,
+    so large directories are never held in memory. Entries are os.DirEntry
+    objects, which cache their type and stat info."""
+
+    def __init__(self, path):
+        self.path = path
+        # raises FileNotFoundError / NotADirectoryError for a bad path
+        self._scan = os.scandir(path)
+        self._read_ahead = []
+
+    def first_file(self):
+        """Return the first regular file in the directory, or None."""
+        for entry in self._read_ahead:
+            if entry.is_file():
+                return entry
+        for entry in self._scan:
+            self._read_ahead.append(entry)
+            if entry.is_file():
+                return entry
+        return None
+
+    def entries_read(self):
+        """Return how many entries have been read ahead so far."""
+        return len(self._read_ahead)
+
+    def __iter__(self):
+        """Yield every entry in the directory. Can only be done once."""
+        read_ahead, self._read_ahead = self._read_ahead, []
+        for entry in read_ahead:
+            yield entry
+        for entry in self._scan:
+            yield entry
+        self.close()
+
+    def close(self):
+        """Release the underlying scandir iterator."""
+        self._scan.close()
+
+
+class FileEntry(object):
+    """Stand-in for os.DirEntry for a single file, for when a file is known
+    by name rather than found by listing its directory."""
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def stat(self):
+        """Return the file's stat info, cached after the first call."""
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        """Return True if the entry is a directory."""
+        return stat.S_ISDIR(self.stat().st_mode)
+
+    def is_file(self):
+        """Return True if the entry is a regular file."""
+        return stat.S_ISREG(self.stat().st_mode)
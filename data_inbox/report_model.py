@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+report_model loads the results of a run for reporting, in a single joined
+query or from the results stream written as the run goes, so every section
+of the report is rendered from the same results
+"""
+
+import csv
+import json
+
+# file_run_status columns loaded for each file
+FILE_COLUMNS = ('code', 'filename_pattern', 'cols_add', 'cols_del',
+    'cols_moved', 'cached', 'rows', 'bad_rows', 'bad_offsets', 'drift',
+    'duplicate_of', 'match_confidence')
+
+# fields of each record in the results stream. Partner records leave the
+# file fields empty
+RESULT_FIELDS = ('record', 'run_id', 'partner', 'name_full', 'code',
+    'filename_pattern', 'ok_to_process') + FILE_COLUMNS[2:]
+# buffer size of the results files
+WRITE_BUFFER_BYTES = 64 * 1024
+
+# partner_run_status code of partners with new files
+NEW_FILES = 3
+
+RUN_RESULTS_SQL = """
+    SELECT prs.partner, prs.code, p.name_full, {}
+    FROM partner_run_status AS prs
+    JOIN partners AS p ON p.id = prs.partner
+    LEFT JOIN file_run_status AS f ON prs.code = {} AND f.run_id = prs.run_id
+        AND f.partner = prs.partner
+    WHERE prs.run_id = ?
+    ORDER BY prs.id, f.id
+    """.format(", ".join("f." + col for col in FILE_COLUMNS), NEW_FILES)
+
+
+class PartnerResult(object):
+    """The result of a partner in a run: its partner_run_status code and,
+    for a partner with new files, the file_run_status row of each file as
+    a dict."""
+
+    def __init__(self, partner, code, name_full):
+        self.partner = partner
+        self.code = code
+        self.name_full = name_full
+        self.files = []
+
+    def exceptions(self):
+        """Return the files that need to be looked at before processing."""
+        return [item for item in self.files if needs_attention(item)]
+
+
+def needs_attention(item):
+    """Return True unless a file's header is unchanged and nothing else was
+    noted about it."""
+    return item['code'] != 1 or bool(item['bad_rows']) or \
+        bool(item['drift']) or bool(item['duplicate_of'])
+
+
+def load_run(conn, run_id):
+    """Return a PartnerResult for each partner in a run, in the order they
+    were stored, with their files, from one query."""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    partners = []
+    partner = None
+    for row in cursor.execute(RUN_RESULTS_SQL, (int(run_id),)):
+        if partner is None or partner.partner != row[0]:
+            partner = PartnerResult(row[0], row[1], row[2])
+            partners.append(partner)
+        if row[3] is not None:
+            partner.files.append(dict(zip(FILE_COLUMNS, row[3:])))
+    return partners
+
+
+class ResultSink(object):
+    """Stream a record per partner and per file result to a JSON Lines file,
+    and optionally a CSV file, as results are produced. Files are appended
+    to, so a watch can stream every run to the same files."""
+
+    def __init__(self, path, names, csv_path=None):
+        self.path = path
+        # partner names, keyed by id
+        self.names = names
+        # offset of the first record of each run in the JSON Lines file
+        self.run_offsets = {}
+        self.jsonl = open(path, 'a', buffering=WRITE_BUFFER_BYTES)
+        self.csv_file = None
+        if csv_path:
+            self.csv_file = open(csv_path, 'a', buffering=WRITE_BUFFER_BYTES, \
+                newline='')
+            self.csv_writer = csv.DictWriter(self.csv_file, RESULT_FIELDS)
+            if not self.csv_file.tell():
+                self.csv_writer.writeheader()
+
+    def write(self, record):
+        """Write a record to each file."""
+        if record['run_id'] not in self.run_offsets:
+            self.run_offsets[record['run_id']] = self.jsonl.tell()
+        self.jsonl.write(json.dumps(record) + "\n")
+        if self.csv_file:
+            self.csv_writer.writerow(record)
+
+    def add_partner(self, row):
+        """Stream a partner_run_status row."""
+        record = dict.fromkeys(RESULT_FIELDS)
+        record.update(record='partner', run_id=row['run_id'], \
+            partner=row['partner'], name_full=self.names.get(row['partner']), \
+            code=row['code'])
+        self.write(record)
+
+    def add_file(self, row):
+        """Stream a file_run_status row, flagging whether the file is OK to
+        process."""
+        record = {field: row.get(field) for field in RESULT_FIELDS}
+        record.update(record='file', name_full=self.names.get(row['partner']), \
+            ok_to_process=not needs_attention(row))
+        self.write(record)
+
+    def flush(self):
+        """Push the records written so far to disk."""
+        self.jsonl.flush()
+        if self.csv_file:
+            self.csv_file.flush()
+
+    def load_run(self, run_id):
+        """Read the records of a run back from the JSON Lines file and return
+        a PartnerResult for each partner, as load_run does. A later record
+        for a partner or file replaces an earlier one."""
+        self.flush()
+        partners = {}
+        if run_id not in self.run_offsets:
+            return []
+        with open(self.path) as results:
+            results.seek(self.run_offsets[run_id])
+            for line in results:
+                record = json.loads(line)
+                if record['run_id'] != run_id:
+                    continue
+                partner = partners.get(record['partner'])
+                if partner is None:
+                    partner = PartnerResult(record['partner'], None, \
+                        record['name_full'])
+                    partner.files = {}
+                    partners[record['partner']] = partner
+                if record['record'] == 'partner':
+                    # a partner whose status changed moves to the end, as
+                    # its replaced partner_run_status row does
+                    partners[record['partner']] = partners.pop(record['partner'])
+                    partner.code = record['code']
+                else:
+                    partner.files.pop(record['filename_pattern'], None)
+                    partner.files[record['filename_pattern']] = record
+        for partner in partners.values():
+            partner.files = list(partner.files.values())
+        return list(partners.values())
+
+    def close(self):
+        """Flush and close the results files."""
+        self.jsonl.close()
+        if self.csv_file:
+            self.csv_file.close()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+status_writer buffers the results of a run and writes them to the fileset
+database in batches
+"""
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# columns written for every file_run_status row, in insert order
+FILE_RUN_STATUS_COLUMNS = ('code', 'partner', 'run_id', 'filename_pattern',
+    'filetype', 'cols_add', 'cols_del', 'cols_moved', 'cached', 'rows',
+    'bad_rows', 'bad_offsets', 'drift', 'duplicate_of', 'match_confidence')
+
+FILE_PROFILE_COLUMNS = ('run_id', 'partner', 'filename_pattern',
+    'normalized_name', 'position', 'column_name', 'count', 'nulls',
+    'distinct_count', 'min_value', 'max_value', 'top_values', 'path', 'size',
+    'mtime_ns')
+
+FINGERPRINT_COLUMNS = ('run_id', 'partner', 'path', 'filename_pattern',
+    'size', 'mtime_ns', 'quick_hash', 'full_hash')
+
+HEADER_CACHE_COLUMNS = ('path', 'partner', 'size', 'mtime_ns', 'inode',
+    'header', 'delim', 'fingerprint', 'outcome', 'rows', 'bad_rows',
+    'bad_offsets')
+
+PARTNER_RUN_STATUS_COLUMNS = ('code', 'partner', 'run_id')
+
+
+def insert_sql(table, columns, verb='INSERT'):
+    """Build a named-parameter INSERT statement for table."""
+    return "{} INTO {} ({}) VALUES ({})".format(verb, table, \
+        ", ".join(columns), ", ".join(":" + col for col in columns))
+
+
+class StatusWriter(object):
+    """Collect partner and file results for a run and flush them to the
+    database with executemany, one transaction per flush. Partner and file
+    results are also passed straight on to sink, if given, as they are
+    added."""
+
+    def __init__(self, conn, sink=None):
+        self.conn = conn
+        self.sink = sink
+        self.partner_rows = []
+        self.file_rows = []
+        self.profile_rows = []
+        self.cache_rows = []
+        self.stale_cache_paths = []
+        self.fingerprint_rows = []
+
+    def add_partner_status(self, code, partner, run_id):
+        """Buffer a partner_run_status row."""
+        row = {'code': code, 'partner': partner, 'run_id': run_id}
+        self.partner_rows.append(row)
+        if self.sink:
+            self.sink.add_partner(row)
+
+    def add_file_status(self, code, partner, run_id, filename_pattern, **fields):
+        """Buffer a file_run_status row. Columns not passed are stored as NULL,
+        except filetype which defaults to 'unknown'."""
+        row = dict.fromkeys(FILE_RUN_STATUS_COLUMNS)
+        row['filetype'] = "unknown"
+        row.update(fields)
+        row.update({'code': code, 'partner': partner, 'run_id': run_id, \
+            'filename_pattern': filename_pattern})
+        self.file_rows.append(row)
+        if self.sink:
+            self.sink.add_file(row)
+
+    def add_file_profile(self, run_id, partner, filename_pattern, \
+            normalized_name, position, column_name, summary, path=None, \
+            size=None, mtime_ns=None):
+        """Buffer a file_profile row from a column_profile summary of the file
+        at path, which was size bytes and last modified at mtime_ns."""
+        self.profile_rows.append({'run_id': run_id, 'partner': partner, \
+            'filename_pattern': filename_pattern, \
+            'normalized_name': normalized_name, 'position': position, \
+            'column_name': column_name, 'count': summary['count'], \
+            'nulls': summary['nulls'], 'distinct_count': summary['distinct'], \
+            'min_value': summary['min'], 'max_value': summary['max'], \
+            'top_values': json.dumps(summary['top']), 'path': path, \
+            'size': size, 'mtime_ns': mtime_ns})
+
+    def add_fingerprint(self, fingerprint_row):
+        """Buffer a file_fingerprints row, replacing any row for the same
+        path, size and modification time."""
+        self.fingerprint_rows.append({col: fingerprint_row.get(col) \
+            for col in FINGERPRINT_COLUMNS})
+
+    def add_header_cache(self, cache_row):
+        """Buffer a header_cache row, replacing any cached row for its path."""
+        self.cache_rows.append({col: cache_row.get(col) \
+            for col in HEADER_CACHE_COLUMNS})
+
+    def remove_header_cache(self, paths):
+        """Buffer the removal of the cached headers for paths."""
+        self.stale_cache_paths.extend(paths)
+
+    def pending(self):
+        """Return the number of buffered rows."""
+        return len(self.partner_rows) + len(self.file_rows) + \
+            len(self.profile_rows) + len(self.cache_rows) + \
+            len(self.stale_cache_paths) + len(self.fingerprint_rows)
+
+    def flush(self):
+        """Write all buffered rows in a single transaction."""
+        if self.sink:
+            self.sink.flush()
+        if not self.pending():
+            return
+        logger.info("Writing %i partner and %i file status rows.", \
+            len(self.partner_rows), len(self.file_rows))
+        with self.conn:
+            if self.partner_rows:
+                self.conn.executemany(insert_sql('partner_run_status', \
+                    PARTNER_RUN_STATUS_COLUMNS), self.partner_rows)
+            if self.file_rows:
+                self.conn.executemany(insert_sql('file_run_status', \
+                    FILE_RUN_STATUS_COLUMNS), self.file_rows)
+            if self.profile_rows:
+                self.conn.executemany(insert_sql('file_profile', \
+                    FILE_PROFILE_COLUMNS), self.profile_rows)
+            if self.cache_rows:
+                self.conn.executemany(insert_sql('header_cache', \
+                    HEADER_CACHE_COLUMNS, 'INSERT OR REPLACE'), self.cache_rows)
+            if self.stale_cache_paths:
+                self.conn.executemany("DELETE FROM header_cache WHERE path = ?", \
+                    [(path,) for path in self.stale_cache_paths])
+            if self.fingerprint_rows:
+                self.conn.executemany(insert_sql('file_fingerprints', \
+                    FINGERPRINT_COLUMNS, 'INSERT OR REPLACE'), \
+                    self.fingerprint_rows)
+        self.partner_rows = []
+        self.file_rows = []
+        self.profile_rows = []
+        self.cache_rows = []
+        self.stale_cache_paths = []
+        self.fingerprint_rows = []
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+watcher reports files as they are written to the partner directories, with
+Linux inotify where available and by polling the directories otherwise
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+# wd, mask, cookie, len, followed by len bytes of name
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 64 * 1024
+
+
+class InotifyWatcher(object):
+    """Watch directories with inotify for files that are closed after being
+    written, or moved into the directory."""
+
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', \
+            use_errno=True)
+        # raises AttributeError where inotify doesn't exist
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+        self._fd = inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = {}
+        for directory in directories:
+            wd = inotify_add_watch(self._fd, os.fsencode(directory), \
+                IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                error = ctypes.get_errno()
+                self.close()
+                raise OSError(error, "Unable to watch {}".format(directory))
+            self._directories[wd] = directory
+
+    def events(self, timeout):
+        """Wait up to timeout seconds and return a list of (directory, name)
+        for files written since the last call."""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self._fd, INOTIFY_READ_SIZE)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed. Events were lost.")
+            elif wd in self._directories and name:
+                events.append((self._directories[wd], os.fsdecode(name)))
+        return events
+
+    def close(self):
+        """Stop watching."""
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+    """Watch directories by listing them every interval seconds. A file is
+    reported once its size and mtime have stayed the same for a full
+    interval, so files still being written aren't picked up early. Files
+    already there when watching starts are not reported."""
+
+    def __init__(self, directories, interval):
+        self._directories = list(directories)
+        self._interval = interval
+        self._last = self._snapshot()
+        self._reported = dict(self._last)
+        self._next_poll = time.time() + interval
+
+    def _snapshot(self):
+        """Return the (size, mtime_ns) of every file in the directories."""
+        snapshot = {}
+        for directory in self._directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            file_stat = entry.stat()
+                            snapshot[(directory, entry.name)] = \
+                                (file_stat.st_size, file_stat.st_mtime_ns)
+            except OSError:
+                logger.error("Unable to list %s", directory, exc_info=True)
+        return snapshot
+
+    def events(self, timeout):
+        """Wait up to timeout seconds and return a list of (directory, name)
+        for files that have been written and settled since the last call."""
+        wait = self._next_poll - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        if wait > 0:
+            time.sleep(wait)
+        self._next_poll = time.time() + self._interval
+        snapshot = self._snapshot()
+        events = []
+        for key, file_stat in snapshot.items():
+            if self._last.get(key) == file_stat and \
+                    self._reported.get(key) != file_stat:
+                events.append(key)
+                self._reported[key] = file_stat
+        self._last = snapshot
+        self._reported = {key: self._reported[key] for key in self._reported \
+            if key in snapshot}
+        return events
+
+    def close(self):
+        """Stop watching."""
+        pass
+
+
+def open_watcher(directories, poll_interval):
+    """Return an inotify watcher for directories, or a polling watcher if
+    inotify isn't available."""
+    try:
+        return InotifyWatcher(directories)
+    except (AttributeError, OSError):
+        logger.warning("inotify not available. Polling every %s seconds.", \
+            poll_interval, exc_info=True)
+        return PollingWatcher(directories, poll_interval)
@@ -7,4 +7,6 @@ VALUES
   (4, 'Header missing'),
   (5, 'New filename pattern'),
   (6, 'Column(s) deleted and column(s) added'),
-  (7, 'No previous fileset stored- header not checked.')
+  (7, 'No previous fileset stored- header not checked.'),
+  (8, 'Column order changed'),
+  (9, 'Header too long or no end of line')
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+
+from data_inbox import column_profile, deep_check
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+
+def without_top(summaries):
+    # frequent value counts are lower bounds that depend on merge order
+    return [dict(summary, top=None) for summary in summaries]
+
+
+def test_sketches_merge():
+    values = [str(value) for value in range(20000)] + ['F'] * 5000 + [''] * 100
+    whole = column_profile.ColumnSketch()
+    whole.add_values(values)
+    halves = [column_profile.ColumnSketch(), column_profile.ColumnSketch()]
+    halves[0].add_values(values[::2])
+    halves[1].add_values(values[1::2])
+    halves[0].merge(halves[1])
+    assert without_top([halves[0].summary()]) == without_top([whole.summary()])
+    assert halves[0].summary()['top'][0][0] == 'F'
+    summary = whole.summary()
+    assert (summary['count'], summary['nulls']) == (25100, 100)
+    assert abs(summary['distinct'] - 20001) < 20001 * 0.05
+    assert (summary['min'], summary['max']) == ('0', 'F')
+    assert summary['top'][0][0] == 'F'
+
+
+def test_profile_ranges(tmp_path):
+    data = b'PATID,SEX,NOTE\n' + b''.join(
+        b'%d,%s,"line\nbreak, ""quoted"""\n' % (row, b'MF'[row % 2:row % 2 + 1])
+        for row in range(500))
+    path = tmp_path / 'DEMOGRAPHIC.csv'
+    path.write_bytes(data)
+    whole = column_profile.profile_file(str(path), [(0, len(data))], 3, ',',
+                                        'utf-8')
+    assert [column['count'] for column in whole] == [500] * 3
+    assert whole[2]['top'] == [('line\nbreak, "quoted"', 500)]
+    # ranges that start inside a quoted field are profiled again
+    bounds = deep_check.range_bounds(str(path), len(data), 100)
+    assert without_top(column_profile.profile_file(str(path), bounds, 3, ',',
+                                                   'utf-8')) == without_top(whole)
+    assert column_profile.profile_stream(io.BytesIO(data), 3, ',', 'utf-8') == whole
+
+
+def test_compare_profiles():
+    previous = {'SEX': {'count': 100, 'nulls': 0, 'distinct': 2, 'min': 'F',
+                        'max': 'M'},
+                'PATID': {'count': 100, 'nulls': 0, 'distinct': 100,
+                          'min': '1', 'max': '99'}}
+    current = {'SEX': {'count': 100, 'nulls': 50, 'distinct': 2, 'min': 'F',
+                       'max': 'M'},
+               'PATID': {'count': 100, 'nulls': 0, 'distinct': 3,
+                         'min': '1', 'max': '99'}}
+    assert column_profile.compare_profiles(previous, current) == \
+        ['SEX missing 0% -> 50%', 'PATID distinct values 100 -> 3']
+    assert column_profile.compare_profiles(previous, previous) == []
+
+
+def test_compare_profiles_range():
+    previous = {'ADMIT_DATE': {'count': 100, 'nulls': 0, 'distinct': 30,
+                               'min': '2018-01-01', 'max': '2018-01-31'}}
+    # a rolling extract moves forward, which isn't drift
+    rolled = {'ADMIT_DATE': {'count': 100, 'nulls': 0, 'distinct': 30,
+                             'min': '2018-02-01', 'max': '2018-02-28'}}
+    assert column_profile.compare_profiles(previous, rolled) == []
+    earlier = {'ADMIT_DATE': {'count': 100, 'nulls': 0, 'distinct': 30,
+                              'min': '1900-01-01', 'max': '2017-12-31'}}
+    assert column_profile.compare_profiles(previous, earlier) == \
+        ['ADMIT_DATE least value 2018-01-01 -> 1900-01-01',
+         'ADMIT_DATE greatest value 2018-01-31 -> 2017-12-31']
@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sys
+
+import pytest
+from click.testing import CliRunner
+
+# data_inbox.py imports the modules next to it as a script does
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data_inbox'))
+
+from data_inbox import data_inbox  # noqa: E402
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint_run(directory, names, fingerprints, run_id):
+    """Fingerprint files in order as a run does, returning what each was
+    found to duplicate."""
+    duplicates = {}
+    for name in names:
+        entry = data_inbox.FileEntry(str(directory), name)
+        fingerprint = data_inbox.fingerprint_file(entry, fingerprints, run_id, \
+            logger)
+        data_inbox.remember_fingerprint(fingerprints, fingerprint['row'])
+        duplicates[name] = fingerprint['duplicate_of']
+    return duplicates
+
+
+def test_fingerprint_same_run(tmp_path):
+    (tmp_path / 'DEMOGRAPHIC_20180301.csv').write_bytes(b'PATID,SEX\r\n1,F\r\n')
+    (tmp_path / 'DUP_DEMOGRAPHIC.csv').write_bytes(b'PATID,SEX\r\n1,F\r\n')
+    names = ['DEMOGRAPHIC_20180301.csv', 'DUP_DEMOGRAPHIC.csv']
+    fingerprints = {}
+    # the copy is caught in the run both arrive in, once
+    assert fingerprint_run(tmp_path, names, fingerprints, 2) == \
+        {'DEMOGRAPHIC_20180301.csv': None, \
+        'DUP_DEMOGRAPHIC.csv': 'DEMOGRAPHIC_20180301.csv (run 2)'}
+    # and still in the incoming directory next run, they are as they were
+    assert fingerprint_run(tmp_path, names, fingerprints, 3) == \
+        {'DEMOGRAPHIC_20180301.csv': None, 'DUP_DEMOGRAPHIC.csv': None}
+
+
+def test_fingerprint_next_run(tmp_path):
+    (tmp_path / 'DEMOGRAPHIC_20180301.csv').write_bytes(b'PATID,SEX\r\n1,F\r\n')
+    fingerprints = {}
+    fingerprint_run(tmp_path, ['DEMOGRAPHIC_20180301.csv'], fingerprints, 2)
+    (tmp_path / 'DUP_DEMOGRAPHIC.csv').write_bytes(b'PATID,SEX\r\n1,F\r\n')
+    # only the file arriving later is a resend
+    assert fingerprint_run(tmp_path, ['DEMOGRAPHIC_20180301.csv', \
+        'DUP_DEMOGRAPHIC.csv'], fingerprints, 3) == \
+        {'DEMOGRAPHIC_20180301.csv': None, \
+        'DUP_DEMOGRAPHIC.csv': 'DEMOGRAPHIC_20180301.csv (run 2)'}
+
+
+def test_fingerprint_earlier_gone(tmp_path, monkeypatch):
+    (tmp_path / 'ENCOUNTER.csv').write_bytes(b'PATID,ENCID\r\n1,2\r\n')
+    size = (tmp_path / 'ENCOUNTER.csv').stat().st_size
+    # treat the file as large enough for a pre-hash
+    monkeypatch.setattr(data_inbox.file_hash, 'quick_hash', \
+        lambda path, size: 'pre:abc')
+    earlier = {'run_id': 1, 'path': str(tmp_path / 'gone.csv'), \
+        'filename_pattern': 'gone.csv', 'size': size, 'mtime_ns': 0, \
+        'quick_hash': 'pre:abc', 'full_hash': None}
+    fingerprint = data_inbox.fingerprint_file(data_inbox.FileEntry( \
+        str(tmp_path), 'ENCOUNTER.csv'), {size: [earlier]}, 2, logger)
+    # the earlier file can't be hashed in full, so its pre-hash decides
+    assert fingerprint['duplicate_of'] == 'gone.csv (run 1)'
+    assert fingerprint['hashed'] == []
+    assert earlier['full_hash'] is None
+
+
+def open_db(tmp_path):
+    """Return a fresh database with one partner, UFH, whose incoming files
+    are in tmp_path/sftp, and its partner_info."""
+    conn = data_inbox.sqlite3.connect(':memory:')
+    conn.row_factory = data_inbox.dict_factory
+    data_inbox.fileset_db.create_empty_tables(conn)
+    data_inbox.fileset_db.upgrade_schema(conn)
+    (tmp_path / 'sftp').mkdir()
+    conn.execute("INSERT INTO partners (name, name_full, \
+        incoming_file_directory, stored_file_directory, tocheck) VALUES \
+        ('UFH', 'University of Florida Health', ?, ?, 'True')", \
+        (str(tmp_path / 'sftp') + '/', str(tmp_path / 'archive') + '/'))
+    partner_info = {row['id']: row for row in conn.execute("SELECT id, name, \
+        name_full, incoming_file_directory FROM partners")}
+    return conn, partner_info
+
+
+def check_run(conn, partner_info, full_read=None):
+    """Run the checks once, returning the run id."""
+    run_id = data_inbox.check_run_id(conn.cursor(), conn, logger)
+    writer = data_inbox.StatusWriter(conn)
+    data_inbox.run_checks(partner_info, conn, logger, run_id, writer, 1, \
+        full_read)
+    return run_id
+
+
+def test_header_cache(tmp_path):
+    conn, partner_info = open_db(tmp_path)
+    conn.execute("INSERT INTO partners_filesets (pid, date, filename_pattern, \
+        filetype, header) VALUES (1, '2017-01-01', 'DEMOGRAPHIC', 4, \
+        'PATID,BIRTH_DATE,SEX')")
+    demographic = tmp_path / 'sftp' / 'DEMOGRAPHIC_2018.csv'
+    demographic.write_text('PATID,BIRTH_DATE,SEX\n1,2000-01-01,F\n')
+    old = tmp_path / 'sftp' / 'DEMOGRAPHIC_OLD.csv'
+    old.write_text('PATID,BIRTH_DATE\n1,2000-01-01\n')
+
+    def statuses(run_id):
+        return {row['filename_pattern']: (row['code'], row['cached']) for row \
+            in conn.execute("SELECT filename_pattern, code, cached FROM \
+            file_run_status WHERE run_id = ?", (run_id,))}
+
+    def cached_paths():
+        return sorted(os.path.basename(row['path']) for row in \
+            conn.execute("SELECT path FROM header_cache"))
+
+    run_id = check_run(conn, partner_info)
+    assert statuses(run_id) == {'DEMOGRAPHIC_2018.csv': (1, 0), \
+        'DEMOGRAPHIC_OLD.csv': (3, 0)}
+    assert cached_paths() == ['DEMOGRAPHIC_2018.csv', 'DEMOGRAPHIC_OLD.csv']
+    # unchanged size, mtime and inode: the cached header is used
+    run_id = check_run(conn, partner_info)
+    assert statuses(run_id) == {'DEMOGRAPHIC_2018.csv': (1, 1), \
+        'DEMOGRAPHIC_OLD.csv': (3, 1)}
+    # a rewritten file is read again, and a removed one leaves the cache
+    demographic.write_text('PATID,BIRTH_DATE,SEX,RACE\n1,2000-01-01,F,1\n')
+    old.unlink()
+    run_id = check_run(conn, partner_info)
+    assert statuses(run_id) == {'DEMOGRAPHIC_2018.csv': (2, 0)}
+    assert cached_paths() == ['DEMOGRAPHIC_2018.csv']
+    assert conn.execute("SELECT header FROM header_cache").fetchone()['header'] \
+        .startswith('PATID,BIRTH_DATE,SEX,RACE')
+
+
+def make_archive(directory, deliveries):
+    """Write archive directories of delivered files, given as
+    {directory: {filename: contents}}."""
+    for delivery, files in deliveries.items():
+        (directory / delivery).mkdir(parents=True)
+        for name, contents in files.items():
+            (directory / delivery / name).write_text(contents)
+
+
+def scanned_dirs(conn, pid=1):
+    """Return the archive directories a fileset build added, newest first."""
+    return [row['directory'] for row in conn.execute("SELECT directory FROM \
+        fileset_watermarks WHERE pid = ? ORDER BY directory DESC", (pid,))]
+
+
+def test_build_fileset_filters(tmp_path, monkeypatch):
+    conn, partner_info = open_db(tmp_path)
+    conn.execute("INSERT INTO partners (name, name_full, \
+        incoming_file_directory, stored_file_directory, tocheck) VALUES \
+        ('TMH', 'Tallahassee Memorial Hospital', ?, ?, 'True')", \
+        (str(tmp_path / 'tmh_sftp') + '/', str(tmp_path / 'tmh') + '/'))
+    make_archive(tmp_path / 'archive', { \
+        '20170101': {'DEMOGRAPHIC.csv': 'PATID,SEX\n'}, \
+        '20170201': {'DEMOGRAPHIC.csv': 'PATID,SEX\n'}, \
+        '20170301': {'DEMOGRAPHIC.csv': 'PATID,SEX\n'}, \
+        'extra': {'DEMOGRAPHIC.csv': 'PATID,SEX\n'}})
+    make_archive(tmp_path / 'tmh', {'20170101': {'ENCOUNTER.csv': 'PATID\n'}})
+
+    def never_asked(prompt):
+        raise AssertionError("asked " + prompt)
+
+    monkeypatch.setattr('builtins.input', never_asked)
+    data_inbox.add_new_fileset(conn, logger, ['tmh'], assume_yes=True)
+    assert scanned_dirs(conn, 1) == []
+    assert scanned_dirs(conn, 2) == ['20170101']
+    # only dated directories in the range
+    data_inbox.add_new_fileset(conn, logger, ['UFH'], since='20170115', \
+        until='20170215', assume_yes=True)
+    assert scanned_dirs(conn) == ['20170201']
+    data_inbox.add_new_fileset(conn, logger, ['UFH'], since='20170215', \
+        assume_yes=True)
+    assert scanned_dirs(conn) == ['20170301', '20170201']
+    # without assume_yes, each directory is confirmed, and can be skipped or
+    # the partner stopped
+    answers = iter(['Y', 'S', 'Y', 'N'])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(answers))
+    conn.execute("DELETE FROM fileset_watermarks")
+    data_inbox.add_new_fileset(conn, logger, ['UFH'])
+    assert scanned_dirs(conn) == ['extra', '20170201']
+
+
+def test_build_fileset_resume(tmp_path, monkeypatch):
+    conn, partner_info = open_db(tmp_path)
+    make_archive(tmp_path / 'archive', { \
+        '20170101': {'CONDITION.csv': 'PATID,CONDITION\n'}, \
+        '20170201': {'DIAGNOSIS.csv': 'PATID,DX\n'}, \
+        '20170301': {'ENCOUNTER.csv': 'PATID,ENCOUNTERID\n'}})
+    read_headers = data_inbox.read_archived_headers
+    read = []
+    interrupt_in = ['20170201']
+
+    def interrupted(new_path, logger):
+        delivery = os.path.basename(os.path.dirname(new_path))
+        if delivery in interrupt_in:
+            raise KeyboardInterrupt
+        read.append(delivery)
+        return read_headers(new_path, logger)
+
+    monkeypatch.setattr(data_inbox, 'read_archived_headers', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        data_inbox.add_new_fileset(conn, logger, assume_yes=True)
+    # the directory added before the interruption is kept, and nothing of
+    # the one it was interrupted in
+    assert scanned_dirs(conn) == ['20170301']
+    assert [row['filename_pattern'] for row in conn.execute("SELECT \
+        filename_pattern FROM partners_filesets")] == ['ENCOUNTER']
+    del interrupt_in[:]
+    del read[:]
+    data_inbox.add_new_fileset(conn, logger, assume_yes=True)
+    # the build carries on from the next directory
+    assert read == ['20170201', '20170101']
+    assert scanned_dirs(conn) == ['20170301', '20170201', '20170101']
+
+
+def test_build_fileset_newest_wins(tmp_path, monkeypatch):
+    conn, partner_info = open_db(tmp_path)
+    conn.execute("INSERT INTO filetypes (filetype_id, filetype_name) VALUES \
+        (4, 'Demographic'), (5, 'Diagnosis')")
+    old_header = {'DEMOGRAPHIC.csv': 'PATID,SEX\n', 'DIAGNOSIS.txt': 'PATID|DX\n'}
+    make_archive(tmp_path / 'archive', {'20170101': old_header, \
+        '20170201': old_header, '20170301': old_header, '20170401': old_header, \
+        '20170501': {'DEMOGRAPHIC.csv': 'PATID,SEX,RACE\n', \
+        'DIAGNOSIS.txt': 'PATID|DX\n'}})
+    read_headers = data_inbox.read_archived_headers
+    read = []
+
+    def recorded(new_path, logger):
+        read.append(os.path.basename(os.path.dirname(new_path)))
+        return read_headers(new_path, logger)
+
+    monkeypatch.setattr(data_inbox, 'read_archived_headers', recorded)
+
+    def stored():
+        return {row['filetype']: (row['header'], row['archive_dir']) for row \
+            in conn.execute("SELECT filetype, header, archive_dir FROM \
+            partners_filesets")}
+
+    data_inbox.add_new_fileset(conn, logger, assume_yes=True)
+    # the newest header is stored, and older ones only kept as history
+    assert stored() == {4: ('PATID,SEX,RACE', '20170501'), \
+        5: ('PATID|DX', '20170501')}
+    assert sorted(version['columns'] for version in data_inbox.header_history \
+        .header_versions(conn, 1, 4)) == [['PATID', 'SEX'], \
+        ['PATID', 'SEX', 'RACE']]
+    # a first build stops once directories turn up no new filetypes
+    assert scanned_dirs(conn) == ['20170501', '20170401', '20170301', \
+        '20170201']
+    make_archive(tmp_path / 'archive', {'20170601': \
+        {'DEMOGRAPHIC.csv': 'PATID,SEX,RACE,ETHNICITY\n'}})
+    del read[:]
+    data_inbox.add_new_fileset(conn, logger, assume_yes=True, rescan=True)
+    # once every known filetype has its newest header, the scan stops
+    assert sorted(set(read)) == ['20170501', '20170601']
+    assert stored() == {4: ('PATID,SEX,RACE,ETHNICITY', '20170601'), \
+        5: ('PATID|DX', '20170501')}
+    del read[:]
+    data_inbox.add_new_fileset(conn, logger, assume_yes=True, rescan=True, \
+        depth=1)
+    assert sorted(set(read)) == ['20170601']
+
+
+def scan_fileset(partner_fileset, new_file_trim):
+    """Match a filename the way it was before the fileset index, scoring
+    every stored pattern in turn. Returns the score and filename."""
+    strip = {ord(k): None for k in data_inbox.digits}
+    new = new_file_trim.upper().translate(strip)
+    max_score = {'score': 0, 'filename': ""}
+    for row in partner_fileset:
+        fname = row['filename_pattern'].upper().translate(strip)
+        current_score = data_inbox.fuzz.ratio(new, fname)
+        if current_score > max_score['score']:
+            max_score = {'score': current_score, \
+                'filename': row['filename_pattern']}
+    return max_score['score'], max_score['filename']
+
+
+def test_match_fileset():
+    partner_fileset = [{'pid': 1, 'filetype': filetype, \
+        'filename_pattern': pattern, 'header': header} for filetype, pattern, \
+        header in [(4, 'DEMOGRAPHIC_2017', 'PATID,SEX'), \
+        (4, 'demographic_2018', 'PATID,SEX,RACE'), \
+        (5, 'DIAGNOSIS', 'PATID|DX'), (7, 'encounter', 'PATID,ENCOUNTERID'), \
+        (32, 'LAB_RESULT_CM', 'PATID,LAB')]]
+    fileset_index = data_inbox.compile_fileset_index(partner_fileset, logger)
+    for new_file_trim in ['DEMOGRAPHIC_20180301', 'Demographic_2019', \
+            'DIAGNOSIS_2018', 'DIAG', 'ENCOUNTERS', 'LAB_RESULT', 'vital', \
+            '2018']:
+        match = data_inbox.match_fileset(fileset_index, new_file_trim, logger)
+        assert (match['score'], match['filename']) == \
+            scan_fileset(partner_fileset, new_file_trim)
+    # of several patterns matching exactly, the first stored wins
+    match = data_inbox.match_fileset(fileset_index, 'DEMOGRAPHIC_20180301', \
+        logger)
+    assert (match['score'], match['filename']) == (100, 'DEMOGRAPHIC_2017')
+
+
+def test_prune_parsed_headers(monkeypatch):
+    monkeypatch.setattr(data_inbox, 'PARSED_STORED_HEADERS', {})
+    data_inbox.parse_stored_header('PATID,SEX', logger)
+    kept = data_inbox.parse_stored_header('PATID|DX', logger)
+    data_inbox.prune_parsed_headers({'PATID|DX'})
+    assert data_inbox.PARSED_STORED_HEADERS == {'PATID|DX': kept}
+
+
+def test_match_renamed_by_header(tmp_path):
+    conn, partner_info = open_db(tmp_path)
+    conn.execute("INSERT INTO partners_filesets (pid, date, filename_pattern, \
+        filetype, header) VALUES (1, '2017-01-01', 'DEMOGRAPHIC', 4, \
+        'PATID,BIRTH_DATE,SEX,RACE')")
+    # names that have nothing in common with any stored pattern
+    (tmp_path / 'sftp' / 'qqq.csv').write_text( \
+        'PATID,BIRTH_DATE,SEX,RACE\n1,2000-01-01,F,1\n')
+    (tmp_path / 'sftp' / 'zzz.csv').write_text('A,B,C\n1,2,3\n')
+    run_id = check_run(conn, partner_info)
+    assert {row['filename_pattern']: (row['code'], row['match_confidence']) \
+        for row in conn.execute("SELECT filename_pattern, code, \
+        match_confidence FROM file_run_status WHERE run_id = ?", (run_id,))} \
+        == {'qqq.csv': (1, 0.6), 'zzz': (5, None)}
+
+
+def test_header_trailing_whitespace(tmp_path):
+    conn, partner_info = open_db(tmp_path)
+    conn.execute("INSERT INTO partners_filesets (pid, date, filename_pattern, \
+        filetype, header) VALUES (1, '2017-01-01', 'DEMOGRAPHIC', 4, \
+        'PATID,BIRTH_DATE,SEX,RACE')")
+    (tmp_path / 'sftp' / 'DEMOGRAPHIC_2018.csv').write_text( \
+        'PATID,BIRTH_DATE,SEX,RACE \r\n1,2000-01-01,F,1\r\n')
+    run_id = check_run(conn, partner_info)
+    assert conn.execute("SELECT code FROM file_run_status WHERE run_id = ?", \
+        (run_id,)).fetchone()['code'] == 1
+    assert conn.execute("SELECT header FROM header_cache").fetchone() \
+        ['header'] == 'PATID,BIRTH_DATE,SEX,RACE'
+
+
+def test_check_workers(tmp_path):
+    """Checking partners in parallel stores the same results as one at a
+    time."""
+
+    def stored_results(directory, workers):
+        directory.mkdir()
+        conn, partner_info = open_db(directory)
+        for name in ['TMH', 'ORH', 'BND']:
+            conn.execute("INSERT INTO partners (name, name_full, \
+                incoming_file_directory, stored_file_directory, tocheck) \
+                VALUES (?, ?, ?, '', 'True')", (name, name, \
+                str(directory / name) + '/'))
+        for pid, name in [(2, 'TMH'), (3, 'ORH')]:
+            (directory / name).mkdir()
+            conn.execute("INSERT INTO partners_filesets (pid, date, \
+                filename_pattern, filetype, header) VALUES (?, '2017-01-01', \
+                'ENCOUNTER', 7, 'PATID,ENCOUNTERID')", (pid,))
+            (directory / name / 'ENCOUNTER_2018.csv').write_text( \
+                'PATID,ENCOUNTERID,ADMIT_DATE\n1,2,3\n')
+            (directory / name / 'encounter_2019.csv').write_text( \
+                'PATID,ENCOUNTERID\n1,2\n')
+        conn.execute("INSERT INTO partners_filesets (pid, date, \
+            filename_pattern, filetype, header) VALUES (1, '2017-01-01', \
+            'DEMOGRAPHIC', 4, 'PATID,SEX')")
+        (directory / 'sftp' / 'DEMOGRAPHIC_2018.csv').write_text('PATID\n1\n')
+        partner_info = {row['id']: row for row in conn.execute("SELECT id, \
+            name, name_full, incoming_file_directory FROM partners")}
+        run_id = data_inbox.check_run_id(conn.cursor(), conn, logger)
+        writer = data_inbox.StatusWriter(conn)
+        data_inbox.run_checks(partner_info, conn, logger, run_id, writer, \
+            workers)
+        return {'partners': sorted((row['partner'], row['code']) for row in \
+            conn.execute("SELECT partner, code FROM partner_run_status")), \
+            'files': sorted(tuple(sorted(row.items())) for row in \
+            conn.execute("SELECT partner, filename_pattern, code, cols_add, \
+            cols_del, cached FROM file_run_status")), \
+            'cache': sorted((row['partner'], os.path.basename(row['path']), \
+            row['header']) for row in conn.execute("SELECT partner, path, \
+            header FROM header_cache"))}
+
+    serial = stored_results(tmp_path / 'serial', 1)
+    assert len(serial['partners']) == 4
+    assert len(serial['files']) == 5
+    assert stored_results(tmp_path / 'parallel', 4) == serial
+
+
+def test_deep_check_cached(tmp_path, monkeypatch):
+    conn, partner_info = open_db(tmp_path)
+    conn.execute("INSERT INTO partners_filesets (pid, date, filename_pattern, \
+        filetype, header) VALUES (1, '2017-01-01', 'DEMOGRAPHIC', 4, \
+        'PATID,SEX')")
+    demographic = tmp_path / 'sftp' / 'DEMOGRAPHIC_2018.csv'
+    demographic.write_text('PATID,SEX\n1,F\n2\n3,M\n')
+    full_read = {'pool': None, 'rows': True, 'profile': False, \
+        'fingerprint': False}
+    deep_check_file = data_inbox.deep_check_file
+    read = []
+
+    def counted(path, *args):
+        read.append(os.path.basename(path))
+        return deep_check_file(path, *args)
+
+    monkeypatch.setattr(data_inbox, 'deep_check_file', counted)
+
+    def rows(run_id):
+        row = conn.execute("SELECT rows, bad_rows, bad_offsets FROM \
+            file_run_status WHERE run_id = ?", (run_id,)).fetchone()
+        return row['rows'], row['bad_rows'], row['bad_offsets']
+
+    first = rows(check_run(conn, partner_info, full_read))
+    assert first == (3, 1, '[14]')
+    # an unchanged file isn't read again
+    assert rows(check_run(conn, partner_info, full_read)) == first
+    assert read == ['DEMOGRAPHIC_2018.csv']
+    demographic.write_text('PATID,SEX\n1,F\n')
+    assert rows(check_run(conn, partner_info, full_read)) == (1, 0, None)
+    assert len(read) == 2
+
+
+def test_profile_cached(tmp_path, monkeypatch):
+    conn, partner_info = open_db(tmp_path)
+    conn.execute("INSERT INTO partners_filesets (pid, date, filename_pattern, \
+        filetype, header) VALUES (1, '2017-01-01', 'DEMOGRAPHIC', 4, \
+        'PATID,SEX')")
+    # two files that normalize to the same name
+    first = tmp_path / 'sftp' / 'DEMOGRAPHIC_1.csv'
+    first.write_text('PATID,SEX\n1,F\n2,F\n')
+    (tmp_path / 'sftp' / 'DEMOGRAPHIC_2.csv').write_text('PATID,SEX\n3,M\n4,M\n')
+    full_read = {'pool': None, 'rows': False, 'profile': True, \
+        'fingerprint': False}
+    profile_file = data_inbox.profile_file
+    read = []
+
+    def counted(path, *args):
+        read.append(os.path.basename(path))
+        return profile_file(path, *args)
+
+    monkeypatch.setattr(data_inbox, 'profile_file', counted)
+
+    def results(run_id):
+        return {row['filename_pattern']: row['drift'] for row in conn.execute( \
+            "SELECT filename_pattern, drift FROM file_run_status WHERE \
+            run_id = ?", (run_id,))}
+
+    check_run(conn, partner_info, full_read)
+    profiles = data_inbox.load_previous_profiles(conn, 1)['DEMOGRAPHIC_.CSV']
+    # kept apart by path rather than merged
+    assert sorted((os.path.basename(path), dict(profile['columns'])['SEX'] \
+        ['min']) for path, profile in profiles.items()) == \
+        [('DEMOGRAPHIC_1.csv', 'F'), ('DEMOGRAPHIC_2.csv', 'M')]
+    # unchanged files aren't read again, and their profiles are kept
+    del read[:]
+    run_id = check_run(conn, partner_info, full_read)
+    assert read == []
+    assert conn.execute("SELECT COUNT(*) AS n FROM file_profile WHERE \
+        run_id = ?", (run_id,)).fetchone()['n'] == 4
+    assert results(run_id) == {'DEMOGRAPHIC_1.csv': None, \
+        'DEMOGRAPHIC_2.csv': None}
+    # a rewritten file is profiled again and compared with its own profile
+    first.write_text('PATID,SEX\n1,\n2,\n')
+    run_id = check_run(conn, partner_info, full_read)
+    assert read == ['DEMOGRAPHIC_1.csv']
+    assert results(run_id) == {'DEMOGRAPHIC_1.csv': 'SEX missing 0% -> 100%', \
+        'DEMOGRAPHIC_2.csv': None}
+
+
+def test_archive_date_option():
+    runner = CliRunner()
+    for value in ['2018-01-01', '201801', '20181301']:
+        result = runner.invoke(data_inbox.main, ['--buildfileset', '--since', \
+            value])
+        assert result.exit_code == 2
+        assert 'YYYYMMDD' in result.output
+    assert data_inbox.check_archive_date(None, None, '20180131') == '20180131'
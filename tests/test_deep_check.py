@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from data_inbox import deep_check
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+DATA = (b'PATID,DX,"DX,TYPE"\r\n'
+        b'1,A,09\r\n'
+        b'2,"B\nC",10\r\n'
+        b'\r\n'
+        b'3,D\r\n'
+        b'4,"E,F",09\r\n'
+        b'5,"G\n,H\n,I",10,11\r\n') * 50
+
+
+def test_check_file(tmp_path):
+    path = tmp_path / 'DIAGNOSIS.csv'
+    path.write_bytes(DATA)
+    result = deep_check.check_file(str(path), b',')
+    # repeats of the header after the first are counted as rows
+    assert result['rows'] == 50 * 6 - 1
+    assert result['bad_rows'] == 50 * 2
+    assert result['bad_offsets'][:2] == [DATA.index(b'3,D'), DATA.index(b'5,"G')]
+    # byte ranges scanned separately, including ones that start inside a
+    # quoted field, give the same result
+    with ThreadPoolExecutor(4) as pool:
+        for chunk_bytes in (5, 64, 1000):
+            assert deep_check.check_file(str(path), b',', pool, chunk_bytes) == result
+    assert deep_check.check_stream(io.BytesIO(DATA), b',', 7) == result
+
+
+def test_truncated(tmp_path):
+    path = tmp_path / 'DIAGNOSIS.csv'
+    path.write_bytes(b'PATID,DX\n1,A\n2,"B')
+    assert deep_check.check_file(str(path), b',') == \
+        {'rows': 2, 'bad_rows': 1, 'bad_offsets': [13]}
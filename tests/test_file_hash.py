@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from data_inbox import file_hash
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+
+def test_full_hash_blocks(tmp_path):
+    path = tmp_path / 'ENCOUNTER.csv'
+    path.write_bytes(b'PATID,ENCID\r\n1,2\r\n' * 1000)
+    # the digest doesn't depend on the block size
+    assert file_hash.full_hash(str(path), 7) == file_hash.full_hash(str(path))
+
+
+def test_quick_hash(tmp_path):
+    data = b'PATID,ENCID\r\n' + b'1,2\r\n' * 1000
+    first = tmp_path / 'ENCOUNTER_20200101.csv'
+    first.write_bytes(data)
+    resent = tmp_path / 'ENCOUNTER_20200201.csv'
+    resent.write_bytes(data)
+    changed = tmp_path / 'ENCOUNTER_20200301.csv'
+    changed.write_bytes(data[:100] + b'3' + data[101:])
+    size = len(data)
+    # small files are hashed in full
+    small = file_hash.quick_hash(str(first), size)
+    assert not file_hash.is_prehash(small)
+    assert small == file_hash.full_hash(str(first))
+    # large files are pre-hashed by their size, start and end, which misses
+    # changes in the middle
+    quick = [file_hash.quick_hash(str(path), size, 50, 100) \
+        for path in (first, resent, changed)]
+    assert file_hash.is_prehash(quick[0])
+    assert quick[0] == quick[1] == quick[2]
+    assert file_hash.full_hash(str(changed)) != small
+
+
+def test_directory_fingerprint(tmp_path):
+    (tmp_path / 'DEMOGRAPHIC.csv').write_bytes(b'PATID\r\n1\r\n')
+    (tmp_path / 'subdir').mkdir()
+    first = file_hash.directory_fingerprint(str(tmp_path))
+    assert file_hash.directory_fingerprint(str(tmp_path)) == first
+    # files in subdirectories aren't included
+    (tmp_path / 'subdir' / 'VITAL.csv').write_bytes(b'PATID\r\n')
+    assert file_hash.directory_fingerprint(str(tmp_path)) == first
+    (tmp_path / 'DIAGNOSIS.csv').write_bytes(b'PATID\r\n')
+    assert file_hash.directory_fingerprint(str(tmp_path)) != first
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import os
+import sqlite3
+
+import pytest
+from data_inbox import fileset_db
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    fileset_db.create_empty_tables(conn)
+    yield conn
+    conn.close()
+
+
+def query_plan(conn, query, params):
+    return " ".join(row[-1] for row in
+                    conn.execute("EXPLAIN QUERY PLAN " + query, params))
+
+
+def test_upgrade_schema(conn):
+    assert fileset_db.get_schema_version(conn) == 0
+    assert fileset_db.upgrade_schema(conn) == fileset_db.SCHEMA_VERSION
+    assert fileset_db.get_schema_version(conn) == fileset_db.SCHEMA_VERSION
+    # upgrading an up to date database is a no-op
+    assert fileset_db.upgrade_schema(conn) == fileset_db.SCHEMA_VERSION
+
+
+def test_upgrade_schema_keeps_data(conn):
+    conn.execute("INSERT INTO partners_filesets (pid, filetype, header) \
+        VALUES (1, 4, 'PATID,SEX')")
+    conn.commit()
+    fileset_db.upgrade_schema(conn)
+    assert conn.execute("SELECT header FROM partners_filesets").fetchall() \
+        == [('PATID,SEX',)]
+
+
+def test_upgrade_schema_without_tables():
+    conn = sqlite3.connect(':memory:')
+    assert fileset_db.upgrade_schema(conn) == 0
+
+
+@pytest.mark.parametrize('query, params', [
+    ("SELECT * FROM partners_filesets WHERE pid=?", (1,)),
+    ("SELECT * FROM partners_filesets WHERE pid = ? AND filetype = ?", (1, 4)),
+    ("SELECT * FROM file_run_status WHERE run_id = ? AND partner = ?", (1, 1)),
+    ("SELECT partner FROM partner_run_status WHERE code = 3 AND run_id = ?", (1,)),
+])
+def test_hot_queries_use_indexes(conn, query, params):
+    fileset_db.upgrade_schema(conn)
+    plan = query_plan(conn, query, params)
+    assert 'USING' in plan and 'INDEX' in plan, plan
+
+
+def add_runs(conn, run_dates):
+    for run_id, run_date in enumerate(run_dates, 1):
+        conn.execute("INSERT INTO current_run_status (id, run_date) \
+            VALUES (?, ?)", (run_id, run_date))
+        conn.execute("INSERT INTO partner_run_status (code, partner, run_id) \
+            VALUES (3, 1, ?)", (run_id,))
+        conn.execute("INSERT INTO file_run_status (code, partner, run_id) \
+            VALUES (1, 1, ?)", (run_id,))
+    conn.commit()
+
+
+def test_retention_by_run_count(conn):
+    fileset_db.upgrade_schema(conn)
+    add_runs(conn, ['2017-01-0{}'.format(day) for day in range(1, 6)])
+    assert fileset_db.first_run_to_keep(conn, max_runs=2) == 3
+    deleted = fileset_db.delete_runs_before(conn, 3)
+    assert deleted == {'file_run_status': 2, 'file_profile': 0,
+                       'partner_run_status': 2, 'current_run_status': 2}
+    assert conn.execute("SELECT MIN(run_id) FROM file_run_status") \
+        .fetchone()[0] == 3
+
+
+def test_retention_by_age(conn):
+    add_runs(conn, ['2001-01-01', '2001-01-02'])
+    conn.execute("INSERT INTO current_run_status (id, run_date) \
+        VALUES (3, CURRENT_DATE)")
+    assert fileset_db.first_run_to_keep(conn, max_days=30) == 3
+    assert fileset_db.first_run_to_keep(conn) is None
+
+
+def test_incremental_vacuum(conn):
+    conn.execute("CREATE TABLE filler (data BLOB)")
+    conn.executemany("INSERT INTO filler VALUES (zeroblob(4000))",
+                     [()] * 200)
+    conn.execute("DELETE FROM filler")
+    conn.commit()
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    assert free_pages > 10
+    assert fileset_db.incremental_vacuum(conn, 5, 2) == 10
+    fileset_db.incremental_vacuum(conn, 1000, 10)
+    assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+
+
+def test_backup_database(tmp_path):
+    db_path = str(tmp_path / 'fileset_db.sqlite')
+    backup_path = str(tmp_path / 'fileset_db.sqlite.bk')
+    conn = sqlite3.connect(db_path)
+    fileset_db.create_empty_tables(conn)
+    conn.commit()
+    assert fileset_db.backup_database(db_path, backup_path, generations=2)
+    # nothing changed, so no new backup
+    assert not fileset_db.backup_database(db_path, backup_path, generations=2)
+    conn.execute("INSERT INTO partners (name) VALUES ('UFH')")
+    conn.commit()
+    assert fileset_db.backup_database(db_path, backup_path, generations=2)
+    backup = sqlite3.connect(backup_path)
+    assert backup.execute("SELECT name FROM partners").fetchall() == [('UFH',)]
+    previous = sqlite3.connect(backup_path + '.1')
+    assert previous.execute("SELECT name FROM partners").fetchall() == []
+    assert not (tmp_path / 'fileset_db.sqlite.bk.2').exists()
+
+
+def test_backup_database_wal(tmp_path):
+    db_path = str(tmp_path / 'fileset_db.sqlite')
+    backup_path = str(tmp_path / 'fileset_db.sqlite.bk')
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    fileset_db.create_empty_tables(conn)
+    conn.commit()
+    conn.close()
+    assert fileset_db.backup_database(db_path, backup_path)
+    assert not fileset_db.backup_database(db_path, backup_path)
+    # the change counter stays the same in WAL mode, and closing the last
+    # connection checkpoints the log and removes it
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO partners (name) VALUES ('UFH')")
+    conn.commit()
+    conn.close()
+    assert not os.path.exists(db_path + '-wal')
+    assert fileset_db.backup_database(db_path, backup_path)
+    backup = sqlite3.connect(backup_path)
+    assert backup.execute("SELECT name FROM partners").fetchall() == [('UFH',)]
+
+
+def test_backup_database_compressed(tmp_path):
+    db_path = str(tmp_path / 'fileset_db.sqlite')
+    conn = sqlite3.connect(db_path)
+    fileset_db.create_empty_tables(conn)
+    conn.commit()
+    backup_path = str(tmp_path / 'fileset_db.sqlite.bk')
+    assert fileset_db.backup_database(db_path, backup_path, compress=True)
+    with gzip.open(backup_path + '.gz', 'rb') as f:
+        assert f.read(16) == b'SQLite format 3\x00'
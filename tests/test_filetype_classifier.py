@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from data_inbox.filetype_classifier import FiletypeClassifier, name_grams
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+FILETYPES = [(1, 'Condition'), (2, 'Death Cause'), (3, 'Death'), \
+    (4, 'Demographic'), (5, 'Diagnosis'), (12, 'Vital'), (31, 'HCN_VitalFeed')]
+
+
+def make_classifier():
+    classifier = FiletypeClassifier()
+    for filetype_id, name in FILETYPES:
+        classifier.add_name(name, filetype_id)
+    return classifier
+
+
+def test_name_grams():
+    assert name_grams('death_cause_2018') == name_grams('Death Cause')
+    assert name_grams('DX') == {'DX'}
+    assert name_grams('2018') == set()
+
+
+def test_classify_by_name():
+    classifier = make_classifier()
+    # the closest name wins, whatever order the filetypes are in
+    assert classifier.classify('DEATH_CAUSE_20180101') == (2, 'name')
+    assert classifier.classify('DEATH_20180101') == (3, 'name')
+    assert classifier.classify('uf_vital') == (12, 'name')
+    assert classifier.classify('HCN_VITALFEED') == (31, 'name')
+    assert classifier.classify('readme') == (None, None)
+
+
+def test_classify_by_header():
+    classifier = make_classifier()
+    classifier.add_header(['PATID', 'DX', 'DX_TYPE', 'ADMIT_DATE'], 5)
+    classifier.add_header(['PATID', 'BIRTH_DATE', 'SEX'], 4)
+    # the name says nothing, the header does
+    assert classifier.classify('uf_extract', ['patid', 'DX', 'DX_TYPE']) == \
+        (5, 'header')
+    assert classifier.classify('uf_extract', ['ENCOUNTERID']) == (None, None)
+    # a learned filename pattern
+    classifier.add_name('uf_extract', 5)
+    assert classifier.classify('UF_EXTRACT_2019') == (5, 'name')
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from data_inbox.header_diff import diff_columns, header_fingerprint
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+
+def test_unchanged_header_uses_fingerprint():
+    old = ['PATID', 'BIRTH_DATE', 'SEX']
+    diff = diff_columns(list(old), old, header_fingerprint(old))
+    assert diff['unchanged']
+    assert header_fingerprint(old) != header_fingerprint(['PATID', 'SEX'])
+
+
+def test_added_and_deleted_columns():
+    diff = diff_columns(['PATID', 'SEX', 'RACE', 'RACE'],
+                        ['PATID', 'BIRTH_DATE', 'SEX', 'RACE'])
+    assert not diff['unchanged']
+    assert diff['added'] == ['RACE']
+    assert diff['deleted'] == ['BIRTH_DATE']
+    assert diff['duplicates'] == ['RACE']
+    assert diff['moved'] == []
+
+
+def test_reordered_columns():
+    diff = diff_columns(['SEX', 'PATID', 'BIRTH_DATE', 'RACE'],
+                        ['PATID', 'BIRTH_DATE', 'SEX', 'RACE'])
+    assert not diff['unchanged']
+    assert diff['added'] == [] and diff['deleted'] == []
+    # only the column that actually moved is reported
+    assert diff['moved'] == ['SEX']
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlite3
+
+from data_inbox import fileset_db, header_history
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+
+def test_pack_columns():
+    packed = header_history.pack_columns([1, 70000, 3])
+    assert len(packed) == 12
+    assert header_history.unpack_columns(packed) == [1, 70000, 3]
+
+
+def test_record_header():
+    conn = sqlite3.connect(':memory:')
+    fileset_db.create_empty_tables(conn)
+    fileset_db.upgrade_schema(conn)
+    # deliveries recorded newest first, as the fileset builder does
+    header_history.record_header(conn, 1, 4, 'DEMOGRAPHIC', \
+        ['PATID', 'BIRTH_DATE', 'SEX', 'RACE'], ',', '2017-03-01 00:00:00')
+    header_history.record_header(conn, 1, 4, 'DEMOGRAPHIC', \
+        ['PATID', 'BIRTH_DATE', 'SEX'], ',', '2017-02-01 00:00:00')
+    header_history.record_header(conn, 1, 4, 'DEMOGRAPHIC', \
+        ['PATID', 'BIRTH_DATE', 'SEX'], ',', '2017-01-01 00:00:00')
+    header_history.record_header(conn, 2, 4, 'DEMOGRAPHIC', \
+        ['PATID', 'SEX'], '|', '2016-01-01 00:00:00')
+    versions = header_history.header_versions(conn, 1, 4)
+    assert [(version['columns'], version['first_seen'], version['last_seen']) \
+        for version in versions] == [
+        (['PATID', 'BIRTH_DATE', 'SEX'], '2017-01-01 00:00:00', '2017-02-01 00:00:00'),
+        (['PATID', 'BIRTH_DATE', 'SEX', 'RACE'], '2017-03-01 00:00:00', \
+            '2017-03-01 00:00:00')]
+    # each column name is stored once
+    assert conn.execute("SELECT COUNT(*) FROM column_names").fetchone()[0] == 4
+    assert header_history.column_span(conn, 1, 'RACE') == \
+        ('2017-03-01 00:00:00', '2017-03-01 00:00:00')
+    assert header_history.column_span(conn, 1, 'SEX') == \
+        ('2017-01-01 00:00:00', '2017-03-01 00:00:00')
+    assert header_history.column_span(conn, 2, 'RACE') is None
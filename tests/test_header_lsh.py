@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from data_inbox import header_lsh
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+
+def columns(prefix, count):
+    return header_lsh.column_set(['{}_{}'.format(prefix, number) \
+        for number in range(count)])
+
+
+def test_signature():
+    first = header_lsh.signature(columns('DX', 20))
+    assert len(first) == header_lsh.NUM_HASHES
+    # order and case don't matter
+    assert first == header_lsh.signature(header_lsh.column_set( \
+        ['dx_{}'.format(number) for number in reversed(range(20))]))
+    assert header_lsh.signature(frozenset()) is None
+
+
+def test_query():
+    index = header_lsh.HeaderIndex()
+    for key, prefix in enumerate(['DX', 'PX', 'LAB', 'VITAL']):
+        index.add(key, columns(prefix, 20))
+    # a header with a column added and one renamed still finds its match
+    new = columns('PX', 19) | {'PX_NEW', 'EXTRA'}
+    matches = index.query(new)
+    assert matches[0][1] == 1
+    assert matches[0][0] == header_lsh.jaccard(new, columns('PX', 20))
+    assert index.query(columns('OTHER', 20)) == []
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import zipfile
+
+from data_inbox import header_reader
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+
+def write(tmp_path, data, name='DEMOGRAPHIC.csv'):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_line_terminators(tmp_path):
+    for data in [b'PATID,SEX\n1,F\n', b'PATID,SEX\r\n1,F\r\n',
+                 b'PATID,SEX\r1,F\r', b'PATID,SEX']:
+        assert header_reader.read_header(write(tmp_path, data)) == \
+            ('PATID,SEX', header_reader.HEADER_OK)
+
+
+def test_quoted_newline(tmp_path):
+    path = write(tmp_path, b'PATID,"BIRTH\nDATE"\n1,2000\n')
+    assert header_reader.read_header(path) == \
+        ('PATID,"BIRTH\nDATE"', header_reader.HEADER_OK)
+
+
+def test_stray_quote(tmp_path):
+    path = write(tmp_path, b'PATID,SEX"\n1,F\n2,M\n')
+    assert header_reader.read_header(path) == \
+        ('PATID,SEX"', header_reader.HEADER_OK)
+
+
+def test_header_too_long(tmp_path):
+    path = write(tmp_path, b'X' * 5000)
+    assert header_reader.read_header(path, max_bytes=1000) == \
+        (None, header_reader.HEADER_TOO_LONG)
+
+
+def test_not_text(tmp_path):
+    path = write(tmp_path, b'\xff\xfe\x00\x81\n')
+    assert header_reader.read_header(path) == \
+        (None, header_reader.HEADER_NOT_TEXT)
+
+
+def test_gzip_header(tmp_path):
+    path = tmp_path / 'DEMOGRAPHIC.csv.gz'
+    with gzip.open(str(path), 'wb') as stream:
+        stream.write(b'PATID,SEX\n' + b'1,F\n' * 100000)
+    compression = header_reader.sniff_content(str(path))
+    assert compression == 'gz'
+    assert header_reader.read_header(str(path), compression=compression) == \
+        ('PATID,SEX', header_reader.HEADER_OK)
+
+
+def test_zip_members(tmp_path):
+    path = str(tmp_path / 'extract.zip')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('DEMOGRAPHIC.csv', 'PATID,SEX\n1,F\n')
+        archive.writestr('DIAGNOSIS.txt', 'PATID|DX\n1|A\n')
+    assert header_reader.zip_members(path) == ['DEMOGRAPHIC.csv', 'DIAGNOSIS.txt']
+    assert header_reader.read_header(path, compression='zip', \
+        member='DIAGNOSIS.txt') == ('PATID|DX', header_reader.HEADER_OK)
+
+
+def test_corrupt_compressed(tmp_path):
+    path = write(tmp_path, b'not really gzip\n', 'DEMOGRAPHIC.csv.gz')
+    assert header_reader.read_header(path, compression='gz') == \
+        (None, header_reader.HEADER_UNREADABLE)
+
+
+def test_sniff_content(tmp_path):
+    assert header_reader.sniff_content(write(tmp_path, b'%PDF-1.4\n')) == 'pdf'
+    assert header_reader.sniff_content(write(tmp_path, b'PAR1\x15\x04')) == 'parquet'
+    assert header_reader.sniff_content(write(tmp_path, b'SQLite format 3\x00')) == 'sqlite'
+    assert header_reader.sniff_content(write(tmp_path, b'PATID,SEX\n')) is None
+    assert header_reader.sniff_content(write(tmp_path, b'')) is None
+
+
+def test_split_header():
+    assert header_reader.split_header('PATID\t"LAST, FIRST"\tSEX') == \
+        (['PATID', '"LAST, FIRST"', 'SEX'], '\t')
+    # the most common delimiter wins, and the preferred one only a tie
+    assert header_reader.split_header('A|B|C,D', preferred=',') == \
+        (['A', 'B', 'C,D'], '|')
+    assert header_reader.split_header('a;b;c,d', preferred=',') == \
+        (['a', 'b', 'c,d'], ';')
+    assert header_reader.split_header('A|B;C') == (['A|B', 'C'], ';')
+    assert header_reader.split_header('A|B;C', preferred='|') == \
+        (['A', 'B;C'], '|')
+    assert header_reader.split_header('A,"B;C') == (['A', '"B;C'], ',')
+    assert header_reader.split_header('PATID') == (['PATID'], None)
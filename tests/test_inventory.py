@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from data_inbox.inventory import DirectoryInventory
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+
+def test_first_file_keeps_entries_read_ahead(tmp_path):
+    (tmp_path / 'a_dir').mkdir()
+    (tmp_path / 'DEMOGRAPHIC.csv').write_text('PATID\n')
+    (tmp_path / 'VITAL.csv').write_text('PATID\n')
+    inventory = DirectoryInventory(str(tmp_path))
+    assert inventory.first_file().is_file()
+    names = sorted(entry.name for entry in inventory)
+    assert names == ['DEMOGRAPHIC.csv', 'VITAL.csv', 'a_dir']
+
+
+def test_only_directories(tmp_path):
+    (tmp_path / 'a_dir').mkdir()
+    inventory = DirectoryInventory(str(tmp_path))
+    assert inventory.first_file() is None
+    assert inventory.entries_read() == 1
+    inventory.close()
+
+
+def test_missing_directory(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        DirectoryInventory(str(tmp_path / 'missing'))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlite3
+
+from data_inbox import fileset_db, report_model
+from data_inbox.status_writer import StatusWriter
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+
+def test_load_run():
+    conn = sqlite3.connect(':memory:')
+    fileset_db.create_empty_tables(conn)
+    fileset_db.upgrade_schema(conn)
+    conn.executemany("INSERT INTO partners (id, name, name_full) VALUES (?, ?, ?)", \
+        [(1, 'UFH', 'University of Florida Health'), (2, 'TMH', 'Tallahassee'), \
+        (3, 'ORH', 'Orlando Health')])
+    writer = StatusWriter(conn)
+    writer.add_partner_status(3, 1, 7)
+    writer.add_partner_status(2, 3, 7)
+    writer.add_partner_status(3, 2, 7)
+    writer.add_file_status(1, 1, 7, 'DEMOGRAPHIC.csv')
+    writer.add_file_status(2, 1, 7, 'DIAGNOSIS.csv', cols_add="['EXTRA']")
+    writer.add_file_status(1, 2, 7, 'ENCOUNTER.csv', duplicate_of='ENC.csv (run 6)')
+    # other runs aren't loaded
+    writer.add_file_status(2, 1, 6, 'DIAGNOSIS.csv')
+    writer.flush()
+    partners = report_model.load_run(conn, 7)
+    assert [(partner.name_full, partner.code) for partner in partners] == \
+        [('University of Florida Health', 3), ('Orlando Health', 2), \
+        ('Tallahassee', 3)]
+    assert [item['filename_pattern'] for item in partners[0].files] == \
+        ['DEMOGRAPHIC.csv', 'DIAGNOSIS.csv']
+    assert partners[0].files[1]['cols_add'] == "['EXTRA']"
+    assert partners[1].files == []
+    assert [item['filename_pattern'] for partner in partners \
+        for item in partner.exceptions()] == ['DIAGNOSIS.csv', 'ENCOUNTER.csv']
+
+
+def test_result_sink(tmp_path):
+    conn = sqlite3.connect(':memory:')
+    fileset_db.create_empty_tables(conn)
+    fileset_db.upgrade_schema(conn)
+    path = str(tmp_path / 'results.jsonl')
+    csv_path = tmp_path / 'results.csv'
+    sink = report_model.ResultSink(path, {1: 'UFH', 2: 'TMH'}, str(csv_path))
+    writer = StatusWriter(conn, sink)
+    writer.add_partner_status(1, 2, 7)
+    writer.add_partner_status(3, 1, 7)
+    writer.add_file_status(1, 1, 7, 'DEMOGRAPHIC.csv')
+    writer.add_file_status(2, 1, 7, 'DIAGNOSIS.csv', cols_add="['EXTRA']")
+    # records are on disk before the database is written
+    writer.flush()
+    assert (tmp_path / 'results.jsonl').read_text().count('\n') == 4
+    assert csv_path.read_text().splitlines()[3].startswith( \
+        'file,7,1,UFH,1,DEMOGRAPHIC.csv,True')
+    # in watch mode, a partner's status and a file's result can be replaced
+    writer.add_partner_status(3, 2, 8)
+    writer.add_file_status(1, 2, 8, 'ENCOUNTER.csv')
+    writer.add_partner_status(3, 2, 7)
+    writer.add_file_status(1, 1, 7, 'DIAGNOSIS.csv')
+    partners = sink.load_run(7)
+    assert [(partner.name_full, partner.code) for partner in partners] == \
+        [('UFH', 3), ('TMH', 3)]
+    assert [(item['filename_pattern'], item['ok_to_process']) for item in \
+        partners[0].files] == [('DEMOGRAPHIC.csv', True), ('DIAGNOSIS.csv', True)]
+    assert [item['filename_pattern'] for item in sink.load_run(8)[0].files] == \
+        ['ENCOUNTER.csv']
+    sink.close()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlite3
+
+from data_inbox import fileset_db
+from data_inbox.status_writer import StatusWriter
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+
+def test_flush_writes_buffered_rows():
+    conn = sqlite3.connect(':memory:')
+    fileset_db.create_empty_tables(conn)
+    fileset_db.upgrade_schema(conn)
+    writer = StatusWriter(conn)
+    writer.add_partner_status(3, 1, 7)
+    writer.add_file_status(1, 1, 7, 'DEMOGRAPHIC.csv')
+    writer.add_file_status(2, 1, 7, 'DIAGNOSIS.csv', cols_add="['EXTRA']")
+    assert writer.pending() == 3
+    assert conn.execute("SELECT COUNT(*) FROM file_run_status").fetchone()[0] == 0
+    writer.flush()
+    assert writer.pending() == 0
+    assert not conn.in_transaction
+    rows = conn.execute("SELECT code, filename_pattern, filetype, cols_add \
+        FROM file_run_status ORDER BY id").fetchall()
+    assert rows == [(1, 'DEMOGRAPHIC.csv', 'unknown', None),
+                    (2, 'DIAGNOSIS.csv', 'unknown', "['EXTRA']")]
+    assert conn.execute("SELECT code, partner, run_id FROM partner_run_status") \
+        .fetchall() == [(3, 1, 7)]
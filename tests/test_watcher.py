@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from data_inbox import watcher
+
+__author__ = "Nicholas Rejack"
+__copyright__ = "Nicholas Rejack"
+__license__ = "none"
+
+
+def test_polling_watcher_reports_settled_files(tmp_path):
+    directory = str(tmp_path)
+    (tmp_path / 'OLD.csv').write_text('PATID\n')
+    file_watcher = watcher.PollingWatcher([directory], 0.01)
+    (tmp_path / 'NEW.csv').write_text('PATID\n')
+    # first poll sees the new file, the next one sees it hasn't changed
+    events = file_watcher.events(1) + file_watcher.events(1)
+    assert events == [(directory, 'NEW.csv')]
+    assert file_watcher.events(1) == []
+
+
+def test_inotify_watcher_reports_closed_files(tmp_path):
+    directory = str(tmp_path)
+    try:
+        file_watcher = watcher.InotifyWatcher([directory])
+    except (AttributeError, OSError):
+        pytest.skip("inotify not available")
+    (tmp_path / 'NEW.csv').write_text('PATID\n')
+    assert file_watcher.events(1) == [(directory, 'NEW.csv')]
+    file_watcher.close()